@@ -1,3 +1,5 @@
 # -*- coding: utf-8 -*-
+from . import controllers
 from . import models
-from . import wizard
\ No newline at end of file
+from . import report
+from . import wizard
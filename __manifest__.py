@@ -59,7 +59,9 @@ Technical Features:
     ],
     'data': [
         'security/ir.model.access.csv',
+        'data/ir_cron_data.xml',
         'views/product_template_views.xml',  # NEW
+        'views/product_archive_replace_run_views.xml',
         'wizard/product_archive_replace_wizard_view.xml',
         'report/product_archive_replace_report.xml',
         'report/product_archive_replace_report_template.xml',
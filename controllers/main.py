@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import wrap_file
+
+from odoo import http
+from odoo.http import request, content_disposition, Response
+import logging
+
+from ..models.product_archive_replace_run import EXPORT_FORMATS
+
+_logger = logging.getLogger(__name__)
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv;charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class ProductArchiveReplaceExport(http.Controller):
+
+    @http.route('/ics_product_archive_replace/run/<int:run_id>/export/<string:file_format>',
+                type='http', auth='user')
+    def export_run_results(self, run_id, file_format, **kwargs):
+        """
+        Stream the results of a run as CSV or XLSX.
+        The file is built in a temporary file and sent in blocks, so the
+        worker memory does not depend on the number of result lines.
+        """
+        if file_format not in EXPORT_FORMATS:
+            raise NotFound()
+        run = request.env['product.archive.replace.run'].browse(run_id).exists()
+        if not run:
+            raise NotFound()
+        run.check_access_rights('read')
+        run.check_access_rule('read')
+        
+        handle, path = tempfile.mkstemp(suffix=f'.{file_format}', prefix='archive_replace_')
+        os.close(handle)
+        try:
+            run._export_results(file_format, path)
+            size = os.path.getsize(path)
+            output = open(path, 'rb')
+        finally:
+            # The open handle keeps the data readable until the response is sent
+            os.unlink(path)
+        
+        _logger.info(f"Exporting {file_format} results of run {run.name} ({size} bytes)")
+        filename = f"{run.name.replace('/', '_')}.{file_format}"
+        return Response(
+            wrap_file(request.httprequest.environ, output),
+            headers=[
+                ('Content-Type', EXPORT_MIMETYPES[file_format]),
+                ('Content-Length', size),
+                ('Content-Disposition', content_disposition(filename)),
+            ],
+            direct_passthrough=True,
+        )
@@ -1,2 +1,9 @@
 # -*- coding: utf-8 -*-
-from . import product_template
\ No newline at end of file
+from . import product_template
+from . import product_product
+from . import product_archive_replace_counter
+from . import product_archive_replace_profiler
+from . import product_archive_replace_scanner
+from . import product_archive_replace_reference
+from . import product_archive_replace_run
+from . import product_archive_replace_journal
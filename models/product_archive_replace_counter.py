@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from datetime import timedelta
+
+from odoo import models, fields, api
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Counts dict keys -> reference snapshot fields of product.template
+SNAPSHOT_FIELDS = {
+    'sale_count': 'ref_sale_count',
+    'purchase_count': 'ref_purchase_count',
+    'bom_count': 'ref_bom_count',
+    'pricelist_count': 'ref_pricelist_count',
+    'vendor_count': 'ref_vendor_count',
+    'stock_qty': 'ref_stock_qty',
+}
+
+# Models whose changes make the snapshot of their products stale,
+# as (model, field pointing at the variant, field pointing at the template)
+SNAPSHOT_SOURCES = [
+    ('sale.order.line', 'product_id', None),
+    ('purchase.order.line', 'product_id', None),
+    ('mrp.bom', None, 'product_tmpl_id'),
+    ('mrp.bom.line', 'product_id', None),
+    ('product.pricelist.item', 'product_id', 'product_tmpl_id'),
+    ('product.supplierinfo', 'product_id', 'product_tmpl_id'),
+    ('stock.quant', 'product_id', None),
+]
+
+
+class ProductArchiveReplaceCounter(models.AbstractModel):
+    _name = 'product.archive.replace.counter'
+    _description = 'Archive & Replace Reference Counter'
+
+    # ========== COUNTING ENGINE ==========
+
+    @api.model
+    def _empty_counts(self):
+        """Return a zeroed counts dict"""
+        return {
+            'sale_count': 0,
+            'purchase_count': 0,
+            'bom_count': 0,
+            'pricelist_count': 0,
+            'vendor_count': 0,
+            'stock_qty': 0.0,
+        }
+
+    @api.model
+    def _get_variant_index(self, templates):
+        """Map every active variant of ``templates`` to its template id"""
+        if not templates:
+            return {}
+        variants = self.env['product.product'].search_read(
+            [('product_tmpl_id', 'in', templates.ids)], ['product_tmpl_id']
+        )
+        return {variant['id']: variant['product_tmpl_id'][0] for variant in variants}
+
+    @api.model
+    def _read_group_counts(self, model_name, domain, groupby):
+        """Run one grouped count on ``model_name`` and yield (group values, count)"""
+        groups = self.env[model_name].read_group(domain, groupby, groupby, lazy=False)
+        for group in groups:
+            values = tuple(
+                group[field][0] if group[field] else False
+                for field in groupby
+            )
+            yield values, group['__count']
+
+    @api.model
+    def _get_reference_counts(self, templates):
+        """
+        Count references for all ``templates`` at once.
+        Issues a single grouped query per referencing model and maps the
+        counts back to templates through a variant -> template index.
+        Returns a dict {template_id: counts dict}.
+        """
+        counts = {template_id: self._empty_counts() for template_id in templates.ids}
+        if not templates:
+            return counts
+
+        variant_index = self._get_variant_index(templates)
+        variant_ids = list(variant_index)
+        template_ids = set(templates.ids)
+
+        def add(template_id, key, value):
+            if template_id in counts:
+                counts[template_id][key] += value
+
+        if variant_ids:
+            for model_name, key in [('sale.order.line', 'sale_count'),
+                                    ('purchase.order.line', 'purchase_count')]:
+                for (variant_id,), count in self._read_group_counts(
+                        model_name, [('product_id', 'in', variant_ids)], ['product_id']):
+                    add(variant_index.get(variant_id), key, count)
+
+        if 'mrp.bom' in self.env:
+            for (template_id,), count in self._read_group_counts(
+                    'mrp.bom', [('product_tmpl_id', 'in', list(template_ids))], ['product_tmpl_id']):
+                add(template_id, 'bom_count', count)
+            if variant_ids:
+                for (variant_id,), count in self._read_group_counts(
+                        'mrp.bom.line', [('product_id', 'in', variant_ids)], ['product_id']):
+                    add(variant_index.get(variant_id), 'bom_count', count)
+
+        # Pricelist items and vendors can point at the template, the variant or both:
+        # each record is attributed to exactly one template, variant first.
+        for model_name, key in [('product.pricelist.item', 'pricelist_count'),
+                                ('product.supplierinfo', 'vendor_count')]:
+            domain = [('product_tmpl_id', 'in', list(template_ids))]
+            if variant_ids:
+                domain = ['|'] + domain + [('product_id', 'in', variant_ids)]
+            for (template_id, variant_id), count in self._read_group_counts(
+                    model_name, domain, ['product_tmpl_id', 'product_id']):
+                add(variant_index.get(variant_id, template_id), key, count)
+
+        stock = self._get_stock_quantities(variant_index)
+        for template_id, qty in stock.items():
+            add(template_id, 'stock_qty', qty)
+
+        return counts
+
+    @api.model
+    def _get_stock_quantities(self, variant_index, by_location=False):
+        """
+        Sum the on-hand quantities of the indexed variants in internal
+        locations, the quantities moved by the stock transfer, with one grouped
+        query on stock.quant. Forecasts and the warehouse context are ignored.
+        Returns a dict {template_id: qty}, or {(template_id, location_id): qty}
+        with ``by_location``.
+        """
+        quantities = defaultdict(float)
+        if not variant_index:
+            return quantities
+        groupby = ['product_id', 'location_id'] if by_location else ['product_id']
+        groups = self.env['stock.quant'].read_group(
+            [('product_id', 'in', list(variant_index)), ('location_id.usage', '=', 'internal')],
+            ['quantity:sum'], groupby, lazy=False,
+        )
+        for group in groups:
+            template_id = variant_index[group['product_id'][0]]
+            key = (template_id, group['location_id'][0]) if by_location else template_id
+            quantities[key] += group['quantity'] or 0.0
+        return quantities
+
+    @api.model
+    def _sum_counts(self, counts):
+        """Aggregate per-template counts into totals"""
+        totals = self._empty_counts()
+        for template_counts in counts.values():
+            for key, value in template_counts.items():
+                totals[key] += value
+        return totals
+
+    # ========== REFERENCE SNAPSHOT ==========
+
+    @api.model
+    def _get_snapshot_settings(self):
+        """
+        The snapshot is switched on with the ics_product_archive_replace.snapshot
+        parameter. Returns (enabled, maximum age in minutes, batch size).
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        enabled = get_param('ics_product_archive_replace.snapshot') not in (False, '', '0', 'False', 'false')
+        return (
+            enabled,
+            int(get_param('ics_product_archive_replace.snapshot_max_age', 120)),
+            int(get_param('ics_product_archive_replace.snapshot_batch_size', 5000)),
+        )
+
+    @api.model
+    def _get_counts(self, templates):
+        """
+        Same result as _get_reference_counts. Templates whose snapshot is
+        fresh enough are read from their stored counts in one query; only
+        the others are counted live.
+        """
+        enabled, max_age, _batch_size = self._get_snapshot_settings()
+        if not enabled or not templates:
+            return self._get_reference_counts(templates)
+
+        limit = fields.Datetime.now() - timedelta(minutes=max_age)
+        snapshots = self.env['product.template'].with_context(active_test=False).search_read(
+            [('id', 'in', templates.ids), ('ref_snapshot_date', '>=', limit)],
+            list(SNAPSHOT_FIELDS.values())
+        )
+        counts = {
+            snapshot['id']: {key: snapshot[field_name] for key, field_name in SNAPSHOT_FIELDS.items()}
+            for snapshot in snapshots
+        }
+        stale = templates.browse([template_id for template_id in templates.ids if template_id not in counts])
+        if stale:
+            counts.update(self._get_reference_counts(stale))
+        return counts
+
+    @api.model
+    def _refresh_snapshot(self, templates):
+        """Store the live counts of ``templates`` with one UPDATE"""
+        if not templates:
+            return 0
+        counts = self._get_reference_counts(templates)
+        columns = list(SNAPSHOT_FIELDS.values())
+        rows = [
+            [template_id] + [template_counts[key] for key in SNAPSHOT_FIELDS]
+            for template_id, template_counts in counts.items()
+        ]
+
+        Template = self.env['product.template']
+        Template.flush_model(columns + ['ref_snapshot_date'])
+        row_values = ', '.join(['(' + ', '.join(['%s'] * (len(columns) + 1)) + ')'] * len(rows))
+        assignments = ', '.join(f'"{column}" = v."{column}"' for column in columns)
+        self.env.cr.execute(f"""
+            UPDATE product_template AS t
+               SET {assignments}, ref_snapshot_date = %s
+              FROM (VALUES {row_values}) AS v(id, {', '.join(columns)})
+             WHERE t.id = v.id
+        """, [fields.Datetime.now()] + [value for row in rows for value in row])
+        Template.invalidate_model(columns + ['ref_snapshot_date'])
+        return len(rows)
+
+    @api.model
+    def _get_changed_template_ids(self, since):
+        """Templates whose references were created or modified after ``since``, one grouped query per source"""
+        template_ids = set()
+        variant_ids = set()
+        for model_name, variant_field, template_field in SNAPSHOT_SOURCES:
+            if model_name not in self.env:
+                continue
+            for field_name, ids in [(variant_field, variant_ids), (template_field, template_ids)]:
+                if not field_name:
+                    continue
+                for (record_id,), _count in self._read_group_counts(
+                        model_name, [('write_date', '>', since), (field_name, '!=', False)], [field_name]):
+                    ids.add(record_id)
+
+        if variant_ids:
+            variants = self.env['product.product'].with_context(active_test=False).search_read(
+                [('id', 'in', list(variant_ids))], ['product_tmpl_id']
+            )
+            template_ids.update(variant['product_tmpl_id'][0] for variant in variants)
+        return template_ids
+
+    @api.model
+    def _cron_refresh_snapshot(self):
+        """
+        Refresh the reference snapshot of the active products whose references
+        changed since the last pass (write_date deltas), then of the oldest
+        snapshots so every product is recounted within the maximum age.
+        Each batch is committed on its own.
+        """
+        enabled, max_age, batch_size = self._get_snapshot_settings()
+        if not enabled:
+            return
+
+        ICP = self.env['ir.config_parameter'].sudo()
+        Template = self.env['product.template']
+        started = fields.Datetime.now()
+        last_refresh = ICP.get_param('ics_product_archive_replace.snapshot_last_refresh')
+
+        template_ids = []
+        if last_refresh:
+            changed_ids = self._get_changed_template_ids(fields.Datetime.to_datetime(last_refresh))
+            template_ids = Template.search([('id', 'in', list(changed_ids))]).ids
+        template_ids += Template.search([
+            ('id', 'not in', template_ids),
+            '|', ('ref_snapshot_date', '=', False),
+            ('ref_snapshot_date', '<', started - timedelta(minutes=max_age / 2)),
+        ], order='ref_snapshot_date asc nulls first, id', limit=batch_size).ids
+
+        refreshed = 0
+        for start in range(0, len(template_ids), batch_size):
+            refreshed += self._refresh_snapshot(Template.browse(template_ids[start:start + batch_size]))
+            self.env.cr.commit()
+
+        ICP.set_param('ics_product_archive_replace.snapshot_last_refresh', fields.Datetime.to_string(started))
+        _logger.info(f"Refreshed the reference snapshot of {refreshed} products")
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+
+from odoo import models, fields, api, _
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class ProductArchiveReplaceJournal(models.Model):
+    """
+    Previous values of the records written by a run, one row per bulk write
+    and field ({record id: previous value}), with the values the run wrote,
+    the records it created and the stock quantities it moved.
+    Replayed in reverse order to undo the run.
+    """
+    _name = 'product.archive.replace.journal'
+    _description = 'Product Archive & Replace Change Journal'
+    _order = 'id'
+
+    run_id = fields.Many2one('product.archive.replace.run', required=True, ondelete='cascade', index=True)
+    operation = fields.Selection([
+        ('write', 'Write'),
+        ('create', 'Create'),
+        ('stock', 'Stock Update'),
+    ], required=True, default='write', readonly=True)
+    res_model = fields.Char('Model', required=True, readonly=True)
+    field_name = fields.Char('Field', readonly=True)
+    values = fields.Text(
+        'Previous Values', readonly=True,
+        help='JSON {record id: previous value} for writes, list of the created ids for creations, '
+             'list of the quantities added to quants for stock updates.'
+    )
+    written_values = fields.Text(
+        'Written Values', readonly=True,
+        help='JSON {record id: value written by the run}. Records holding another value when the run '
+             'is reverted were changed since, and are left as they are.'
+    )
+    record_count = fields.Integer('Records', readonly=True)
+    skipped_count = fields.Integer(
+        'Changed Since Run', readonly=True,
+        help='Records left as they are by the revert because they were changed after the run.'
+    )
+    state = fields.Selection([
+        ('recorded', 'Recorded'),
+        ('reverted', 'Reverted'),
+    ], default='recorded', required=True, readonly=True, index=True)
+
+    # ========== RECORDING ==========
+
+    @api.model
+    def _get_run_id(self):
+        """Run being processed, journaling is off outside of runs"""
+        return self.env.context.get('archive_replace_run_id')
+
+    @api.model
+    def _record_values(self, records, field_names):
+        """
+        Journal the current values of ``field_names`` on ``records`` before
+        they are overwritten. Returns the created entries.
+        """
+        run_id = self._get_run_id()
+        if not run_id or not records:
+            return self.browse()
+        field_names = list(field_names)
+        data = records.read(field_names, load=False)
+        return self.create([{
+            'run_id': run_id,
+            'res_model': records._name,
+            'field_name': field_name,
+            'values': json.dumps({row['id']: row[field_name] for row in data}, default=str),
+            'record_count': len(data),
+        } for field_name in field_names])
+
+    @contextmanager
+    def _recording(self, records, field_names):
+        """Journal ``field_names`` on ``records`` before the enclosed writes, and the values they wrote"""
+        entries = self._record_values(records, field_names)
+        yield entries
+        entries._record_written_values()
+
+    def _record_written_values(self):
+        """Store the current values of the journaled records as the values written by the run"""
+        for entry in self:
+            res_ids = [int(res_id) for res_id in json.loads(entry.values)]
+            data = self.env[entry.res_model].sudo().with_context(active_test=False).browse(res_ids).read(
+                [entry.field_name], load=False)
+            entry.written_values = json.dumps({row['id']: row[entry.field_name] for row in data}, default=str)
+
+    @api.model
+    def _record_raw_values(self, model_name, field_name, values, written_values):
+        """
+        Journal ``values`` {record id: previous value} and ``written_values``
+        {record id: new value} known by the caller, e.g. from RETURNING
+        """
+        run_id = self._get_run_id()
+        if not run_id or not values:
+            return
+        self.create({
+            'run_id': run_id,
+            'res_model': model_name,
+            'field_name': field_name,
+            'values': json.dumps(values, default=str),
+            'written_values': json.dumps(written_values, default=str),
+            'record_count': len(values),
+        })
+
+    @api.model
+    def _record_creation(self, records):
+        """Journal the records created by the run"""
+        run_id = self._get_run_id()
+        if not run_id or not records:
+            return
+        self.create({
+            'run_id': run_id,
+            'operation': 'create',
+            'res_model': records._name,
+            'values': json.dumps(records.ids),
+            'record_count': len(records),
+        })
+
+    @api.model
+    def _record_stock(self, quantities):
+        """
+        Journal quantities added to (or, when negative, removed from) quants,
+        as dicts of product_id, location_id, lot_id, package_id, owner_id and
+        quantity
+        """
+        run_id = self._get_run_id()
+        if not run_id or not quantities:
+            return
+        self.create({
+            'run_id': run_id,
+            'operation': 'stock',
+            'res_model': 'stock.quant',
+            'values': json.dumps(quantities),
+            'record_count': len(quantities),
+        })
+
+    # ========== REVERT ==========
+
+    def _revert(self):
+        """Replay the entries in reverse order, newest first"""
+        for entry in self.sorted('id', reverse=True):
+            if entry.state != 'recorded':
+                continue
+            if entry.operation == 'create':
+                entry._revert_creation()
+            elif entry.operation == 'stock':
+                entry._revert_stock()
+            else:
+                entry._revert_write()
+        self.write({'state': 'reverted'})
+
+    def _revert_write(self):
+        """
+        Put the previous values back with one UPDATE, or one write per value
+        for x2many fields. Records whose value is no longer the one written by
+        the run were changed since: they are left as they are.
+        """
+        self.ensure_one()
+        Model = self.env[self.res_model].sudo().with_context(active_test=False)
+        field = Model._fields[self.field_name]
+        values = {int(res_id): value for res_id, value in json.loads(self.values).items()}
+        written = {int(res_id): value for res_id, value in json.loads(self.written_values).items()} \
+            if self.written_values else None
+        existing_ids = set(Model.browse(list(values)).exists().ids)
+        values = {res_id: value for res_id, value in values.items() if res_id in existing_ids}
+        if not values:
+            return
+        
+        if field.type in ('many2many', 'one2many'):
+            groups = defaultdict(list)
+            for record in Model.browse(list(values)):
+                if written is None or sorted(record[self.field_name].ids) == sorted(written.get(record.id) or ()):
+                    groups[tuple(values[record.id] or ())].append(record.id)
+            for value, res_ids in groups.items():
+                Model.browse(res_ids).write({self.field_name: [(6, 0, list(value))]})
+            reverted_ids = [res_id for res_ids in groups.values() for res_id in res_ids]
+        else:
+            Model.flush_model([self.field_name])
+            column_type = field.column_type[1]
+            
+            def to_sql(value):
+                return value if value is not False or field.type == 'boolean' else None
+            
+            rows = [(res_id, to_sql(value), to_sql(written.get(res_id, False) if written else False))
+                    for res_id, value in values.items()]
+            row_values = ', '.join([f'(%s, %s::{column_type}, %s::{column_type})'] * len(rows))
+            condition = f' AND t."{self.field_name}" IS NOT DISTINCT FROM v.written' if written is not None else ''
+            self.env.cr.execute(f"""
+                UPDATE "{Model._table}" AS t
+                   SET "{self.field_name}" = v.value
+                  FROM (VALUES {row_values}) AS v(id, value, written)
+                 WHERE t.id = v.id{condition}
+             RETURNING t.id
+            """, [value for row in rows for value in row])
+            reverted_ids = [row[0] for row in self.env.cr.fetchall()]
+            Model.invalidate_model([self.field_name])
+            Model.browse(reverted_ids).modified([self.field_name])
+        
+        self.skipped_count = len(values) - len(reverted_ids)
+        if self.skipped_count:
+            _logger.warning(f"Revert left {self.skipped_count} {self.res_model}.{self.field_name} values "
+                            f"changed since the run as they are")
+
+    def _revert_creation(self):
+        """
+        Undo the records created by the run: replacement products are
+        archived, release their codes and leave the replacement chain, and
+        inventory moves are reversed.
+        """
+        self.ensure_one()
+        records = self.env[self.res_model].sudo().with_context(active_test=False).browse(
+            json.loads(self.values)).exists()
+        if not records:
+            return
+        if self.res_model == 'product.template':
+            records.product_variant_ids.write({'barcode': False, 'default_code': False})
+            records.write({'active': False, 'replaced_template_id': False})
+            self._unlink_replaced_templates(records)
+        elif self.res_model == 'stock.move':
+            self._reverse_inventory_moves(records.filtered(lambda move: move.state == 'done'))
+        elif 'active' in records._fields:
+            records.write({'active': False})
+        else:
+            records.unlink()
+
+    def _unlink_replaced_templates(self, replacements):
+        """
+        Clear the links still pointing at the reverted ``replacements`` once
+        the link writes of the run are reverted, i.e. links changed since the
+        run, so that no chain resolves to an archived replacement
+        """
+        templates = self.env['product.template'].sudo().with_context(active_test=False).search([
+            ('replacement_template_id', 'in', replacements.ids),
+        ])
+        if not templates:
+            return
+        templates.write({'replacement_template_id': False, 'replacement_date': False, 'replacement_user_id': False})
+        _logger.warning(f"Revert unlinked {len(templates)} products from reverted replacements: {templates.ids}")
+
+    def _revert_stock(self):
+        """
+        Apply the opposite of the journaled quantities to the quants, e.g.
+        put back the stock cleared on the archived products, so the stock
+        moved since the run (receipts, deliveries...) is kept
+        """
+        self.ensure_one()
+        Quant = self.env['stock.quant'].sudo()
+        for row in json.loads(self.values):
+            Quant._update_available_quantity(
+                self.env['product.product'].browse(row['product_id']),
+                self.env['stock.location'].browse(row['location_id']),
+                -row['quantity'],
+                lot_id=self.env['stock.lot'].browse(row['lot_id'] or []),
+                package_id=self.env['stock.quant.package'].browse(row['package_id'] or []),
+                owner_id=self.env['res.partner'].browse(row['owner_id'] or []),
+            )
+
+    @api.model
+    def _reverse_inventory_moves(self, moves):
+        """Bring the quantities of done inventory moves back with reversed done moves"""
+        if not moves:
+            return
+        reverse_moves = self.env['stock.move'].sudo().create([{
+            'name': _('Revert: %s', move.name),
+            'product_id': move.product_id.id,
+            'product_uom': move.product_uom.id,
+            'product_uom_qty': move.quantity_done,
+            'location_id': move.location_dest_id.id,
+            'location_dest_id': move.location_id.id,
+            'company_id': move.company_id.id,
+            'is_inventory': True,
+            'move_line_ids': [(0, 0, {
+                'product_id': line.product_id.id,
+                'product_uom_id': line.product_uom_id.id,
+                'qty_done': line.qty_done,
+                'location_id': line.location_dest_id.id,
+                'location_dest_id': line.location_id.id,
+                'lot_id': line.lot_id.id,
+                'package_id': line.result_package_id.id,
+                'result_package_id': line.package_id.id,
+                'owner_id': line.owner_id.id,
+                'company_id': line.company_id.id,
+            }) for line in move.move_line_ids],
+        } for move in moves])
+        reverse_moves._action_done()
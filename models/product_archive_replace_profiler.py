@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import time
+from contextlib import contextmanager, nullcontext
+
+from odoo import models, api
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Phases of one product replacement, in execution order
+PROFILE_PHASES = [
+    ('copy', 'Product Copy'),
+    ('sales', 'Sales Orders'),
+    ('purchases', 'Purchase Orders'),
+    ('boms', 'BOMs'),
+    ('pricelists', 'Pricelists'),
+    ('vendors', 'Vendors'),
+    ('stock', 'Stock'),
+    ('references', 'Other References'),
+    ('archive', 'Archive'),
+    ('chatter', 'Chatter'),
+]
+
+
+class PhaseProfile:
+    """Wall time, SQL query count and rows touched per phase of one product"""
+
+    def __init__(self, cr):
+        self.cr = cr
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the enclosed block; the yielded dict takes the rows touched"""
+        stat = self.phases.setdefault(name, {'wall_time': 0.0, 'query_count': 0, 'row_count': 0})
+        queries = self.cr.sql_log_count
+        started = time.perf_counter()
+        try:
+            yield stat
+        finally:
+            stat['wall_time'] += time.perf_counter() - started
+            stat['query_count'] += self.cr.sql_log_count - queries
+
+    def add(self, name, wall_time=0.0, query_count=0, row_count=0):
+        """Add figures measured elsewhere to a phase"""
+        stat = self.phases.setdefault(name, {'wall_time': 0.0, 'query_count': 0, 'row_count': 0})
+        stat['wall_time'] += wall_time
+        stat['query_count'] += query_count
+        stat['row_count'] += row_count
+
+    def get_share(self, name, count):
+        """Per-product share of a phase measured once for ``count`` products"""
+        stat = self.phases.get(name)
+        if not stat or not count:
+            return {}
+        return {
+            'wall_time': stat['wall_time'] / count,
+            'query_count': round(stat['query_count'] / count),
+            'row_count': 1,
+        }
+
+    def get_phase_vals(self):
+        """Values of the run phase records of the measured phases"""
+        return [dict(stat, phase=name) for name, stat in self.phases.items()]
+
+
+class NullProfile:
+    """Profile used when profiling is disabled: measures nothing"""
+
+    phases = {}
+
+    def phase(self, name):
+        return nullcontext({})
+
+    def add(self, name, **figures):
+        pass
+
+    def get_share(self, name, count):
+        return {}
+
+    def get_phase_vals(self):
+        return []
+
+
+NULL_PROFILE = NullProfile()
+
+
+class ProductArchiveReplaceProfiler(models.AbstractModel):
+    _name = 'product.archive.replace.profiler'
+    _description = 'Archive & Replace Phase Profiler'
+
+    @api.model
+    def _is_enabled(self):
+        """
+        Profiling is switched on with the ics_product_archive_replace.profiling
+        parameter, or for one call with the archive_replace_profiling context key.
+        """
+        if self.env.context.get('archive_replace_profiling'):
+            return True
+        value = self.env['ir.config_parameter'].sudo().get_param('ics_product_archive_replace.profiling')
+        return value not in (False, '', '0', 'False', 'false')
+
+    @api.model
+    def _new_profile(self, enabled):
+        """Return a fresh profile for one product, or the shared no-op profile"""
+        return PhaseProfile(self.env.cr) if enabled else NULL_PROFILE
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+
+from odoo import models, api, tools
+import logging
+
+_logger = logging.getLogger(__name__)
+
+REFERENCE_COMODELS = ('product.product', 'product.template')
+
+# Models left out of the generic migration: either migrated by a dedicated
+# phase of the wizard, or part of the products' own structure and history
+EXCLUDED_REFERENCE_MODELS = {
+    'product.product',
+    'product.template',
+    'product.template.attribute.line',
+    'product.template.attribute.value',
+    'product.template.attribute.exclusion',
+    'product.archive.replace.run.line',
+    'sale.order.line',
+    'purchase.order.line',
+    'mrp.bom',
+    'mrp.bom.line',
+    'product.pricelist.item',
+    'product.supplierinfo',
+    'stock.quant',
+    'stock.lot',
+    'stock.valuation.layer',
+    'account.analytic.line',
+}
+
+
+class ProductArchiveReplaceReference(models.AbstractModel):
+    _name = 'product.archive.replace.reference'
+    _description = 'Archive & Replace Reference Registry'
+
+    # ========== DISCOVERY ==========
+
+    @api.model
+    def _get_excluded_references(self):
+        """
+        Models and (model, field) pairs never migrated by the registry.
+        Override to add the references a module migrates itself.
+        """
+        return set(EXCLUDED_REFERENCE_MODELS)
+
+    @api.model
+    def _get_reference_handlers(self):
+        """
+        Migrations replacing the generic update, as {model name: method name}.
+        The method is called with (reference, mapping, skip_locked) and returns
+        the rows updated and the ids skipped, like ``_update_reference``.
+        Override to plug in models needing more than a plain update.
+        """
+        return {
+            'stock.move': '_update_open_stock_moves',
+            'stock.move.line': '_update_open_stock_moves',
+            'mrp.production': '_update_open_productions',
+            'stock.scrap': '_update_open_scraps',
+            'account.move.line': '_update_draft_journal_items',
+        }
+
+    @api.model
+    @tools.ormcache()
+    def _get_reference_fields(self):
+        """
+        Stored many2one fields pointing at product.product or product.template,
+        read once from ir.model.fields and kept until the registry caches are
+        cleared. Related and computed fields are left out: they follow the
+        fields they depend on.
+        Returns a tuple of (model, field, comodel).
+        """
+        excluded = self._get_excluded_references()
+        fields_data = self.env['ir.model.fields'].sudo().search_read([
+            ('ttype', '=', 'many2one'),
+            ('relation', 'in', REFERENCE_COMODELS),
+            ('store', '=', True),
+        ], ['model', 'name', 'relation'], order='model, name')
+
+        references = []
+        for data in fields_data:
+            model_name, field_name = data['model'], data['name']
+            if model_name in excluded or (model_name, field_name) in excluded or model_name not in self.env:
+                continue
+            Model = self.env[model_name]
+            field = Model._fields.get(field_name)
+            if Model._abstract or Model._transient or not Model._auto or not field \
+                    or not field.store or field.compute or field.related:
+                continue
+            references.append((model_name, field_name, data['relation']))
+
+        _logger.info(f"Discovered {len(references)} product references to migrate")
+        return tuple(references)
+
+    # ========== MIGRATION ==========
+
+    @api.model
+    def _migrate_references(self, template_map, variant_map, skip_locked=False):
+        """
+        Point every discovered reference from the old products to the new ones
+        with one set-based UPDATE per field, whatever the number of products.
+        ``template_map`` and ``variant_map`` map old ids to new ids.
+        With ``skip_locked``, rows locked by other transactions are left as is.
+        Each field is updated in a savepoint: when the update fails, e.g. on a
+        unique constraint when several variants are merged, the old ids are
+        retried one by one and only the failing ones are left out.
+        Returns a Counter {(comodel, old id): rows updated}, a list of
+        (reference, ids) of the locked rows left on the old products and a
+        dict {(comodel, old id): error} of the old ids that failed.
+        """
+        Run = self.env['product.archive.replace.run']
+        handlers = self._get_reference_handlers()
+        counts = Counter()
+        locked = []
+        failed = {}
+        for reference in self._get_reference_fields():
+            model_name, field_name, comodel = reference
+            mapping = variant_map if comodel == 'product.product' else template_map
+            if not mapping:
+                continue
+            handler = getattr(self, handlers.get(model_name, '_update_reference'))
+            try:
+                with self.env.cr.savepoint():
+                    results = [handler(reference, mapping, skip_locked)]
+            except Exception as e:
+                if Run._is_concurrency_error(e):
+                    raise
+                if len(mapping) == 1:
+                    failed[(comodel, next(iter(mapping)))] = f'{model_name}.{field_name}: {e}'
+                    continue
+                _logger.warning(f"Migration of {model_name}.{field_name} failed, retrying product by product: {e}")
+                results = []
+                for old_id, new_id in mapping.items():
+                    try:
+                        with self.env.cr.savepoint():
+                            results.append(handler(reference, {old_id: new_id}, skip_locked))
+                    except Exception as e:
+                        if Run._is_concurrency_error(e):
+                            raise
+                        failed[(comodel, old_id)] = f'{model_name}.{field_name}: {e}'
+            for updated, locked_ids in results:
+                counts.update((comodel, old_id) for old_id in updated.values())
+                if locked_ids:
+                    locked.append((reference, locked_ids))
+        return counts, locked, failed
+
+    @api.model
+    def _update_reference(self, reference, mapping, skip_locked=False, where=None):
+        """
+        Rewrite ``reference`` for all the old -> new ids of ``mapping`` in one
+        UPDATE, restricted by the ``where`` SQL condition on the ``t`` alias.
+        The ORM cache of the field is invalidated and the fields depending on
+        it are recomputed, and the previous values are journaled on the run.
+        Returns {row id: old id} of the rows updated and the ids of the locked
+        rows skipped.
+        """
+        model_name, field_name, _comodel = reference
+        Model = self.env[model_name]
+        Model.flush_model()
+
+        candidate_ids = set()
+        if skip_locked:
+            self.env.cr.execute(
+                f'SELECT t.id FROM "{Model._table}" AS t WHERE t."{field_name}" IN %s'
+                + (f' AND {where}' if where else ''),
+                [tuple(mapping)]
+            )
+            candidate_ids = {row[0] for row in self.env.cr.fetchall()}
+            if not candidate_ids:
+                return {}, []
+
+        params = [value for pair in mapping.items() for value in pair]
+        assignments = f'"{field_name}" = m.new_id'
+        if Model._log_access:
+            assignments += ", write_uid = %s, write_date = now() at time zone 'UTC'"
+            params.insert(0, self.env.uid)
+        conditions = f't."{field_name}" = m.old_id'
+        if where:
+            conditions += f' AND {where}'
+        if skip_locked:
+            conditions += (f' AND t.id IN (SELECT id FROM "{Model._table}" WHERE "{field_name}" IN %s'
+                           f' FOR NO KEY UPDATE SKIP LOCKED)')
+            params.append(tuple(mapping))
+
+        values = ', '.join(['(%s, %s)'] * len(mapping))
+        self.env.cr.execute(f"""
+            UPDATE "{Model._table}" AS t
+               SET {assignments}
+              FROM (VALUES {values}) AS m(old_id, new_id)
+             WHERE {conditions}
+         RETURNING t.id, m.old_id
+        """, params)
+        previous = dict(self.env.cr.fetchall())
+        ids = list(previous)
+
+        if ids:
+            self.env['product.archive.replace.journal']._record_raw_values(
+                model_name, field_name, previous, {row_id: mapping[old_id] for row_id, old_id in previous.items()})
+            Model.invalidate_model([field_name, 'write_uid', 'write_date'] if Model._log_access else [field_name])
+            Model.browse(ids).modified([field_name])
+            _logger.info(f"Migrated {len(ids)} {model_name}.{field_name} references")
+        return previous, sorted(candidate_ids.difference(ids))
+
+    # ========== HANDLERS ==========
+
+    @api.model
+    def _update_open_stock_moves(self, reference, mapping, skip_locked=False):
+        """Done and cancelled moves are stock history: they stay on the archived product"""
+        return self._update_reference(reference, mapping, skip_locked, where="t.state NOT IN ('done', 'cancel')")
+
+    @api.model
+    def _update_open_productions(self, reference, mapping, skip_locked=False):
+        """Finished and cancelled manufacturing orders stay on the archived product"""
+        return self._update_reference(reference, mapping, skip_locked, where="t.state NOT IN ('done', 'cancel')")
+
+    @api.model
+    def _update_draft_journal_items(self, reference, mapping, skip_locked=False):
+        """Posted journal items are accounting history: only draft entries are migrated"""
+        return self._update_reference(reference, mapping, skip_locked, where="t.parent_state = 'draft'")
+
+    @api.model
+    def _update_open_scraps(self, reference, mapping, skip_locked=False):
+        """Done scraps are stock history: they stay on the archived product"""
+        return self._update_reference(reference, mapping, skip_locked, where="t.state != 'done'")
@@ -0,0 +1,979 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from psycopg2 import Error as PsycopgError, OperationalError
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+import logging
+
+from .product_archive_replace_profiler import PROFILE_PHASES
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+_logger = logging.getLogger(__name__)
+
+# Background workers: one scheduled action each, so they can run in parallel cron threads
+WORKER_CRON_XMLIDS = [
+    'ics_product_archive_replace.ir_cron_product_archive_replace_run',
+    'ics_product_archive_replace.ir_cron_product_archive_replace_run_worker_2',
+    'ics_product_archive_replace.ir_cron_product_archive_replace_run_worker_3',
+    'ics_product_archive_replace.ir_cron_product_archive_replace_run_worker_4',
+]
+
+# Deterministic retry schedule for serialization failures and deadlocks
+MAX_CONCURRENCY_RETRIES = 5
+RETRY_BASE_DELAY = 0.5
+
+# Raised by NOWAIT when another transaction holds the row
+PG_LOCK_NOT_AVAILABLE = '55P03'
+
+# First key of the session advisory locks held by workers on the chunks they process
+CHUNK_LOCK_NAMESPACE = 584201
+
+# Result line columns of the exports, as (column, header)
+EXPORT_COLUMNS = [
+    ('id', 'Line ID'),
+    ('old_product_id', 'Old Product ID'),
+    ('old_product_name', 'Old Product'),
+    ('old_default_code', 'Old Ref'),
+    ('old_barcode', 'Old Barcode'),
+    ('old_type', 'Old Type'),
+    ('new_product_id', 'New Product ID'),
+    ('new_product_name', 'New Product'),
+    ('new_type', 'New Type'),
+    ('status', 'Status'),
+    ('sales_migrated', 'Sales Lines'),
+    ('purchases_migrated', 'Purchase Lines'),
+    ('boms_migrated', 'BOMs'),
+    ('pricelists_migrated', 'Pricelists'),
+    ('vendors_migrated', 'Vendors'),
+    ('stock_transferred', 'Stock Cleared'),
+    ('references_migrated', 'Other References'),
+    ('error_message', 'Error Message'),
+    ('note', 'Notes'),
+]
+EXPORT_FORMATS = ('csv', 'xlsx')
+
+
+class ProductArchiveReplaceRun(models.Model):
+    _name = 'product.archive.replace.run'
+    _description = 'Product Archive & Replace Run'
+    _order = 'id desc'
+
+    name = fields.Char('Reference', required=True, readonly=True, copy=False, default=lambda self: _('New'))
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+        ('reverted', 'Reverted'),
+    ], default='draft', string='Status', required=True, readonly=True, index=True, copy=False)
+    user_id = fields.Many2one('res.users', string='Executed By', default=lambda self: self.env.user, readonly=True)
+    date_start = fields.Datetime('Started On', readonly=True, copy=False)
+    date_end = fields.Datetime('Finished On', readonly=True, copy=False)
+    date_reverted = fields.Datetime('Reverted On', readonly=True, copy=False)
+
+    # ========== MIGRATION OPTIONS (copied from the wizard) ==========
+    new_type = fields.Selection([
+        ('product', 'Storable Product'),
+        ('consu', 'Consumable'),
+        ('service', 'Service'),
+    ], required=True, string="New Product Type", readonly=True)
+    migrate_sales = fields.Boolean('Migrate Sales Orders', readonly=True)
+    migrate_purchases = fields.Boolean('Migrate Purchase Orders', readonly=True)
+    migrate_boms = fields.Boolean('Migrate BOMs', readonly=True)
+    migrate_pricelists = fields.Boolean('Migrate Pricelists', readonly=True)
+    migrate_vendors = fields.Boolean('Migrate Vendors', readonly=True)
+    migrate_stock = fields.Boolean('Clear Stock', readonly=True)
+    migrate_references = fields.Boolean('Migrate Other References', readonly=True)
+    stock_transfer_moves = fields.Boolean('Record Stock Moves', readonly=True)
+    continue_on_error = fields.Boolean('Continue on Migration Errors', readonly=True)
+    bulk_write = fields.Boolean('Bulk Reference Rewrite', readonly=True)
+    chatter_mode = fields.Selection([
+        ('immediate', 'Post per Product'),
+        ('batched', 'Batched Messages'),
+        ('run_log', 'Run Log Only'),
+    ], default='immediate', string='Chatter Messages', readonly=True)
+    lock_mode = fields.Selection([
+        ('wait', 'Wait for Locks'),
+        ('skip_locked', 'Skip Locked Rows'),
+    ], default='wait', string='Locking', readonly=True)
+
+    # ========== CHUNKS & PROGRESS ==========
+    chunk_size = fields.Integer('Products per Chunk', default=50, readonly=True)
+    worker_count = fields.Integer(
+        'Parallel Workers', default=1, readonly=True,
+        help='Number of scheduled actions processing the chunks concurrently.'
+    )
+    chunk_ids = fields.One2many('product.archive.replace.run.chunk', 'run_id', string='Chunks', readonly=True)
+    line_ids = fields.One2many('product.archive.replace.run.line', 'run_id', string='Migration Results', readonly=True)
+    product_count = fields.Integer('Products to Process', readonly=True)
+    # Aggregated from the lines so concurrent workers never write the run row per chunk
+    processed_count = fields.Integer('Processed Products', compute='_compute_progress')
+    success_count = fields.Integer('Successful Replacements', compute='_compute_progress')
+    failed_count = fields.Integer('Failed Replacements', compute='_compute_progress')
+    skipped_count = fields.Integer('Already Replaced', compute='_compute_progress')
+    progress = fields.Float('Progress', compute='_compute_progress')
+    error_message = fields.Text('Error Message', readonly=True, copy=False)
+
+    # ========== DEFERRED ROWS (low-contention mode) ==========
+    deferred_ids = fields.One2many('product.archive.replace.deferred', 'run_id', string='Deferred Rows', readonly=True)
+    deferred_pending_count = fields.Integer('Rows Pending (Locked)', compute='_compute_deferred_counts')
+    deferred_abandoned_count = fields.Integer('Rows Abandoned (Locked)', compute='_compute_deferred_counts')
+
+    # ========== CHANGE JOURNAL ==========
+    journal_ids = fields.One2many('product.archive.replace.journal', 'run_id', string='Change Journal', readonly=True)
+
+    # ========== TOTALS (successful lines) ==========
+    total_sales_migrated = fields.Integer('Sales Lines Migrated', compute='_compute_totals')
+    total_purchases_migrated = fields.Integer('Purchase Lines Migrated', compute='_compute_totals')
+    total_boms_migrated = fields.Integer('BOMs Migrated', compute='_compute_totals')
+    total_pricelists_migrated = fields.Integer('Pricelists Migrated', compute='_compute_totals')
+    total_vendors_migrated = fields.Integer('Vendors Migrated', compute='_compute_totals')
+    total_stock_transferred = fields.Float('Stock Cleared', compute='_compute_totals')
+    total_references_migrated = fields.Integer('Other References Migrated', compute='_compute_totals')
+
+    # ========== PROFILING ==========
+    phase_ids = fields.One2many('product.archive.replace.run.phase', 'run_id', string='Phase Timings', readonly=True)
+    profile_summary = fields.Html('Phase Profile', compute='_compute_profile_summary', sanitize=False)
+
+    @api.model
+    def _get_option_fields(self):
+        """Wizard options stored on the run and replayed on each chunk"""
+        return [
+            'new_type',
+            'migrate_sales',
+            'migrate_purchases',
+            'migrate_boms',
+            'migrate_pricelists',
+            'migrate_vendors',
+            'migrate_stock',
+            'migrate_references',
+            'stock_transfer_moves',
+            'continue_on_error',
+            'bulk_write',
+            'chatter_mode',
+            'lock_mode',
+        ]
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            if vals.get('name', _('New')) == _('New'):
+                vals['name'] = self.env['ir.sequence'].next_by_code('product.archive.replace.run') or _('New')
+        return super().create(vals_list)
+
+    def _compute_progress(self):
+        groups = self.env['product.archive.replace.run.line'].read_group(
+            [('run_id', 'in', self.ids)], ['run_id', 'status'], ['run_id', 'status'], lazy=False,
+        )
+        stats = defaultdict(dict)
+        for group in groups:
+            stats[group['run_id'][0]][group['status']] = group['__count']
+        for run in self:
+            run.success_count = stats[run.id].get('success', 0)
+            run.failed_count = stats[run.id].get('failed', 0)
+            run.skipped_count = stats[run.id].get('skipped', 0)
+            run.processed_count = run.success_count + run.failed_count + run.skipped_count
+            run.progress = 100.0 * run.processed_count / run.product_count if run.product_count else 0.0
+
+    def _compute_deferred_counts(self):
+        groups = self.env['product.archive.replace.deferred'].read_group(
+            [('run_id', 'in', self.ids), ('state', 'in', ('pending', 'abandoned'))],
+            ['run_id', 'state'], ['run_id', 'state'], lazy=False,
+        )
+        stats = defaultdict(dict)
+        for group in groups:
+            stats[group['run_id'][0]][group['state']] = group['__count']
+        for run in self:
+            run.deferred_pending_count = stats[run.id].get('pending', 0)
+            run.deferred_abandoned_count = stats[run.id].get('abandoned', 0)
+
+    def _compute_totals(self):
+        """Sum the migrated records of the successful lines with one grouped query"""
+        total_fields = ['sales_migrated', 'purchases_migrated', 'boms_migrated',
+                        'pricelists_migrated', 'vendors_migrated', 'stock_transferred',
+                        'references_migrated']
+        groups = self.env['product.archive.replace.run.line'].read_group(
+            [('run_id', 'in', self.ids), ('status', '=', 'success')],
+            ['run_id'] + [f'{field_name}:sum' for field_name in total_fields],
+            ['run_id'], lazy=False,
+        )
+        totals = {group['run_id'][0]: group for group in groups}
+        for run in self:
+            group = totals.get(run.id, {})
+            for field_name in total_fields:
+                run[f'total_{field_name}'] = group.get(field_name) or 0
+
+    def _get_phase_stats(self):
+        """
+        Aggregate the phase timings of the run with one grouped query.
+        Returns a list of dicts in execution order, empty when profiling was off.
+        """
+        self.ensure_one()
+        groups = self.env['product.archive.replace.run.phase'].read_group(
+            [('run_id', '=', self.id)],
+            ['phase', 'wall_time:sum', 'query_count:sum', 'row_count:sum'],
+            ['phase'], lazy=False,
+        )
+        by_phase = {group['phase']: group for group in groups}
+        stats = []
+        for phase, label in PROFILE_PHASES:
+            group = by_phase.get(phase)
+            if not group:
+                continue
+            count = group['__count']
+            stats.append({
+                'phase': phase,
+                'label': label,
+                'products': count,
+                'wall_time': group['wall_time'],
+                'avg_time': group['wall_time'] / count * 1000.0,
+                'query_count': group['query_count'],
+                'avg_queries': group['query_count'] / count,
+                'row_count': group['row_count'],
+            })
+        return stats
+
+    def _compute_profile_summary(self):
+        for run in self:
+            stats = run._get_phase_stats() if run.id else []
+            if not stats:
+                run.profile_summary = False
+                continue
+            rows = ''.join(
+                f"<tr><td>{stat['label']}</td><td>{stat['products']}</td>"
+                f"<td>{stat['wall_time']:.2f}</td><td>{stat['avg_time']:.1f}</td>"
+                f"<td>{stat['query_count']}</td><td>{stat['avg_queries']:.1f}</td>"
+                f"<td>{stat['row_count']}</td></tr>"
+                for stat in stats
+            )
+            run.profile_summary = (
+                "<table class='table table-sm'><thead><tr>"
+                "<th>Phase</th><th>Products</th><th>Total (s)</th><th>Avg (ms)</th>"
+                "<th>Queries</th><th>Avg Queries</th><th>Rows</th>"
+                f"</tr></thead><tbody>{rows}</tbody></table>"
+            )
+
+    # ========== CHUNKING ==========
+
+    def _create_chunks(self, product_ids):
+        """Split ``product_ids`` into chunks of ``chunk_size`` products"""
+        self.ensure_one()
+        size = max(self.chunk_size, 1)
+        self.env['product.archive.replace.run.chunk'].create([{
+            'run_id': self.id,
+            'sequence': index,
+            'product_ids': [(6, 0, product_ids[start:start + size])],
+            'product_count': len(product_ids[start:start + size]),
+        } for index, start in enumerate(range(0, len(product_ids), size))])
+
+    def _get_processor(self):
+        """
+        Return a wizard carrying the run options to process a chunk.
+        It acts as the user who started the run, not as the scheduled action
+        user, so the replacements, messages and write_uid keep their author.
+        """
+        self.ensure_one()
+        wizard = self.env['product.archive.replace.wizard'].with_user(self.user_id or self.env.user)
+        if self.worker_count > 1:
+            wizard = wizard.with_context(archive_replace_parallel=True)
+        return wizard.create({
+            field_name: self[field_name] for field_name in self._get_option_fields()
+        })
+
+    def _check_done(self):
+        """Close the run once none of its chunks is pending or running and no deferred row is left"""
+        for run in self:
+            if run.state not in ('queued', 'running'):
+                continue
+            states = set(run.chunk_ids.mapped('state'))
+            if states & {'pending', 'running'} or run.deferred_pending_count:
+                continue
+            run.write({
+                'state': 'failed' if 'failed' in states else 'done',
+                'date_end': fields.Datetime.now(),
+            })
+
+    # ========== ACTIONS ==========
+
+    def action_queue(self):
+        """Queue the run for the scheduled actions"""
+        for run in self:
+            if not run.chunk_ids:
+                raise UserError(_("Run %s has no products to process.", run.name))
+        self.write({'state': 'queued', 'error_message': False})
+        self._trigger_workers(max(self.mapped('worker_count') or [1]))
+        return True
+
+    def _get_chunks_to_retry(self):
+        """Failed chunks, and processed chunks where some products failed"""
+        return self.chunk_ids.filtered(
+            lambda c: c.state == 'failed' or (c.state == 'done' and c.failed_count)
+        )
+
+    def _requeue_chunks(self, chunks):
+        """
+        Put ``chunks`` back in the queue. Their failed lines are kept as
+        'retried' so the checkpoints they recorded survive; products already
+        completed in the run are left out when the chunks are processed again.
+        """
+        chunks.line_ids.filtered(lambda line: line.status == 'failed').write({'status': 'retried'})
+        chunks.write({'state': 'pending', 'error_message': False, 'retry_count': 0})
+
+    def action_retry_failed(self):
+        """Requeue the failed chunks of the run"""
+        for run in self:
+            chunks = run._get_chunks_to_retry()
+            if not chunks:
+                raise UserError(_("Run %s has no failed chunks.", run.name))
+            run._requeue_chunks(chunks)
+        return self.action_queue()
+
+    def action_resume(self):
+        """
+        Resume a cancelled or failed run: pending chunks are processed and
+        failed ones retried. Products replaced by an earlier attempt are
+        skipped or finished from their last checkpoint.
+        """
+        for run in self:
+            if run.state not in ('cancelled', 'failed'):
+                raise UserError(_("Only cancelled or failed runs can be resumed."))
+            run._requeue_chunks(run._get_chunks_to_retry())
+            run.date_end = False
+        return self.action_queue()
+
+    def action_cancel(self):
+        """Stop processing the remaining chunks"""
+        self.filtered(lambda r: r.state in ('draft', 'queued', 'running')).write({
+            'state': 'cancelled',
+            'date_end': fields.Datetime.now(),
+        })
+        return True
+
+    def action_revert(self):
+        """
+        Undo the run by replaying its change journal in reverse: references,
+        stock and codes go back to the archived products, which are
+        reactivated, and the replacements are archived.
+        """
+        Journal = self.env['product.archive.replace.journal']
+        for run in self:
+            if run.state not in ('done', 'failed', 'cancelled'):
+                raise UserError(_("Only finished, failed or cancelled runs can be reverted."))
+            entries = Journal.search([('run_id', '=', run.id), ('state', '=', 'recorded')])
+            if not entries:
+                raise UserError(_("Run %s has no recorded changes to revert.", run.name))
+            
+            run.deferred_ids.filtered(lambda row: row.state == 'pending').write({
+                'state': 'abandoned',
+                'last_error': _("The run was reverted."),
+            })
+            entries._revert()
+            run.write({'state': 'reverted', 'date_reverted': fields.Datetime.now()})
+            _logger.info(f"Reverted archive & replace run {run.name}: {len(entries)} journal entries replayed, "
+                         f"{sum(entries.mapped('skipped_count'))} records changed since the run left as they are")
+        
+        # Links are restored with SQL updates, which do not go through write()
+        self.env['product.template']._invalidate_replacement_cache()
+        return True
+
+    def action_refresh(self):
+        """Reload the run form to show the latest progress"""
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'reload',
+        }
+
+    # ========== EXPORT ==========
+
+    def action_export_xlsx(self):
+        return self._action_export('xlsx')
+
+    def action_export_csv(self):
+        return self._action_export('csv')
+
+    def _action_export(self, file_format):
+        """Download the results through the streaming export controller"""
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/ics_product_archive_replace/run/{self.id}/export/{file_format}',
+            'target': 'self',
+        }
+
+    def _get_export_batch_size(self):
+        """Result lines fetched per query by the exports"""
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'ics_product_archive_replace.export_batch_size', 5000))
+
+    def _iter_export_rows(self):
+        """
+        Yield the result lines of the run as tuples of EXPORT_COLUMNS.
+        Lines are read with keyset-paginated SQL in batches, so neither the
+        ORM cache nor the memory grows with the size of the run.
+        """
+        self.ensure_one()
+        self.env['product.archive.replace.run.line'].flush_model()
+        columns = ', '.join(column for column, _header in EXPORT_COLUMNS)
+        batch_size = self._get_export_batch_size()
+        last_id = 0
+        while True:
+            self.env.cr.execute(f"""
+                SELECT {columns}
+                  FROM product_archive_replace_run_line
+                 WHERE run_id = %s AND id > %s
+              ORDER BY id
+                 LIMIT %s
+            """, [self.id, last_id, batch_size])
+            rows = self.env.cr.fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def _get_export_summary(self):
+        """Run header and per-model totals written before the result lines"""
+        self.ensure_one()
+        return [
+            ('Run', self.name),
+            ('Executed By', self.user_id.name),
+            ('Started On', fields.Datetime.to_string(self.date_start) if self.date_start else ''),
+            ('Finished On', fields.Datetime.to_string(self.date_end) if self.date_end else ''),
+            ('Products', self.product_count),
+            ('Successful Replacements', self.success_count),
+            ('Failed Replacements', self.failed_count),
+            ('Sales Lines Migrated', self.total_sales_migrated),
+            ('Purchase Lines Migrated', self.total_purchases_migrated),
+            ('BOMs Migrated', self.total_boms_migrated),
+            ('Pricelists Migrated', self.total_pricelists_migrated),
+            ('Vendors Migrated', self.total_vendors_migrated),
+            ('Stock Cleared', self.total_stock_transferred),
+            ('Other References Migrated', self.total_references_migrated),
+            ('Rows Pending (Locked)', self.deferred_pending_count),
+            ('Rows Abandoned (Locked)', self.deferred_abandoned_count),
+        ]
+
+    def _export_results(self, file_format, path):
+        """Write the summary and the result lines of the run to the file at ``path``"""
+        self.ensure_one()
+        if file_format not in EXPORT_FORMATS:
+            raise UserError(_("Unsupported export format: %s", file_format))
+        
+        if file_format == 'csv':
+            with open(path, 'w', newline='', encoding='utf-8') as output:
+                writer = csv.writer(output)
+                writer.writerows(self._get_export_summary())
+                writer.writerow([])
+                writer.writerow([header for _column, header in EXPORT_COLUMNS])
+                writer.writerows(self._iter_export_rows())
+            return
+        
+        if xlsxwriter is None:
+            raise UserError(_("The Python library xlsxwriter is required for Excel exports."))
+        
+        # constant_memory flushes every row to disk as soon as the next one starts
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        bold = workbook.add_format({'bold': True})
+        
+        summary_sheet = workbook.add_worksheet('Summary')
+        for row, (label, value) in enumerate(self._get_export_summary()):
+            summary_sheet.write(row, 0, label, bold)
+            summary_sheet.write(row, 1, value)
+        
+        lines_sheet = workbook.add_worksheet('Results')
+        lines_sheet.write_row(0, 0, [header for _column, header in EXPORT_COLUMNS], bold)
+        for row, values in enumerate(self._iter_export_rows(), start=1):
+            lines_sheet.write_row(row, 0, values)
+        workbook.close()
+
+    # ========== SCHEDULED ACTIONS ==========
+
+    @api.model
+    def _trigger_workers(self, worker_count=1):
+        """Wake up ``worker_count`` worker scheduled actions"""
+        for xmlid in WORKER_CRON_XMLIDS[:max(worker_count, 1)]:
+            cron = self.env.ref(xmlid, raise_if_not_found=False)
+            if cron and cron.active:
+                cron._trigger()
+
+    @api.model
+    def _get_cron_time_budget(self):
+        """Seconds a single cron execution may spend before rescheduling itself"""
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'ics_product_archive_replace.cron_time_budget', 60))
+
+    @api.model
+    def _get_stale_chunk_delay(self):
+        """Minutes after which a running chunk is considered abandoned by its worker"""
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'ics_product_archive_replace.stale_chunk_minutes', 60))
+
+    @api.model
+    def _is_concurrency_error(self, error):
+        """Serialization failures, deadlocks and lock timeouts are retried, never swallowed"""
+        return isinstance(error, OperationalError) and error.pgcode in PG_CONCURRENCY_ERRORS_TO_RETRY
+
+    @api.model
+    def _retry_on_concurrency(self, func, label):
+        """Run ``func`` and commit, retrying concurrency errors on a fixed schedule"""
+        for attempt in range(1, MAX_CONCURRENCY_RETRIES + 1):
+            try:
+                result = func()
+                self.env.cr.commit()
+                return result
+            except OperationalError as e:
+                self.env.cr.rollback()
+                if not self._is_concurrency_error(e) or attempt == MAX_CONCURRENCY_RETRIES:
+                    raise
+                _logger.info(f"Concurrent update on {label}, retry {attempt}/{MAX_CONCURRENCY_RETRIES}")
+                time.sleep(RETRY_BASE_DELAY * attempt)
+
+    @api.model
+    def _requeue_stale_chunks(self):
+        """
+        Put back chunks whose worker died while processing them.
+        A slow chunk keeps the advisory lock of its worker and is left alone,
+        only chunks whose lock is free are requeued.
+        """
+        limit = fields.Datetime.now() - timedelta(minutes=self._get_stale_chunk_delay())
+        stale_chunks = self.env['product.archive.replace.run.chunk'].search([
+            ('state', '=', 'running'),
+            ('date_claimed', '<', limit),
+        ]).filtered(lambda chunk: chunk._is_abandoned())
+        if stale_chunks:
+            _logger.warning(f"Requeuing {len(stale_chunks)} abandoned archive & replace chunks")
+            stale_chunks.write({'state': 'pending'})
+
+    @api.model
+    def _claim_next_chunk(self):
+        """
+        Claim the next pending chunk.
+        Workers skip rows locked by each other, so each chunk is claimed once.
+        """
+        self.env.cr.execute("""
+            SELECT chunk.id
+              FROM product_archive_replace_run_chunk chunk
+              JOIN product_archive_replace_run run ON run.id = chunk.run_id
+             WHERE chunk.state = 'pending'
+               AND run.state IN ('queued', 'running')
+          ORDER BY chunk.run_id, chunk.sequence
+             LIMIT 1
+               FOR UPDATE OF chunk SKIP LOCKED
+        """)
+        row = self.env.cr.fetchone()
+        if not row:
+            return self.env['product.archive.replace.run.chunk']
+        chunk = self.env['product.archive.replace.run.chunk'].browse(row[0])
+        chunk.write({'state': 'running', 'date_claimed': fields.Datetime.now()})
+        run = chunk.run_id
+        if run.state == 'queued':
+            run.write({'state': 'running', 'date_start': run.date_start or fields.Datetime.now()})
+        return chunk
+
+    @api.model
+    def _cron_process_runs(self):
+        """Claim and process pending chunks one at a time, committing after each one"""
+        deadline = time.time() + self._get_cron_time_budget()
+        self._retry_on_concurrency(self._requeue_stale_chunks, 'stale chunks')
+
+        while time.time() < deadline:
+            chunk = self._retry_on_concurrency(self._claim_next_chunk, 'chunk claim')
+            if not chunk:
+                # Rows deferred because of locks are retried once the chunks are processed
+                self.env['product.archive.replace.deferred']._process_pending(deadline)
+                # Runs are closed once no worker has anything left to claim
+                self._retry_on_concurrency(
+                    lambda: self.search([('state', 'in', ('queued', 'running'))])._check_done(),
+                    'run completion',
+                )
+                return
+            chunk._process()
+
+        # Time budget exhausted: reschedule the workers immediately for the remaining chunks
+        active_runs = self.search([('state', 'in', ('queued', 'running'))])
+        self._trigger_workers(max(active_runs.mapped('worker_count') or [1]))
+
+
+class ProductArchiveReplaceRunChunk(models.Model):
+    _name = 'product.archive.replace.run.chunk'
+    _description = 'Product Archive & Replace Run Chunk'
+    _order = 'run_id, sequence'
+
+    run_id = fields.Many2one('product.archive.replace.run', required=True, ondelete='cascade', index=True)
+    sequence = fields.Integer('Sequence', default=0)
+    product_ids = fields.Many2many(
+        'product.template',
+        'product_archive_replace_run_chunk_product_rel',
+        'chunk_id',
+        'product_id',
+        string='Products',
+        context={'active_test': False},
+    )
+    product_count = fields.Integer('Products', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], default='pending', string='Status', required=True, index=True)
+    success_count = fields.Integer('Successful Replacements', readonly=True)
+    failed_count = fields.Integer('Failed Replacements', readonly=True)
+    skipped_count = fields.Integer('Already Replaced', readonly=True)
+    retry_count = fields.Integer('Concurrency Retries', readonly=True)
+    error_message = fields.Text('Error Message', readonly=True)
+    line_ids = fields.One2many('product.archive.replace.run.line', 'chunk_id', string='Results', readonly=True)
+    date_claimed = fields.Datetime('Claimed On', readonly=True)
+    date_done = fields.Datetime('Processed On', readonly=True)
+
+    def _get_line_counts(self):
+        """Success/failed/skipped counts of the chunk, over all its attempts"""
+        self.ensure_one()
+        groups = self.env['product.archive.replace.run.line'].read_group(
+            [('chunk_id', '=', self.id)], ['status'], ['status'], lazy=False,
+        )
+        counts = {group['status']: group['__count'] for group in groups}
+        return {
+            'success_count': counts.get('success', 0),
+            'failed_count': counts.get('failed', 0),
+            'skipped_count': counts.get('skipped', 0),
+        }
+
+    def _try_lock(self):
+        """
+        Take the session advisory lock of the chunk without waiting.
+        It survives the commits and rollbacks of the processing and is only
+        released by ``_unlock`` or when the worker's connection closes.
+        """
+        self.ensure_one()
+        self.env.cr.execute('SELECT pg_try_advisory_lock(%s, %s)', [CHUNK_LOCK_NAMESPACE, self.id])
+        return self.env.cr.fetchone()[0]
+
+    def _unlock(self):
+        """Release the session advisory lock of the chunk"""
+        self.ensure_one()
+        self.env.cr.execute('SELECT pg_advisory_unlock(%s, %s)', [CHUNK_LOCK_NAMESPACE, self.id])
+
+    def _is_abandoned(self):
+        """A running chunk is abandoned when no worker holds its advisory lock"""
+        if not self._try_lock():
+            return False
+        self._unlock()
+        return True
+
+    def _process(self):
+        """
+        Process a claimed chunk while holding its advisory lock, so that it
+        is never requeued and processed twice while its worker is alive.
+        """
+        self.ensure_one()
+        if not self._try_lock():
+            _logger.warning(f"Run {self.run_id.name}: chunk {self.sequence} is already processed by another worker")
+            return
+        try:
+            self._process_claimed()
+        finally:
+            try:
+                self._unlock()
+            except PsycopgError:
+                # The transaction was aborted by an error on its way up
+                self.env.cr.rollback()
+                self._unlock()
+
+    def _process_claimed(self):
+        """
+        Process a claimed chunk in its own transaction.
+        Concurrency errors roll the chunk back and retry it on a fixed
+        schedule before giving up.
+        """
+        self.ensure_one()
+        run = self.run_id
+        Run = self.env['product.archive.replace.run']
+
+        _logger.info(f"Run {run.name}: processing chunk {self.sequence} ({self.product_count} products)")
+
+        for attempt in range(1, MAX_CONCURRENCY_RETRIES + 1):
+            try:
+                processor = run._get_processor()
+                # Archived products are kept when they were replaced by an earlier attempt,
+                # so that they are recorded as already replaced
+                products = self.with_context(active_test=False).product_ids.filtered(
+                    lambda p: (p.active or p.replacement_template_id) and p.type != run.new_type
+                ).sorted('id').with_env(processor.env)
+                results = processor._process_products(products, run, chunk=self)
+                break
+            except Exception as e:
+                self.env.cr.rollback()
+                if Run._is_concurrency_error(e) and attempt < MAX_CONCURRENCY_RETRIES:
+                    _logger.info(f"Run {run.name}: chunk {self.sequence} hit a concurrent update, "
+                                 f"retry {attempt}/{MAX_CONCURRENCY_RETRIES}")
+                    self.retry_count = attempt
+                    self.env.cr.commit()
+                    time.sleep(RETRY_BASE_DELAY * attempt)
+                    continue
+                _logger.error(f"Run {run.name}: chunk {self.sequence} failed: {e}", exc_info=True)
+                results = None
+                error = str(e)
+                break
+
+        if results is None:
+            def fail():
+                # Every product of the rolled back chunk is reported as failed,
+                # except the ones completed by an earlier attempt of the chunk
+                RunLine = self.env['product.archive.replace.run.line']
+                done_ids = set(RunLine.search([
+                    ('run_id', '=', run.id),
+                    ('old_product_id', 'in', self.product_ids.ids),
+                    ('status', 'in', ('success', 'skipped')),
+                ]).old_product_id.ids)
+                products = self.with_context(active_test=False).product_ids.filtered(
+                    lambda p: p.id not in done_ids)
+                RunLine.create([{
+                    'run_id': run.id,
+                    'chunk_id': self.id,
+                    'old_product_id': product.id,
+                    'old_product_name': product.name,
+                    'old_default_code': product.default_code or '',
+                    'old_barcode': product.barcode or '',
+                    'old_type': product.type,
+                    'new_type': run.new_type,
+                    'status': 'failed',
+                    'error_message': error,
+                } for product in products])
+                self.write(dict(
+                    self._get_line_counts(),
+                    state='failed',
+                    error_message=error,
+                    date_done=fields.Datetime.now(),
+                ))
+                if not run.continue_on_error and run.state in ('queued', 'running'):
+                    # Stop the remaining chunks, like the synchronous mode stops on the first error
+                    run.write({
+                        'state': 'failed',
+                        'error_message': error,
+                        'date_end': fields.Datetime.now(),
+                    })
+            Run._retry_on_concurrency(fail, f'run {run.name}')
+        else:
+            # The chunk work and its completion are committed together; only the
+            # chunk row is written so workers never collide on the run record
+            self.write(dict(
+                self._get_line_counts(),
+                state='done',
+                error_message=False,
+                date_done=fields.Datetime.now(),
+            ))
+            self.env.cr.commit()
+
+
+class ProductArchiveReplaceRunLine(models.Model):
+    _name = 'product.archive.replace.run.line'
+    _description = 'Product Archive & Replace Run Line'
+    _order = 'run_id, id'
+
+    run_id = fields.Many2one('product.archive.replace.run', required=True, ondelete='cascade', index=True)
+    chunk_id = fields.Many2one('product.archive.replace.run.chunk', ondelete='set null', index=True)
+    
+    old_product_id = fields.Many2one('product.template', string='Old Product', readonly=True, index=True)
+    old_product_name = fields.Char('Old Product Name', readonly=True)
+    old_default_code = fields.Char('Old Ref', readonly=True)
+    old_barcode = fields.Char('Old Barcode', readonly=True)
+    old_type = fields.Selection([
+        ('product', 'Storable'),
+        ('consu', 'Consumable'),
+        ('service', 'Service'),
+    ], string='Old Type', readonly=True)
+    
+    new_product_id = fields.Many2one('product.template', string='New Product', readonly=True, index=True)
+    new_product_name = fields.Char('New Product Name', readonly=True)
+    new_type = fields.Selection([
+        ('product', 'Storable'),
+        ('consu', 'Consumable'),
+        ('service', 'Service'),
+    ], string='New Type', readonly=True)
+    
+    status = fields.Selection([
+        ('success', 'Success'),
+        ('failed', 'Failed'),
+        ('skipped', 'Already Replaced'),
+        ('retried', 'Failed (Retried)'),
+    ], string='Status', readonly=True, index=True)
+    checkpoint = fields.Selection(
+        PROFILE_PHASES, string='Last Completed Phase', readonly=True,
+        help='Last phase completed for this product. A later attempt resumes after it.'
+    )
+    
+    sales_migrated = fields.Integer('Sales Lines', readonly=True)
+    purchases_migrated = fields.Integer('Purchase Lines', readonly=True)
+    boms_migrated = fields.Integer('BOMs', readonly=True)
+    pricelists_migrated = fields.Integer('Pricelists', readonly=True)
+    vendors_migrated = fields.Integer('Vendors', readonly=True)
+    stock_transferred = fields.Float('Stock Cleared', readonly=True)
+    references_migrated = fields.Integer('Other References', readonly=True)
+    
+    error_message = fields.Text('Error Message', readonly=True)
+    note = fields.Text('Notes', readonly=True)
+    
+    phase_ids = fields.One2many('product.archive.replace.run.phase', 'line_id', string='Phase Timings', readonly=True)
+    profile_time = fields.Float('Time (s)', digits=(16, 3), readonly=True)
+    profile_query_count = fields.Integer('Queries', readonly=True)
+    
+    type_change = fields.Char('Type Change', compute='_compute_type_change', store=False)
+    
+    @api.depends('old_type', 'new_type')
+    def _compute_type_change(self):
+        for line in self:
+            type_map = {
+                'product': 'Storable',
+                'consu': 'Consumable',
+                'service': 'Service',
+            }
+            old = type_map.get(line.old_type, line.old_type)
+            new = type_map.get(line.new_type, line.new_type)
+            line.type_change = f"{old} → {new}"
+
+    @api.model
+    def _get_create_batch_size(self):
+        """Number of result lines buffered before they are created at once"""
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'ics_product_archive_replace.line_batch_size', 200))
+
+
+class ProductArchiveReplaceRunPhase(models.Model):
+    _name = 'product.archive.replace.run.phase'
+    _description = 'Product Archive & Replace Phase Timing'
+    _order = 'line_id, id'
+
+    run_id = fields.Many2one('product.archive.replace.run', required=True, ondelete='cascade', index=True)
+    line_id = fields.Many2one('product.archive.replace.run.line', required=True, ondelete='cascade', index=True)
+    phase = fields.Selection(PROFILE_PHASES, string='Phase', required=True, readonly=True)
+    wall_time = fields.Float('Time (s)', digits=(16, 4), readonly=True)
+    query_count = fields.Integer('Queries', readonly=True)
+    row_count = fields.Integer('Rows Touched', readonly=True)
+
+
+class ProductArchiveReplaceDeferred(models.Model):
+    _name = 'product.archive.replace.deferred'
+    _description = 'Product Archive & Replace Deferred Row'
+    _order = 'run_id, id'
+
+    run_id = fields.Many2one('product.archive.replace.run', required=True, ondelete='cascade', index=True)
+    label = fields.Char('Reference Type', readonly=True)
+    res_model = fields.Char('Model', required=True, readonly=True)
+    res_id = fields.Integer('Record ID', required=True, readonly=True)
+    parent_field = fields.Char('Parent Field', readonly=True)
+    vals = fields.Text('Values', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('abandoned', 'Abandoned'),
+    ], default='pending', string='Status', required=True, readonly=True, index=True)
+    attempt_count = fields.Integer('Attempts', readonly=True)
+    date_next_retry = fields.Datetime('Next Retry', readonly=True, default=fields.Datetime.now)
+    date_done = fields.Datetime('Written On', readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
+
+    @api.model
+    def _get_retry_settings(self):
+        """Maximum attempts and minutes between attempts of a deferred row"""
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (
+            int(get_param('ics_product_archive_replace.deferred_max_attempts', 30)),
+            int(get_param('ics_product_archive_replace.deferred_retry_minutes', 2)),
+        )
+
+    @api.model
+    def _defer(self, run, records, get_vals, label, parent_field=None):
+        """Record the writes of ``records`` that could not be done because their rows were locked"""
+        self.create([{
+            'run_id': run.id,
+            'label': label,
+            'res_model': record._name,
+            'res_id': record.id,
+            'parent_field': parent_field or False,
+            'vals': json.dumps(get_vals(record)),
+        } for record in records])
+        _logger.info(f"Run {run.name}: deferred {len(records)} locked {label} rows")
+
+    @api.model
+    def _claim_next(self):
+        """Claim the next deferred row due for a retry, skipping rows claimed by other workers"""
+        self.env.cr.execute("""
+            SELECT deferred.id
+              FROM product_archive_replace_deferred deferred
+              JOIN product_archive_replace_run run ON run.id = deferred.run_id
+             WHERE deferred.state = 'pending'
+               AND deferred.date_next_retry <= now() at time zone 'UTC'
+               AND run.state IN ('queued', 'running')
+          ORDER BY deferred.date_next_retry, deferred.id
+             LIMIT 1
+               FOR UPDATE OF deferred SKIP LOCKED
+        """)
+        row = self.env.cr.fetchone()
+        return self.browse(row[0] if row else [])
+
+    @api.model
+    def _process_pending(self, deadline):
+        """Retry due deferred rows one at a time, each in its own short transaction"""
+        while time.time() < deadline:
+            deferred = self._claim_next()
+            if not deferred:
+                return
+            deferred._retry()
+            self.env.cr.commit()
+
+    def _retry(self):
+        """
+        Write the deferred values if the row and its parent document can be
+        locked right away (NOWAIT); otherwise schedule the next attempt.
+        """
+        self.ensure_one()
+        cr = self.env.cr
+        # Written as the user who started the run, like the rest of its changes
+        record = self.env[self.res_model].with_user(self.run_id.user_id or self.env.user).browse(
+            self.res_id).exists()
+        if not record:
+            self.write({'state': 'done', 'date_done': fields.Datetime.now(),
+                        'last_error': _("The record no longer exists.")})
+            return
+        
+        try:
+            with cr.savepoint():
+                parent = record[self.parent_field] if self.parent_field else None
+                if parent:
+                    cr.execute(f'SELECT id FROM "{parent._table}" WHERE id = %s FOR NO KEY UPDATE NOWAIT',
+                               [parent.id])
+                cr.execute(f'SELECT id FROM "{record._table}" WHERE id = %s FOR NO KEY UPDATE NOWAIT',
+                           [record.id])
+                vals = json.loads(self.vals)
+                with self.env['product.archive.replace.journal'].with_context(
+                        archive_replace_run_id=self.run_id.id)._recording(record, vals):
+                    record.write(vals)
+        except Exception as e:
+            if not isinstance(e, OperationalError) or \
+                    (e.pgcode != PG_LOCK_NOT_AVAILABLE and e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY):
+                _logger.warning(f"Deferred {self.label} write on {self.res_model}({self.res_id}) failed: {e}")
+                self.write({'state': 'abandoned', 'last_error': str(e)})
+                return
+            max_attempts, retry_minutes = self._get_retry_settings()
+            attempt = self.attempt_count + 1
+            self.write({
+                'attempt_count': attempt,
+                'state': 'abandoned' if attempt >= max_attempts else 'pending',
+                'date_next_retry': fields.Datetime.now() + timedelta(minutes=retry_minutes * min(attempt, 10)),
+                'last_error': str(e),
+            })
+            return
+        
+        self.write({'state': 'done', 'date_done': fields.Datetime.now(), 'last_error': False})
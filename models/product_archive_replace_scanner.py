@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from odoo import models, api, _
+import logging
+
+_logger = logging.getLogger(__name__)
+
+PREFLIGHT_CHECKS = [
+    ('duplicate_barcode', 'Duplicate barcode'),
+    ('duplicate_code', 'Duplicate internal reference'),
+    ('stock_on_hand', 'Stock on hand'),
+    ('reserved_stock', 'Reserved stock'),
+    ('open_moves', 'Open stock moves'),
+    ('production', 'Manufacturing orders in progress'),
+    ('variant_collapse', 'Variants merged on the replacement'),
+]
+
+OPEN_MOVE_STATES = ('waiting', 'confirmed', 'partially_available', 'assigned')
+OPEN_PRODUCTION_STATES = ('confirmed', 'progress', 'to_close')
+
+
+class ProductArchiveReplaceScanner(models.AbstractModel):
+    _name = 'product.archive.replace.scanner'
+    _description = 'Archive & Replace Pre-flight Scanner'
+
+    # ========== PRE-FLIGHT SCAN ==========
+
+    @api.model
+    def _scan(self, templates, migrate_stock=True):
+        """
+        Look for the conflicts the replacement of ``templates`` would run into
+        before anything is written. Every check is one grouped query over the
+        whole target set.
+        Returns a list of issue dicts (template_id, check, severity, message).
+        """
+        issues = []
+        if not templates:
+            return issues
+
+        variants = self.env['product.product'].search_read(
+            [('product_tmpl_id', 'in', templates.ids)], ['product_tmpl_id', 'barcode', 'default_code']
+        )
+        variant_index = {variant['id']: variant['product_tmpl_id'][0] for variant in variants}
+
+        def add(template_id, check, severity, message):
+            issues.append({
+                'template_id': template_id,
+                'check': check,
+                'severity': severity,
+                'message': message,
+            })
+
+        self._check_duplicates(variants, 'barcode', 'duplicate_barcode', 'blocking', add)
+        self._check_duplicates(variants, 'default_code', 'duplicate_code', 'warning', add)
+        self._check_stock(variant_index, migrate_stock, add)
+        self._check_production(variant_index, add)
+        self._check_variant_collapse(templates, add)
+
+        _logger.info(f"Pre-flight scan of {len(templates)} products: {len(issues)} issues")
+        return issues
+
+    @api.model
+    def _check_duplicates(self, variants, field_name, check, severity, add):
+        """
+        Values of ``field_name`` shared by several targets or already used in
+        the active catalog. Replacements take over the values of the archived
+        products, so any other holder conflicts with them.
+        """
+        holders = defaultdict(set)
+        for variant in variants:
+            if variant[field_name]:
+                holders[variant[field_name]].add(variant['product_tmpl_id'][0])
+        if not holders:
+            return
+
+        for value, template_ids in holders.items():
+            if len(template_ids) > 1:
+                for template_id in template_ids:
+                    add(template_id, check, severity,
+                        _('%s is shared by %s selected products', value, len(template_ids)))
+
+        groups = self.env['product.product'].sudo().read_group(
+            [(field_name, 'in', list(holders)), ('id', 'not in', [variant['id'] for variant in variants])],
+            [field_name], [field_name], lazy=False,
+        )
+        for group in groups:
+            value = group[field_name]
+            for template_id in holders.get(value, ()):
+                add(template_id, check, severity,
+                    _('%s is already used by %s other active products', value, group['__count']))
+
+    @api.model
+    def _check_stock(self, variant_index, migrate_stock, add):
+        """
+        Stock of the archived products, which the replacement cannot hold as
+        it gets another type, and the moves left on them
+        """
+        variant_ids = list(variant_index)
+        if not variant_ids:
+            return
+        quantities = defaultdict(lambda: [0.0, 0.0])
+        for group in self.env['stock.quant'].sudo().read_group(
+                [('product_id', 'in', variant_ids), ('location_id.usage', '=', 'internal')],
+                ['quantity:sum', 'reserved_quantity:sum'], ['product_id'], lazy=False):
+            template_id = variant_index[group['product_id'][0]]
+            quantities[template_id][0] += group['quantity']
+            quantities[template_id][1] += group['reserved_quantity']
+        for template_id, (quantity, reserved) in quantities.items():
+            if quantity and migrate_stock:
+                add(template_id, 'stock_on_hand', 'warning',
+                    _('%s units on hand are cleared with an inventory adjustment: the replacement is not storable',
+                      quantity))
+            elif quantity:
+                add(template_id, 'stock_on_hand', 'warning',
+                    _('%s units on hand stay on the archived product', quantity))
+            if reserved and migrate_stock:
+                add(template_id, 'reserved_stock', 'blocking',
+                    _('%s units are reserved by pending transfers', reserved))
+
+        moves = defaultdict(int)
+        for group in self.env['stock.move'].sudo().read_group(
+                [('product_id', 'in', variant_ids), ('state', 'in', OPEN_MOVE_STATES)],
+                ['product_id'], ['product_id'], lazy=False):
+            moves[variant_index[group['product_id'][0]]] += group['__count']
+        for template_id, count in moves.items():
+            add(template_id, 'open_moves', 'warning',
+                _('%s open stock moves stay on the archived product', count))
+
+    @api.model
+    def _check_production(self, variant_index, add):
+        """Manufacturing orders still producing the archived products"""
+        if 'mrp.production' not in self.env or not variant_index:
+            return
+        productions = defaultdict(int)
+        for group in self.env['mrp.production'].sudo().read_group(
+                [('product_id', 'in', list(variant_index)), ('state', 'in', OPEN_PRODUCTION_STATES)],
+                ['product_id'], ['product_id'], lazy=False):
+            productions[variant_index[group['product_id'][0]]] += group['__count']
+        for template_id, count in productions.items():
+            add(template_id, 'production', 'warning',
+                _('%s manufacturing orders in progress stay on the archived product', count))
+
+    @api.model
+    def _check_variant_collapse(self, templates, add):
+        """
+        Variants without a matching combination on the replacement, which
+        are merged into its first variant: variants of attribute values
+        removed from the template, and archived variants of dynamic
+        attributes, which are not created again
+        """
+        groups = self.env['product.product'].sudo().with_context(active_test=False).read_group([
+            ('product_tmpl_id', 'in', templates.ids),
+            '|', ('product_template_attribute_value_ids.ptav_active', '=', False),
+            '&', ('active', '=', False),
+            ('product_template_attribute_value_ids.attribute_id.create_variant', '=', 'dynamic'),
+        ], ['product_tmpl_id'], ['product_tmpl_id'], lazy=False)
+        for group in groups:
+            add(group['product_tmpl_id'][0], 'variant_collapse', 'warning',
+                _('%s variants have no matching combination on the replacement and are merged into its first variant',
+                  group['__count']))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from odoo import models, api, _
+from odoo.exceptions import UserError
+import logging
+
+from .product_template import RESOLVE_KEY_FIELDS
+
+_logger = logging.getLogger(__name__)
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    # ========== BULK RESOLUTION ==========
+
+    @api.model
+    def resolve_current_replacements(self, keys, key_field='id'):
+        """
+        Variant-level counterpart of product.template.resolve_current_replacements.
+        ``keys`` are variant ids, default codes or barcodes.
+        Variants are mapped to the variant of the current replacement with the
+        same attribute values. Returns a dict {key: variant id of the current
+        replacement}, False for unknown keys.
+        """
+        if key_field not in RESOLVE_KEY_FIELDS:
+            raise UserError(_("Products can only be resolved by %s.", ', '.join(RESOLVE_KEY_FIELDS)))
+
+        variants = self.with_context(active_test=False).search_read(
+            [(key_field, 'in', list(keys))], [key_field, 'product_tmpl_id'], order='id'
+        )
+        variant_by_key = {variant[key_field]: variant for variant in variants}
+        heads = self.env['product.template'].resolve_current_replacements(
+            list({variant['product_tmpl_id'][0] for variant in variants})
+        )
+
+        Template = self.env['product.template'].with_context(active_test=False)
+        variant_maps = {}
+
+        def get_head_variant(variant_id, template_id, head):
+            # Variants are matched on their attribute values, once per template pair
+            if (template_id, head) not in variant_maps:
+                variant_maps[(template_id, head)] = Template.browse(template_id)._get_variant_map(
+                    Template.browse(head), create_missing=False)
+            head_variant = variant_maps[(template_id, head)].get(variant_id)
+            return head_variant.id if head_variant else False
+
+        result = {}
+        for key in keys:
+            variant = variant_by_key.get(key)
+            if not variant:
+                result[key] = False
+                continue
+            template_id = variant['product_tmpl_id'][0]
+            head = heads.get(template_id)
+            if not head or head == template_id:
+                result[key] = variant['id']
+            else:
+                result[key] = get_head_variant(variant['id'], template_id, head)
+        return result
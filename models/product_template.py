@@ -1,9 +1,24 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools.lru import LRU
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# Keys accepted by resolve_current_replacements
+RESOLVE_KEY_FIELDS = ('id', 'default_code', 'barcode')
+
+# Writing any of these fields invalidates the cached resolutions
+RESOLVE_CACHE_FIELDS = {'replacement_template_id', 'replaced_template_id'}
+
+# Chain heads kept in memory by resolve_current_replacements
+RESOLVE_CACHE_SIZE = 8192
+
+# PostgreSQL sequence moved forward whenever a replacement link changes:
+# each worker drops its cached chain heads when it sees a new value
+RESOLVE_GENERATION_SEQUENCE = 'product_archive_replace_resolve_generation'
+
 
 class ProductTemplate(models.Model):
     _inherit = 'product.template'
@@ -72,6 +87,59 @@ class ProductTemplate(models.Model):
         help='Number of products in replacement chain'
     )
     
+    # ========== CHAIN INDEX ==========
+    chain_root_id = fields.Many2one(
+        'product.template',
+        string='Chain Origin',
+        compute='_compute_chain_root',
+        store=True,
+        recursive=True,
+        index=True,
+        help='Oldest product of the replacement chain'
+    )
+    
+    chain_position = fields.Integer(
+        string='Chain Position',
+        compute='_compute_chain_root',
+        store=True,
+        recursive=True,
+        help='Position of this product in its replacement chain (0 for the origin)'
+    )
+    
+    chain_head_id = fields.Many2one(
+        'product.template',
+        string='Current Replacement',
+        compute='_compute_chain_head',
+        store=True,
+        recursive=True,
+        index=True,
+        help='Latest product of the replacement chain'
+    )
+    
+    # ========== REFERENCE SNAPSHOT ==========
+    # Reference counts stored by the snapshot scheduled action, read by the
+    # wizard instead of counting live when they are fresh enough
+    ref_sale_count = fields.Integer('Sales Lines (Snapshot)', readonly=True, copy=False)
+    ref_purchase_count = fields.Integer('Purchase Lines (Snapshot)', readonly=True, copy=False)
+    ref_bom_count = fields.Integer('BOMs (Snapshot)', readonly=True, copy=False)
+    ref_pricelist_count = fields.Integer('Pricelist Items (Snapshot)', readonly=True, copy=False)
+    ref_vendor_count = fields.Integer('Vendors (Snapshot)', readonly=True, copy=False)
+    ref_stock_qty = fields.Float('Stock Qty (Snapshot)', readonly=True, copy=False)
+    ref_snapshot_date = fields.Datetime('Reference Snapshot Date', readonly=True, copy=False, index=True)
+    
+    def init(self):
+        super().init()
+        self.env.cr.execute(f'CREATE SEQUENCE IF NOT EXISTS "{RESOLVE_GENERATION_SEQUENCE}"')
+
+    # ========== CONSTRAINTS ==========
+    
+    @api.constrains('replacement_template_id', 'replaced_template_id')
+    def _check_replacement_recursion(self):
+        """Replacement links must not loop"""
+        if not self._check_recursion('replacement_template_id') or \
+                not self._check_recursion('replaced_template_id'):
+            raise ValidationError(_("A product cannot be part of its own replacement chain."))
+    
     # ========== COMPUTE METHODS ==========
     
     @api.depends('replacement_template_id', 'replaced_template_id')
@@ -81,33 +149,36 @@ class ProductTemplate(models.Model):
             product.is_replacement = bool(product.replaced_template_id)
             product.was_replaced = bool(product.replacement_template_id)
     
-    @api.depends('replacement_template_id', 'replaced_template_id')
+    @api.depends('replacement_template_id', 'replaced_template_id',
+                 'replaced_template_id.chain_root_id', 'replaced_template_id.chain_position')
+    def _compute_chain_root(self):
+        """Propagate the chain origin and position forward, one link at a time on change"""
+        for product in self:
+            previous = product.replaced_template_id
+            if previous:
+                product.chain_root_id = previous.chain_root_id or previous
+                product.chain_position = previous.chain_position + 1
+            else:
+                product.chain_root_id = product if product.replacement_template_id else False
+                product.chain_position = 0
+    
+    @api.depends('replacement_template_id', 'replaced_template_id',
+                 'replacement_template_id.chain_head_id')
+    def _compute_chain_head(self):
+        """Propagate the current replacement backward, one link at a time on change"""
+        for product in self:
+            following = product.replacement_template_id
+            if following:
+                product.chain_head_id = following.chain_head_id or following
+            else:
+                product.chain_head_id = product if product.replaced_template_id else False
+    
+    @api.depends('chain_head_id.chain_position')
     def _compute_replacement_chain(self):
         """Compute the length of the replacement chain"""
         for product in self:
-            count = 0
-            current = product
-            visited = set()
-            
-            # Count forward replacements
-            while current.replacement_template_id and current.id not in visited:
-                visited.add(current.id)
-                count += 1
-                current = current.replacement_template_id
-                if count > 100:  # Safety limit
-                    break
-            
-            # Count backward replacements
-            current = product
-            visited = set()
-            while current.replaced_template_id and current.id not in visited:
-                visited.add(current.id)
-                count += 1
-                current = current.replaced_template_id
-                if count > 100:  # Safety limit
-                    break
-            
-            product.replacement_chain_count = count
+            # Forward and backward hops add up to the position of the chain head
+            product.replacement_chain_count = product.chain_head_id.chain_position
     
     # ========== METHODS ==========
     
@@ -117,21 +188,7 @@ class ProductTemplate(models.Model):
         Returns the latest active product in the replacement chain.
         """
         self.ensure_one()
-        
-        current = self
-        visited = set()
-        
-        # Follow the replacement chain to the end
-        while current.replacement_template_id and current.id not in visited:
-            visited.add(current.id)
-            current = current.replacement_template_id
-            
-            # Safety check
-            if len(visited) > 100:
-                _logger.warning(f"Replacement chain too long for product {self.name}")
-                break
-        
-        return current
+        return self.chain_head_id or self
     
     def get_replacement_chain(self):
         """
@@ -140,28 +197,196 @@ class ProductTemplate(models.Model):
         """
         self.ensure_one()
         
-        # Find the oldest product in chain
-        oldest = self
-        visited = set()
-        while oldest.replaced_template_id and oldest.id not in visited:
-            visited.add(oldest.id)
-            oldest = oldest.replaced_template_id
-            if len(visited) > 100:
-                break
+        if not self.chain_root_id:
+            return [self]
         
-        # Build chain from oldest to newest
-        chain = [oldest]
-        visited = set([oldest.id])
-        current = oldest
+        chain = self.with_context(active_test=False).search(
+            [('chain_root_id', '=', self.chain_root_id.id)], order='chain_position, id'
+        )
+        return list(chain)
+    
+    # ========== VARIANT MAPPING ==========
+    
+    def _get_attribute_value_map(self, new_template):
+        """
+        Map the attribute values of this template to the attribute values of
+        ``new_template`` holding the same product.attribute.value.
+        Returns a dict {old value id: new value id or None}.
+        """
+        self.ensure_one()
+        values = self.env['product.template.attribute.value'].search_read(
+            [('product_tmpl_id', 'in', [self.id, new_template.id])],
+            ['product_tmpl_id', 'product_attribute_value_id']
+        )
+        new_values = {
+            value['product_attribute_value_id'][0]: value['id']
+            for value in values if value['product_tmpl_id'][0] == new_template.id
+        }
+        return {
+            value['id']: new_values.get(value['product_attribute_value_id'][0])
+            for value in values if value['product_tmpl_id'][0] == self.id
+        }
+    
+    def _get_variant_map(self, new_template, variants=None, create_missing=True):
+        """
+        Map ``variants`` (all variants of this template by default) to the
+        variants of ``new_template`` with the same attribute values.
+        Combinations of active variants missing on ``new_template`` (dynamic
+        attributes) are created when ``create_missing`` is set; variants left
+        without a match fall back to the first variant of ``new_template``.
+        Returns a dict {old variant id: new variant}.
+        """
+        self.ensure_one()
+        if variants is None:
+            variants = self.with_context(active_test=False).product_variant_ids
+        new_variants = new_template.product_variant_ids
+        if not variants or not new_variants:
+            return {}
+        if len(new_variants) == 1 and not new_variants.product_template_attribute_value_ids:
+            return {variant.id: new_variants for variant in variants}
+        
+        value_map = self._get_attribute_value_map(new_template)
+        by_combination = {
+            frozenset(variant.product_template_attribute_value_ids.ids): variant
+            for variant in new_variants
+        }
+        
+        variant_map = {}
+        unmatched = 0
+        for variant in variants:
+            combination = [value_map.get(value_id) for value_id in variant.product_template_attribute_value_ids.ids]
+            new_variant = None
+            if all(combination):
+                new_variant = by_combination.get(frozenset(combination))
+                if not new_variant and create_missing and variant.active:
+                    new_variant = new_template._create_product_variant(
+                        self.env['product.template.attribute.value'].browse(combination)) or None
+                    if new_variant:
+                        by_combination[frozenset(combination)] = new_variant
+            if not new_variant:
+                new_variant = new_variants[0]
+                unmatched += 1
+            variant_map[variant.id] = new_variant
+        
+        if unmatched:
+            _logger.warning(f"{unmatched} variants of {self.name} have no matching variant on "
+                            f"{new_template.name}, mapped to its first variant")
+        return variant_map
+    
+    # ========== BULK RESOLUTION ==========
+    
+    @api.model
+    def resolve_current_replacements(self, keys, key_field='id'):
+        """
+        Resolve many products to their current replacement at once.
+        ``keys`` are template ids, default codes or barcodes depending on
+        ``key_field``. Returns a dict {key: current replacement template id},
+        False for unknown keys. Codes and barcodes are looked up with one
+        query; the chain heads of the templates are kept in a bounded LRU
+        until a replacement link changes.
+        """
+        if key_field not in RESOLVE_KEY_FIELDS:
+            raise UserError(_("Products can only be resolved by %s.", ', '.join(RESOLVE_KEY_FIELDS)))
         
-        while current.replacement_template_id and current.replacement_template_id.id not in visited:
-            current = current.replacement_template_id
-            chain.append(current)
-            visited.add(current.id)
-            if len(visited) > 100:
-                break
+        if key_field == 'id':
+            template_by_key = {key: key for key in keys}
+        else:
+            # Codes and barcodes are stored on the variants; the newest variant wins
+            variants = self.env['product.product'].with_context(active_test=False).search_read(
+                [(key_field, 'in', list(keys))], [key_field, 'product_tmpl_id'], order='id'
+            )
+            template_by_key = {variant[key_field]: variant['product_tmpl_id'][0] for variant in variants}
         
-        return chain
+        heads = self._get_chain_heads(set(template_by_key.values()))
+        return {key: heads.get(template_by_key.get(key), False) for key in keys}
+    
+    @api.model
+    def _get_chain_heads(self, template_ids):
+        """
+        Current replacement of each template id, as {template id: head id}.
+        Heads missing from the cache are read with one query. Entries are
+        keyed on the user and companies, whose record rules filter the read.
+        Nothing is cached while the transaction holds uncommitted link
+        changes, which other workers cannot see yet.
+        """
+        cache = self._get_replacement_cache()
+        generation = self._get_replacement_generation()
+        if cache['generation'] != generation:
+            cache.update(generation=generation, heads=LRU(RESOLVE_CACHE_SIZE))
+        heads_cache = cache['heads']
+        if self.env.cr.postcommit.data.get(RESOLVE_GENERATION_SEQUENCE):
+            heads_cache = {}
+        
+        scope = (self.env.uid, self.env.su, tuple(self.env.companies.ids))
+        heads = {}
+        missing = []
+        for template_id in template_ids:
+            head = heads_cache.get((scope, template_id))
+            if head:
+                heads[template_id] = head
+            else:
+                missing.append(template_id)
+        
+        if missing:
+            templates = self.with_context(active_test=False).search_read(
+                [('id', 'in', missing)], ['chain_head_id']
+            )
+            for template in templates:
+                head = template['chain_head_id'][0] if template['chain_head_id'] else template['id']
+                heads[template['id']] = heads_cache[(scope, template['id'])] = head
+        return heads
+    
+    @api.model
+    @tools.ormcache()
+    def _get_replacement_cache(self):
+        """
+        Chain heads resolved by this worker, in a bounded LRU, with the
+        generation they were read at
+        """
+        return {'generation': None, 'heads': LRU(RESOLVE_CACHE_SIZE)}
+    
+    @api.model
+    def _get_replacement_generation(self):
+        """Current value of the generation sequence"""
+        self.env.cr.execute(f'SELECT last_value FROM "{RESOLVE_GENERATION_SEQUENCE}"')
+        return self.env.cr.fetchone()[0]
+    
+    @api.model
+    def _invalidate_replacement_cache(self):
+        """
+        Drop the chain heads cached by this worker now, and by every worker
+        once the transaction is committed, by moving the generation forward.
+        Only the resolutions are dropped, the other registry caches are kept.
+        """
+        self._get_replacement_cache()['generation'] = None
+        data = self.env.cr.postcommit.data
+        if not data.get(RESOLVE_GENERATION_SEQUENCE):
+            data[RESOLVE_GENERATION_SEQUENCE] = True
+            self.env.cr.postcommit.add(self._bump_replacement_generation)
+    
+    @api.model
+    def _bump_replacement_generation(self):
+        """Move the generation forward; sequences are not transactional, a short cursor is enough"""
+        with self.pool.cursor() as cr:
+            cr.execute(f"SELECT nextval('{RESOLVE_GENERATION_SEQUENCE}')")
+    
+    @api.model
+    def _clear_replacement_cache(self, vals):
+        """Drop cached resolutions when a replacement link is written"""
+        if RESOLVE_CACHE_FIELDS.intersection(vals):
+            self._invalidate_replacement_cache()
+    
+    @api.model_create_multi
+    def create(self, vals_list):
+        templates = super().create(vals_list)
+        for vals in vals_list:
+            self._clear_replacement_cache(vals)
+        return templates
+    
+    def write(self, vals):
+        res = super().write(vals)
+        self._clear_replacement_cache(vals)
+        return res
     
     def action_view_replacement(self):
         """Open the replacement product"""
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+from . import product_archive_replace_report
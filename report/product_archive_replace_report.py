@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from odoo import models, api
+from odoo.tools.pdf import merge_pdf
+import logging
+
+_logger = logging.getLogger(__name__)
+
+AUDIT_REPORT_NAME = 'ics_product_archive_replace.report_product_archive_replace'
+
+
+class ReportProductArchiveReplace(models.AbstractModel):
+    _name = f'report.{AUDIT_REPORT_NAME}'
+    _description = 'Product Archive & Replace Audit Report'
+
+    @api.model
+    def _get_report_values(self, docids, data=None):
+        """
+        Render the result lines of one slice of the run only.
+        ``data`` carries the slice (line_offset, line_limit) and whether it
+        is the first or the last part of a report rendered in parts.
+        """
+        data = data or {}
+        docs = self.env['product.archive.replace.wizard'].browse(docids)
+        offset = data.get('line_offset', 0)
+        limit = data.get('line_limit')
+        return {
+            'doc_ids': docids,
+            'doc_model': 'product.archive.replace.wizard',
+            'docs': docs,
+            'report_lines': {doc.id: doc._get_report_lines(offset=offset, limit=limit) for doc in docs},
+            'line_offset': offset,
+            'is_first_part': data.get('is_first_part', True),
+            'is_last_part': data.get('is_last_part', True),
+        }
+
+
+class IrActionsReport(models.Model):
+    _inherit = 'ir.actions.report'
+
+    @api.model
+    def _get_audit_report_part_size(self):
+        """Result lines rendered per PDF part of the audit report"""
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'ics_product_archive_replace.report_part_size', 500))
+
+    def _render_qweb_pdf(self, report_ref, res_ids=None, data=None):
+        """
+        Render the audit report of a large run in page-sized parts merged
+        into a single PDF, so wkhtmltopdf never gets the whole run at once.
+        """
+        report = self._get_report(report_ref)
+        if report.report_name != AUDIT_REPORT_NAME or not res_ids or (data or {}).get('line_limit'):
+            return super()._render_qweb_pdf(report_ref, res_ids=res_ids, data=data)
+        
+        wizards = self.env['product.archive.replace.wizard'].browse(res_ids)
+        part_size = self._get_audit_report_part_size()
+        if len(wizards) != 1 or part_size <= 0:
+            return super()._render_qweb_pdf(report_ref, res_ids=res_ids, data=data)
+        
+        line_count = self.env['product.archive.replace.run.line'].search_count(
+            wizards._get_report_line_domain())
+        if line_count <= part_size:
+            return super()._render_qweb_pdf(report_ref, res_ids=res_ids, data=data)
+        
+        parts = []
+        for offset in range(0, line_count, part_size):
+            part_data = dict(
+                data or {},
+                line_offset=offset,
+                line_limit=part_size,
+                is_first_part=offset == 0,
+                is_last_part=offset + part_size >= line_count,
+            )
+            pdf_content, _content_type = super()._render_qweb_pdf(report_ref, res_ids=res_ids, data=part_data)
+            parts.append(pdf_content)
+            # The rendered lines are not needed for the next part
+            self.env.invalidate_all()
+        
+        _logger.info(f"Rendered audit report of {line_count} lines in {len(parts)} parts")
+        return merge_pdf(parts), 'pdf'
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+from odoo.tests.common import TransactionCase
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+MODULE_NAME = 'ics_product_archive_replace'
+
+
+class MemoryPassRollback(Exception):
+    """Raised to roll back the savepoint of a memory measurement pass"""
+
+
+def _env_int(name, default):
+    """Read a benchmark size from the environment"""
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class ArchiveReplaceBenchmarkCase(TransactionCase):
+    """
+    Base class of the archive & replace benchmarks.
+    Generates a synthetic catalog and measures wall time, query count and
+    peak memory of the measured phases.
+
+    Catalog size is read from the environment:
+    ARCHIVE_REPLACE_BENCH_TEMPLATES (N templates), ARCHIVE_REPLACE_BENCH_VARIANTS
+    (M variants per template) and ARCHIVE_REPLACE_BENCH_REFERENCES (K sale lines,
+    purchase lines, BOMs, pricelist items, vendors and quants per template).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.bench_config = {
+            'templates': _env_int('ARCHIVE_REPLACE_BENCH_TEMPLATES', 200),
+            'variants': max(_env_int('ARCHIVE_REPLACE_BENCH_VARIANTS', 1), 1),
+            'references': _env_int('ARCHIVE_REPLACE_BENCH_REFERENCES', 2),
+        }
+        cls.bench_results = {}
+        started = time.perf_counter()
+        cls.templates = cls._generate_catalog(**cls.bench_config)
+        _logger.info(f"Generated synthetic catalog {cls.bench_config} "
+                     f"in {time.perf_counter() - started:.1f}s")
+
+    # ========== SYNTHETIC CATALOG ==========
+
+    @classmethod
+    def _generate_catalog(cls, templates, variants, references):
+        """Create ``templates`` storable templates of ``variants`` variants with ``references`` of each kind"""
+        env = cls.env
+        category = env['product.category'].create({'name': 'Archive & Replace Benchmark'})
+        vals_list = [{
+            'name': f'Benchmark Product {index:06d}',
+            'default_code': f'BENCH-{index:06d}',
+            'detailed_type': 'product',
+            'categ_id': category.id,
+        } for index in range(templates)]
+
+        if variants > 1:
+            attribute = env['product.attribute'].create({
+                'name': 'Benchmark Variant',
+                'create_variant': 'always',
+                'value_ids': [(0, 0, {'name': f'V{index}'}) for index in range(variants)],
+            })
+            for vals in vals_list:
+                vals['attribute_line_ids'] = [(0, 0, {
+                    'attribute_id': attribute.id,
+                    'value_ids': [(6, 0, attribute.value_ids.ids)],
+                })]
+
+        products = env['product.template'].create(vals_list)
+        if references:
+            cls._generate_references(products, references)
+        env.flush_all()
+        env.invalidate_all()
+        return products
+
+    @classmethod
+    def _generate_references(cls, products, references):
+        """Create ``references`` records of every referencing model per template"""
+        env = cls.env
+        partner = env['res.partner'].create({'name': 'Benchmark Partner'})
+        pricelist = env['product.pricelist'].create({'name': 'Benchmark Pricelist'})
+        location = env.ref('stock.stock_location_stock')
+        variants = products.product_variant_ids
+
+        def lines(count):
+            return [variant for variant in variants for _index in range(count)]
+
+        # One order per 100 lines keeps the orders realistic
+        sale_lines = lines(references)
+        env['sale.order'].create([{
+            'partner_id': partner.id,
+            'order_line': [(0, 0, {'product_id': variant.id, 'product_uom_qty': 1.0})
+                           for variant in sale_lines[start:start + 100]],
+        } for start in range(0, len(sale_lines), 100)])
+
+        env['purchase.order'].create([{
+            'partner_id': partner.id,
+            'order_line': [(0, 0, {'product_id': variant.id, 'product_qty': 1.0, 'price_unit': 1.0})
+                           for variant in sale_lines[start:start + 100]],
+        } for start in range(0, len(sale_lines), 100)])
+
+        env['product.pricelist.item'].create([{
+            'pricelist_id': pricelist.id,
+            'applied_on': '1_product',
+            'product_tmpl_id': product.id,
+            'min_quantity': index,
+            'fixed_price': 1.0,
+        } for product in products for index in range(references)])
+
+        env['product.supplierinfo'].create([{
+            'partner_id': partner.id,
+            'product_tmpl_id': product.id,
+            'min_qty': index,
+            'price': 1.0,
+        } for product in products for index in range(references)])
+
+        if 'mrp.bom' in env:
+            component = env['product.product'].create({'name': 'Benchmark Component', 'type': 'consu'})
+            env['mrp.bom'].create([{
+                'product_tmpl_id': product.id,
+                'code': f'BENCH-{index}',
+                'bom_line_ids': [(0, 0, {'product_id': component.id, 'product_qty': 1.0})],
+            } for product in products for index in range(references)])
+
+        Quant = env['stock.quant'].sudo()
+        for variant in variants:
+            for _index in range(references):
+                Quant._update_available_quantity(variant, location, 1.0)
+
+    # ========== MEASUREMENT ==========
+
+    def _make_wizard(self, **vals):
+        """Wizard targeting the whole synthetic catalog"""
+        return self.env['product.archive.replace.wizard'].create(dict({
+            'selection_mode': 'single',
+            'product_ids': [(6, 0, self.templates.ids)],
+            'new_type': 'consu',
+        }, **vals))
+
+    def _reset_caches(self):
+        """Start a phase from cold ORM caches, the resolved targets of the wizards included"""
+        self.env.flush_all()
+        self.env.invalidate_all()
+
+    def _measure_memory(self, func):
+        """
+        Peak Python memory of ``func``, in a pass rolled back to a savepoint.
+        Tracing slows Python down, so it is kept out of the timed pass.
+        """
+        self._reset_caches()
+        self.env.cr.precommit.run()
+        peak_memory = 0
+        tracemalloc.start()
+        try:
+            with self.env.cr.savepoint():
+                func()
+                self.env.flush_all()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                raise MemoryPassRollback()
+        except MemoryPassRollback:
+            pass
+        finally:
+            tracemalloc.stop()
+            self.env.cr.precommit.clear()
+            self.env.cr.postcommit.clear()
+            self.env.invalidate_all()
+            self.env['product.template']._invalidate_replacement_cache()
+        return peak_memory
+
+    def _measure(self, phase, func, product_count=None):
+        """
+        Run ``func`` and record its wall time, query count and peak Python memory.
+        Memory is measured in a separate pass that is rolled back, then
+        ``func`` is timed untraced. Figures are also normalized per 1000 products.
+        """
+        product_count = product_count or len(self.templates)
+        peak_memory = self._measure_memory(func)
+        self._reset_caches()
+        cr = self.env.cr
+
+        queries_before = cr.sql_log_count
+        started = time.perf_counter()
+        result = func()
+        self.env.flush_all()
+        wall_time = time.perf_counter() - started
+        queries = cr.sql_log_count - queries_before
+
+        ratio = 1000.0 / product_count if product_count else 0.0
+        self.bench_results[phase] = {
+            'products': product_count,
+            'wall_time': round(wall_time, 4),
+            'queries': queries,
+            'peak_memory_kb': round(peak_memory / 1024.0, 1),
+            'wall_time_per_1k': round(wall_time * ratio, 4),
+            'queries_per_1k': round(queries * ratio, 1),
+            'peak_memory_kb_per_1k': round(peak_memory / 1024.0 * ratio, 1),
+        }
+        _logger.info(f"Benchmark {phase}: {self.bench_results[phase]}")
+        return result
+
+    # ========== BASELINE ==========
+
+    @classmethod
+    def _get_module_version(cls):
+        module = cls.env['ir.module.module'].search([('name', '=', MODULE_NAME)], limit=1)
+        return module.latest_version or module.installed_version or 'unknown'
+
+    @classmethod
+    def _write_baseline(cls):
+        """
+        Store the results as JSON, one file per module version, in the
+        benchmarks directory of the Odoo data directory.
+        ARCHIVE_REPLACE_BENCH_OUTPUT overrides the target directory and
+        ARCHIVE_REPLACE_BENCH_BASELINE points at a previous file to compare with.
+        """
+        version = cls._get_module_version()
+        report = {
+            'module': MODULE_NAME,
+            'version': version,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': cls.bench_config,
+            'phases': cls.bench_results,
+        }
+
+        directory = os.environ.get('ARCHIVE_REPLACE_BENCH_OUTPUT') or \
+            os.path.join(config['data_dir'], 'benchmarks', MODULE_NAME)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'benchmark_{version}.json')
+            with open(path, 'w') as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+            _logger.info(f"Benchmark results written to {path}")
+        except OSError as e:
+            _logger.warning(f"Could not write benchmark results: {e}")
+
+        baseline_path = os.environ.get('ARCHIVE_REPLACE_BENCH_BASELINE')
+        if baseline_path:
+            cls._compare_baseline(report, baseline_path)
+
+    @classmethod
+    def _compare_baseline(cls, report, baseline_path):
+        """Log the per-1k deltas against a previous benchmark file"""
+        try:
+            with open(baseline_path) as baseline_file:
+                baseline = json.load(baseline_file)
+        except (OSError, ValueError) as e:
+            _logger.warning(f"Could not read benchmark baseline {baseline_path}: {e}")
+            return
+
+        for phase, figures in report['phases'].items():
+            previous = baseline.get('phases', {}).get(phase)
+            if not previous:
+                continue
+            for key in ('wall_time_per_1k', 'queries_per_1k', 'peak_memory_kb_per_1k'):
+                before, after = previous.get(key) or 0, figures[key]
+                delta = (after - before) / before * 100.0 if before else 0.0
+                log = _logger.warning if delta > 10.0 else _logger.info
+                log(f"Benchmark {phase} {key}: {before} -> {after} ({delta:+.1f}% "
+                    f"vs {baseline.get('version')})")
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.bench_results:
+            cls._write_baseline()
+        super().tearDownClass()
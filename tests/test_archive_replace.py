@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+import csv
+import os
+import tempfile
+
+from odoo.tests import tagged
+from odoo.tests.common import TransactionCase
+
+from ..models.product_archive_replace_run import EXPORT_COLUMNS
+
+
+@tagged('post_install', '-at_install')
+class TestArchiveReplace(TransactionCase):
+    """Replacement runs, from the wizard and the background workers, and their revert"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stock_location = cls.env.ref('stock.stock_location_stock')
+        cls.partner = cls.env['res.partner'].create({'name': 'Archive & Replace Customer'})
+        cls.attribute = cls.env['product.attribute'].create({
+            'name': 'Archive & Replace Size',
+            'create_variant': 'always',
+            'value_ids': [(0, 0, {'name': 'S'}), (0, 0, {'name': 'M'}), (0, 0, {'name': 'L'})],
+        })
+        cls.template = cls.env['product.template'].create({
+            'name': 'Archive & Replace Shirt',
+            'detailed_type': 'product',
+            'attribute_line_ids': [(0, 0, {
+                'attribute_id': cls.attribute.id,
+                'value_ids': [(6, 0, cls.attribute.value_ids.ids)],
+            })],
+        })
+        cls.variants = cls.template.product_variant_ids
+        for variant in cls.variants:
+            size = cls._get_size(variant)
+            variant.write({'default_code': f'AR-SHIRT-{size}', 'barcode': f'AR-SHIRT-BARCODE-{size}'})
+        cls.sale_order = cls.env['sale.order'].create({
+            'partner_id': cls.partner.id,
+            'order_line': [(0, 0, {'product_id': variant.id, 'product_uom_qty': 1.0}) for variant in cls.variants],
+        })
+
+    @classmethod
+    def _get_size(cls, variant):
+        return variant.product_template_attribute_value_ids.product_attribute_value_id.name
+
+    def _make_wizard(self, **vals):
+        return self.env['product.archive.replace.wizard'].create(dict({
+            'selection_mode': 'single',
+            'product_ids': [(6, 0, self.template.ids)],
+            'new_type': 'consu',
+        }, **vals))
+
+    def _make_template(self, name):
+        return self.env['product.template'].create({'name': name, 'detailed_type': 'product'})
+
+    def _run_workers(self):
+        """Process the queued runs like the scheduled actions, in the test transaction"""
+        self.patch(self.env.cr, 'commit', lambda: None)
+        self.env['product.archive.replace.run']._cron_process_runs()
+
+    def _get_quantity(self, variant):
+        return sum(self.env['stock.quant'].search([
+            ('product_id', '=', variant.id),
+            ('location_id', '=', self.stock_location.id),
+        ]).mapped('quantity'))
+
+    # ========== VARIANT MAPPING ==========
+
+    def test_01_variant_map(self):
+        """Each old variant maps to the new variant with the same attribute values"""
+        new_template = self.template.copy({'name': 'Archive & Replace Shirt (new)'})
+        variant_map = self.template._get_variant_map(new_template)
+
+        self.assertEqual(set(variant_map), set(self.variants.ids))
+        self.assertEqual(len({variant.id for variant in variant_map.values()}), len(self.variants))
+        for variant in self.variants:
+            self.assertEqual(variant_map[variant.id].product_tmpl_id, new_template)
+            self.assertEqual(self._get_size(variant_map[variant.id]), self._get_size(variant))
+
+    def test_02_replace_multi_variant(self):
+        """Order lines and codes follow their variant to the replacement"""
+        codes = {self._get_size(variant): (variant.default_code, variant.barcode) for variant in self.variants}
+        wizard = self._make_wizard()
+        wizard.action_replace()
+
+        self.assertEqual(wizard.success_count, 1)
+        new_template = self.template.with_context(active_test=False).replacement_template_id
+        self.assertTrue(new_template)
+        self.assertFalse(self.template.active)
+        self.assertEqual(new_template.type, 'consu')
+
+        for line in self.sale_order.order_line:
+            self.assertEqual(line.product_id.product_tmpl_id, new_template)
+        self.assertEqual(
+            sorted(self._get_size(line.product_id) for line in self.sale_order.order_line),
+            sorted(codes),
+        )
+        for variant in new_template.product_variant_ids:
+            self.assertEqual((variant.default_code, variant.barcode), codes[self._get_size(variant)])
+        for variant in self.variants.with_context(active_test=False):
+            self.assertFalse(variant.default_code)
+            self.assertFalse(variant.barcode)
+
+    # ========== REVERT ==========
+
+    def test_03_revert(self):
+        """A reverted run brings references, codes and active flags back"""
+        lines = {line.id: line.product_id for line in self.sale_order.order_line}
+        codes = {variant.id: (variant.default_code, variant.barcode) for variant in self.variants}
+        wizard = self._make_wizard()
+        wizard.action_replace()
+        run = wizard.run_id
+        new_template = self.template.with_context(active_test=False).replacement_template_id
+
+        # Changed by a user after the run: the revert leaves it alone
+        other_product = self.env['product.product'].create({'name': 'Archive & Replace Other'})
+        changed_line = self.sale_order.order_line[0]
+        changed_line.product_id = other_product
+
+        run.action_revert()
+
+        self.assertEqual(run.state, 'reverted')
+        self.assertTrue(self.template.active)
+        self.assertTrue(all(self.variants.mapped('active')))
+        self.assertFalse(self.template.replacement_template_id)
+        self.assertFalse(new_template.active)
+        self.assertFalse(new_template.replaced_template_id)
+        for line in self.sale_order.order_line - changed_line:
+            self.assertEqual(line.product_id, lines[line.id])
+        self.assertEqual(changed_line.product_id, other_product)
+        for variant in self.variants:
+            self.assertEqual((variant.default_code, variant.barcode), codes[variant.id])
+        self.assertEqual(sum(run.journal_ids.mapped('skipped_count')), 1)
+
+    def test_04_clear_and_revert_stock(self):
+        """Stock of the archived storable variants is cleared, and put back by the revert"""
+        variant = self.variants[0]
+        self.env['stock.quant']._update_available_quantity(variant, self.stock_location, 5.0)
+        wizard = self._make_wizard()
+        wizard.action_replace()
+        run = wizard.run_id
+
+        self.assertEqual(self._get_quantity(variant), 0.0)
+        self.assertEqual(run.line_ids.stock_transferred, 5.0)
+
+        # Returned after the run: kept by the revert
+        self.env['stock.quant']._update_available_quantity(variant, self.stock_location, 2.0)
+
+        run.action_revert()
+
+        self.assertEqual(self._get_quantity(variant), 7.0)
+
+    # ========== DRY RUN ==========
+
+    def test_05_dry_run(self):
+        """The dry run rolls the sample back and extrapolates to the whole selection"""
+        other_template = self._make_template('Archive & Replace Cap')
+        lines = {line.id: line.product_id for line in self.sale_order.order_line}
+        run_count = self.env['product.archive.replace.run'].search_count([])
+        wizard = self._make_wizard(
+            product_ids=[(6, 0, (self.template | other_template).ids)],
+            dry_run_sample_size=1,
+        )
+        wizard.action_dry_run()
+
+        self.assertIn('Simulated 1 of 2 products', wizard.dry_run_summary)
+        self.assertIn('Would succeed: 1', wizard.dry_run_summary)
+        for template in self.template | other_template:
+            self.assertTrue(template.active)
+            self.assertFalse(template.replacement_template_id)
+        for line in self.sale_order.order_line:
+            self.assertEqual(line.product_id, lines[line.id])
+        self.assertEqual(self.env['product.archive.replace.run'].search_count([]), run_count)
+        self.assertEqual(wizard.product_count, 2)
+
+    # ========== EXPORTS ==========
+
+    def test_06_export_csv(self):
+        """The CSV export holds the run summary and every result line, read in batches"""
+        self.env['ir.config_parameter'].sudo().set_param('ics_product_archive_replace.export_batch_size', 1)
+        other_template = self._make_template('Archive & Replace Cap')
+        wizard = self._make_wizard(product_ids=[(6, 0, (self.template | other_template).ids)])
+        wizard.action_replace()
+        run = wizard.run_id
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.csv')
+            run._export_results('csv', path)
+            with open(path, newline='', encoding='utf-8') as export:
+                rows = list(csv.reader(export))
+
+        header_index = rows.index([header for _column, header in EXPORT_COLUMNS])
+        self.assertIn(['Successful Replacements', '2'], rows[:header_index])
+        results = rows[header_index + 1:]
+        self.assertEqual(sorted(row[2] for row in results), sorted([self.template.name, other_template.name]))
+        self.assertEqual({row[9] for row in results}, {'success'})
+        self.assertEqual([int(row[0]) for row in results], sorted(run.line_ids.ids))
+
+    # ========== BACKGROUND RUNS ==========
+
+    def test_07_resume_from_checkpoint(self):
+        """A product failing after its copy resumes from its checkpoint with the same replacement"""
+        Reference = self.env.registry['product.archive.replace.reference']
+        migrate_references = Reference._migrate_references
+        template_id = self.template.id
+
+        def fail_references(self, template_map, variant_map, skip_locked=False):
+            counts, locked, _failed = migrate_references(self, template_map, variant_map, skip_locked)
+            return counts, locked, {('product.template', template_id): 'Reference update failed'}
+
+        self.patch(Reference, '_migrate_references', fail_references)
+        wizard = self._make_wizard(execution_mode='background', chunk_size=1)
+        run = self.env['product.archive.replace.run'].browse(wizard.action_replace()['res_id'])
+        self._run_workers()
+
+        failed_line = run.line_ids
+        self.assertEqual(failed_line.status, 'failed')
+        self.assertEqual(failed_line.checkpoint, 'stock')
+        self.assertEqual(failed_line.sales_migrated, 3)
+        self.assertTrue(self.template.active)
+        new_template = self.template.replacement_template_id
+        self.assertTrue(new_template)
+
+        self.patch(Reference, '_migrate_references', migrate_references)
+        run.action_retry_failed()
+        self._run_workers()
+
+        self.assertEqual(run.state, 'done')
+        self.assertEqual(failed_line.status, 'retried')
+        resumed_line = run.line_ids - failed_line
+        self.assertEqual(resumed_line.status, 'success')
+        self.assertEqual(resumed_line.checkpoint, 'chatter')
+        self.assertEqual(resumed_line.new_product_id, new_template)
+        self.assertEqual(resumed_line.sales_migrated, 0)
+        self.assertFalse(self.template.active)
+        self.assertEqual(self.template.with_context(active_test=False).replacement_template_id, new_template)
+        self.assertEqual(self.env['product.template'].search_count([('replaced_template_id', '=', self.template.id)]), 1)
+        self.assertEqual(self.sale_order.order_line.product_id.product_tmpl_id, new_template)
+
+    def test_08_deferred_locked_rows(self):
+        """Rows locked by other users are deferred by skip-locked runs and written by the workers"""
+        variant = self.variants[0]
+        packaging = self.env['product.packaging'].create({
+            'name': 'Archive & Replace Box', 'product_id': variant.id, 'qty': 10.0,
+        })
+        Reference = self.env.registry['product.archive.replace.reference']
+        update_reference = Reference._update_reference
+
+        def update_locked(self, reference, mapping, skip_locked=False, where=None):
+            # Rows created by the test are invisible to other transactions, which cannot lock them
+            if reference[0] == 'product.packaging' and skip_locked:
+                return {}, packaging.ids
+            return update_reference(self, reference, mapping, skip_locked, where)
+
+        self.patch(Reference, '_update_reference', update_locked)
+        wizard = self._make_wizard(lock_mode='skip_locked')
+        run = self.env['product.archive.replace.run'].browse(wizard.action_replace()['res_id'])
+        self._run_workers()
+
+        new_template = self.template.with_context(active_test=False).replacement_template_id
+        new_variant = new_template.product_variant_ids.filtered(
+            lambda new_variant: self._get_size(new_variant) == self._get_size(variant))
+        deferred = run.deferred_ids
+        self.assertEqual(run.state, 'running')
+        self.assertEqual(deferred.mapped('state'), ['pending'])
+        self.assertEqual((deferred.res_model, deferred.res_id), ('product.packaging', packaging.id))
+        self.assertEqual(packaging.product_id, variant)
+
+        # Due for a retry, now that the row is free
+        deferred.date_next_retry = '2000-01-01 00:00:00'
+        self._run_workers()
+
+        self.assertEqual(deferred.state, 'done')
+        self.assertEqual(packaging.product_id, new_variant)
+        self.assertEqual(run.state, 'done')
+
+    # ========== REFERENCE REGISTRY ==========
+
+    def test_09_reference_registry(self):
+        """Other references follow their variant, stock history stays, failing updates only fail their product"""
+        other_template = self._make_template('Archive & Replace Cap')
+        other_variant = other_template.product_variant_id
+        self.env['stock.quant']._update_available_quantity(self.variants[0], self.stock_location, 5.0)
+        packaging = self.env['product.packaging'].create({
+            'name': 'Archive & Replace Box', 'product_id': self.variants[1].id, 'qty': 10.0,
+        })
+        done_scrap = self.env['stock.scrap'].create({'product_id': self.variants[0].id, 'scrap_qty': 1.0})
+        done_scrap.do_scrap()
+        draft_scrap = self.env['stock.scrap'].create({'product_id': self.variants[2].id, 'scrap_qty': 1.0})
+        other_scrap = self.env['stock.scrap'].create({'product_id': other_variant.id, 'scrap_qty': 1.0})
+
+        Reference = self.env.registry['product.archive.replace.reference']
+        update_open_scraps = Reference._update_open_scraps
+
+        def fail_other_scraps(self, reference, mapping, skip_locked=False):
+            if other_variant.id in mapping:
+                self.env.cr.execute('SELECT 1 / 0')
+            return update_open_scraps(self, reference, mapping, skip_locked)
+
+        self.patch(Reference, '_update_open_scraps', fail_other_scraps)
+        wizard = self._make_wizard(product_ids=[(6, 0, (self.template | other_template).ids)])
+        wizard.action_replace()
+        lines = wizard.run_id.line_ids
+
+        new_template = self.template.with_context(active_test=False).replacement_template_id
+        new_variants = {self._get_size(variant): variant for variant in new_template.product_variant_ids}
+        self.assertEqual(packaging.product_id, new_variants[self._get_size(self.variants[1])])
+        self.assertEqual(draft_scrap.product_id, new_variants[self._get_size(self.variants[2])])
+        self.assertEqual(done_scrap.product_id, self.variants[0])
+        line = lines.filtered(lambda line: line.old_product_id == self.template)
+        self.assertEqual(line.status, 'success')
+        self.assertGreaterEqual(line.references_migrated, 2)
+        self.assertFalse(self.template.active)
+
+        other_line = lines.filtered(lambda line: line.old_product_id == other_template)
+        self.assertEqual(other_line.status, 'failed')
+        self.assertEqual(other_line.checkpoint, 'stock')
+        self.assertIn('stock.scrap.product_id', other_line.error_message)
+        self.assertTrue(other_template.active)
+        self.assertEqual(other_scrap.product_id, other_variant)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import tagged
+
+from .common import ArchiveReplaceBenchmarkCase
+
+
+@tagged('-standard', 'archive_replace_benchmark', 'post_install', '-at_install')
+class TestArchiveReplaceBenchmark(ArchiveReplaceBenchmarkCase):
+    """
+    Scaling benchmarks of the archive & replace wizard.
+    Excluded from standard runs, run them with:
+    odoo-bin -d <db> -i ics_product_archive_replace --test-tags archive_replace_benchmark
+    """
+
+    def test_01_preview(self):
+        """First preview page, default sort"""
+        wizard = self._make_wizard(show_preview=True)
+        lines = self._measure('preview', lambda: wizard.preview_line_ids.mapped('product_id'))
+        self.assertEqual(len(lines), min(len(self.templates), wizard.preview_page_size))
+
+    def test_02_preview_sorted_by_counts(self):
+        """First preview page sorted on counts, which counts every target product"""
+        wizard = self._make_wizard(show_preview=True, preview_sort='sale_count')
+        self._measure('preview_sorted', lambda: wizard.preview_line_ids.mapped('product_id'))
+        self.assertEqual(wizard.preview_total, len(self.templates))
+
+    def test_03_total_counts(self):
+        """Reference totals of the whole selection"""
+        wizard = self._make_wizard()
+        total = self._measure('totals', lambda: wizard.total_sale_count)
+        self.assertEqual(
+            total, len(self.templates) * self.bench_config['variants'] * self.bench_config['references']
+        )
+
+    def test_04_execution(self):
+        """Synchronous archive & replace of the whole selection"""
+        wizard = self._make_wizard(execution_mode='sync')
+        self._measure('execution', wizard.action_replace)
+        self.assertEqual(wizard.success_count, len(self.templates))
+        self.assertFalse(any(self.templates.with_context(active_test=False).mapped('active')))
@@ -1,10 +1,38 @@
 # -*- coding: utf-8 -*-
+import json
+import time
+from collections import defaultdict
+from datetime import timedelta
+
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError
+from odoo.tools import html_escape
 import logging
 
+from ..models.product_archive_replace_profiler import NULL_PROFILE, PROFILE_PHASES
+from ..models.product_archive_replace_scanner import PREFLIGHT_CHECKS
+
 _logger = logging.getLogger(__name__)
 
+# Record ids listed per model in the dry run report
+DRY_RUN_LISTED_IDS = 20
+
+
+# Phases of a replacement in execution order, as recorded in the run line checkpoints
+PHASE_SEQUENCE = [phase for phase, _label in PROFILE_PHASES]
+
+# Parent documents of the rewritten lines, as (parent model, line model, parent field).
+# Parallel workers lock them table after table in this order.
+PARENT_LOCKS = [
+    ('sale.order', 'sale.order.line', 'order_id'),
+    ('purchase.order', 'purchase.order.line', 'order_id'),
+    ('mrp.bom', 'mrp.bom.line', 'bom_id'),
+]
+
+
+class DryRunRollback(Exception):
+    """Raised to roll back the savepoint of a dry run"""
+
 
 class ProductArchiveReplaceWizard(models.TransientModel):
     _name = 'product.archive.replace.wizard'
@@ -50,14 +78,85 @@ class ProductArchiveReplaceWizard(models.TransientModel):
     migrate_boms = fields.Boolean('Migrate BOMs (if MRP installed)', default=True)
     migrate_pricelists = fields.Boolean('Migrate Pricelists', default=True)
     migrate_vendors = fields.Boolean('Migrate Vendors', default=True)
-    migrate_stock = fields.Boolean('Transfer Stock (On Hand Quantities)', default=True)
+    migrate_stock = fields.Boolean(
+        'Clear Stock (On Hand Quantities)', default=True,
+        help='Only storable products hold stock and the replacement gets another type, so it cannot take '
+             'the quantities over: the on-hand stock of the archived storable products is brought to zero '
+             'with an inventory adjustment instead of staying on archived products.'
+    )
+    migrate_references = fields.Boolean(
+        'Migrate Other References', default=True,
+        help='Also migrate every other record pointing at the product (reordering rules, packagings, '
+             'open stock moves and manufacturing orders, draft invoice lines, custom models...), '
+             'with one update per field. Done stock moves and posted entries stay on the archived product.'
+    )
+    stock_transfer_moves = fields.Boolean(
+        'Record Stock Moves', default=False,
+        help='Clear the stock through inventory adjustment moves instead of updating quants '
+             'directly, so it appears in the stock moves history.'
+    )
     
     continue_on_error = fields.Boolean('Continue on Migration Errors', default=True)
+    bulk_write = fields.Boolean(
+        'Bulk Reference Rewrite', default=True,
+        help='Rewrite references with one write per group of identical target values. '
+             'Records failing in bulk are retried one by one.'
+    )
+    chatter_mode = fields.Selection([
+        ('immediate', 'Post per Product'),
+        ('batched', 'Batched Messages'),
+        ('run_log', 'Run Log Only'),
+    ], default='immediate', string='Chatter Messages', required=True,
+       help='Post per Product: tracking and notifications as for a manual change. '
+            'Batched Messages: tracking and notifications are disabled during processing and the '
+            'replacement messages are created at once at the end of each batch. '
+            'Run Log Only: no chatter message, the replacements are only recorded on the run.')
+    
+    # ========== EXECUTION MODE ==========
+    execution_mode = fields.Selection([
+        ('sync', 'Immediate'),
+        ('background', 'Background Job'),
+    ], default='sync', string='Execution Mode', required=True,
+       help='Background jobs are processed by a scheduled action in chunks, '
+            'each chunk being committed independently.')
+    chunk_size = fields.Integer('Products per Chunk', default=50)
+    lock_mode = fields.Selection([
+        ('wait', 'Wait for Locks'),
+        ('skip_locked', 'Skip Locked Rows'),
+    ], default='wait', string='Locking', required=True,
+       help='Skip Locked Rows: order lines (and their orders) being edited by users are not '
+            'waited for. They are recorded on the run and retried by the scheduled actions in short '
+            'transactions, so migrations can run during business hours. Always runs as a background job.')
+    worker_count = fields.Integer(
+        'Parallel Workers', default=1,
+        help='Number of scheduled actions processing the chunks concurrently (up to 4). '
+             'Requires enough cron threads (max_cron_threads).'
+    )
+    
+    # ========== DRY RUN ==========
+    dry_run_sample_size = fields.Integer(
+        'Simulation Sample', default=20,
+        help='Number of products processed by the dry run (0 for all). '
+             'Everything is rolled back; the duration of the full run is extrapolated from the sample.'
+    )
+    dry_run_summary = fields.Html('Dry Run Report', readonly=True)
+    
+    # ========== PRE-FLIGHT CHECK ==========
+    preflight_summary = fields.Html('Pre-flight Report', readonly=True)
+    preflight_blocked_count = fields.Integer('Blocked Products', readonly=True)
+    preflight_skip_blocked = fields.Boolean(
+        'Skip Blocked Products', default=False,
+        help='Leave the products with blocking conflicts out of the run instead of stopping it.'
+    )
     
     # ========== CHECK MRP AVAILABILITY ==========
     has_mrp = fields.Boolean('MRP Module Installed', compute='_compute_has_mrp')
     
     # ========== COMPUTED COUNTS ==========
+    target_product_ids = fields.Many2many(
+        'product.template', string='Target Products', compute='_compute_target_product_ids',
+        help='Products matching the selection that have another type than the new one.'
+    )
     product_count = fields.Integer('Products to Process', compute='_compute_product_count')
     total_sale_count = fields.Integer('Total Sales Orders', compute='_compute_total_counts')
     total_purchase_count = fields.Integer('Total Purchase Orders', compute='_compute_total_counts')
@@ -75,6 +174,22 @@ class ProductArchiveReplaceWizard(models.TransientModel):
         store=False
     )
     show_preview = fields.Boolean('Show Products List', default=False)
+    preview_page = fields.Integer('Preview Page', default=1)
+    preview_page_size = fields.Integer('Rows per Page', default=80)
+    preview_sort = fields.Selection([
+        ('name', 'Name'),
+        ('default_code', 'Internal Reference'),
+        ('sale_count', 'Most Sales Lines'),
+        ('purchase_count', 'Most Purchase Lines'),
+        ('stock_qty', 'Most Stock'),
+    ], default='name', string='Sort By', required=True)
+    preview_filter = fields.Selection([
+        ('all', 'All Products'),
+        ('has_stock', 'Has Stock'),
+        ('has_references', 'Has References'),
+    ], default='all', string='Show', required=True)
+    preview_total = fields.Integer('Matching Products', compute='_compute_preview_lines')
+    preview_page_count = fields.Integer('Preview Pages', compute='_compute_preview_lines')
     
     # ========== AUDIT REPORT FIELDS ==========
     migration_date = fields.Datetime('Migration Date', readonly=True)
@@ -83,13 +198,18 @@ class ProductArchiveReplaceWizard(models.TransientModel):
     failed_count = fields.Integer('Failed Replacements', readonly=True)
     
     # ========== RESULTS ==========
+    run_id = fields.Many2one('product.archive.replace.run', string='Migration Run', readonly=True)
     result_line_ids = fields.One2many(
-        'product.archive.replace.result.line',
-        'wizard_id',
+        related='run_id.line_ids',
         string='Migration Results',
         readonly=True
     )
     migration_summary = fields.Html('Migration Summary', readonly=True)
+    report_compact = fields.Boolean(
+        'Compact Report', default=False,
+        help='Only list the failed replacements in the PDF audit report, with the run totals.'
+    )
+    profile_summary = fields.Html(related='run_id.profile_summary', string='Phase Profile')
     show_results = fields.Boolean('Show Results', default=False)
 
     # ========== COMPUTE METHODS ==========
@@ -116,10 +236,10 @@ class ProductArchiveReplaceWizard(models.TransientModel):
         
         return res
 
-    def _get_target_products(self):
-        """Get all products to process based on selection mode"""
+    def _get_target_domain(self):
+        """Domain of the products to process, including the target type filter"""
         if self.selection_mode == 'single':
-            products = self.product_ids
+            domain = [('id', 'in', self.product_ids._origin.ids)]
         else:
             # Category mode
             domain = []
@@ -128,158 +248,149 @@ class ProductArchiveReplaceWizard(models.TransientModel):
                 domain.append(('type', '=', self.current_type_filter))
             
             if self.category_ids:
-                categories = self.category_ids
+                categories = self.category_ids._origin
                 if self.include_subcategories:
                     categories = self.env['product.category'].search([
-                        ('id', 'child_of', self.category_ids.ids)
+                        ('id', 'child_of', categories.ids)
                     ])
                 domain.append(('categ_id', 'in', categories.ids))
             
             domain.append(('active', '=', True))
-            products = self.env['product.template'].search(domain)
         
-        # Filter out products that already have the target type
-        products = products.filtered(lambda p: p.type != self.new_type)
+        # Skip products that already have the target type
+        if self.new_type:
+            domain.append(('type', '!=', self.new_type))
         
-        return products
+        return domain
 
-    @api.depends('selection_mode', 'product_ids', 'category_ids', 'include_subcategories', 
+    @api.depends('selection_mode', 'product_ids', 'category_ids', 'include_subcategories',
                  'filter_by_type', 'current_type_filter', 'new_type')
+    def _compute_target_product_ids(self):
+        """
+        Resolve the products to process with one search per change of the
+        selection inputs; the counts, preview and actions read the result.
+        """
+        for wizard in self:
+            wizard.target_product_ids = self.env['product.template'].search(wizard._get_target_domain())
+
+    def _get_target_product_ids(self):
+        """Ids of the products to process"""
+        return tuple(self.target_product_ids.ids)
+
+    def _get_target_products(self):
+        """Get all products to process based on selection mode"""
+        return self.target_product_ids
+
+    def _invalidate_target_products(self):
+        """Resolve the products again on next access, e.g. once a run changed their type or archived them"""
+        self.invalidate_recordset(['target_product_ids'])
+
+    @api.depends('target_product_ids')
     def _compute_product_count(self):
         """Count products to process"""
         for wizard in self:
-            products = wizard._get_target_products()
-            wizard.product_count = len(products)
+            wizard.product_count = len(wizard._get_target_product_ids())
 
-    @api.depends('selection_mode', 'product_ids', 'category_ids', 'include_subcategories',
-                 'filter_by_type', 'current_type_filter', 'new_type')
+    def _get_preview_page(self):
+        """
+        Return the products of the visible preview page, their counts and
+        the number of products matching the preview filter.
+        Only the visible page is counted unless the filter or the sort
+        needs the counts of every target product.
+        """
+        Product = self.env['product.template']
+        counter = self.env['product.archive.replace.counter']
+        product_ids = self._get_target_product_ids()
+        size = max(self.preview_page_size, 1)
+        offset = (max(self.preview_page, 1) - 1) * size
+        
+        if self.preview_filter == 'all' and self.preview_sort in ('name', 'default_code'):
+            total = len(product_ids)
+            offset = min(offset, max(total - 1, 0) // size * size)
+            page_products = Product.search(
+                [('id', 'in', product_ids)], order=f'{self.preview_sort}, id', offset=offset, limit=size
+            )
+            return page_products, counter._get_counts(page_products), total
+        
+        counts = counter._get_counts(Product.browse(product_ids))
+        rows = list(product_ids)
+        if self.preview_filter == 'has_stock':
+            rows = [pid for pid in rows if counts[pid]['stock_qty'] != 0]
+        elif self.preview_filter == 'has_references':
+            reference_keys = ['sale_count', 'purchase_count', 'bom_count', 'pricelist_count', 'vendor_count']
+            rows = [pid for pid in rows if any(counts[pid][key] for key in reference_keys)]
+        
+        if self.preview_sort in ('name', 'default_code'):
+            rows = Product.search([('id', 'in', rows)], order=f'{self.preview_sort}, id').ids
+        else:
+            rows.sort(key=lambda pid: (-counts[pid][self.preview_sort], pid))
+        
+        total = len(rows)
+        offset = min(offset, max(total - 1, 0) // size * size)
+        return Product.browse(rows[offset:offset + size]), counts, total
+
+    @api.depends('target_product_ids', 'show_preview', 'preview_page', 'preview_page_size', 'preview_sort', 'preview_filter')
     def _compute_preview_lines(self):
-        """Generate preview lines for each product"""
+        """Generate preview lines for the visible page only"""
         for wizard in self:
             wizard.preview_line_ids = [(5, 0, 0)]
+            wizard.preview_total = 0
+            wizard.preview_page_count = 0
             
-            products = wizard._get_target_products()
-            
-            if not products:
+            if not wizard.show_preview or not wizard._get_target_product_ids():
                 continue
             
+            products, counts, total = wizard._get_preview_page()
+            size = max(wizard.preview_page_size, 1)
+            wizard.preview_total = total
+            wizard.preview_page_count = (total + size - 1) // size
+            
             lines = []
-            for product in products:
-                variants = product.product_variant_ids
-                variant_ids = variants.ids
-                
-                sale_count = self.env['sale.order.line'].search_count([
-                    ('product_id', 'in', variant_ids)
-                ]) if variant_ids else 0
-                
-                purchase_count = self.env['purchase.order.line'].search_count([
-                    ('product_id', 'in', variant_ids)
-                ]) if variant_ids else 0
-                
-                bom_count = 0
-                if wizard.has_mrp:
-                    bom_main = self.env['mrp.bom'].search_count([
-                        ('product_tmpl_id', '=', product.id)
-                    ])
-                    bom_lines = self.env['mrp.bom.line'].search_count([
-                        ('product_id', 'in', variant_ids)
-                    ]) if variant_ids else 0
-                    bom_count = bom_main + bom_lines
-                
-                pricelist_count = self.env['product.pricelist.item'].search_count([
-                    '|',
-                    ('product_tmpl_id', '=', product.id),
-                    ('product_id', 'in', variant_ids)
-                ]) if variant_ids else 0
-                
-                vendor_count = self.env['product.supplierinfo'].search_count([
-                    '|',
-                    ('product_tmpl_id', '=', product.id),
-                    ('product_id', 'in', variant_ids)
-                ]) if variant_ids else 0
-                
-                stock_qty = sum(variants.mapped('qty_available'))
-                
+            for sequence, product in enumerate(products):
+                product_counts = counts[product.id]
                 lines.append((0, 0, {
+                    'sequence': sequence,
                     'product_id': product.id,
                     'current_type': product.type,
                     'default_code': product.default_code or '',
                     'barcode': product.barcode or '',
                     'categ_id': product.categ_id.id,
-                    'sale_count': sale_count,
-                    'purchase_count': purchase_count,
-                    'bom_count': bom_count,
-                    'pricelist_count': pricelist_count,
-                    'vendor_count': vendor_count,
-                    'stock_qty': stock_qty,
+                    'sale_count': product_counts['sale_count'],
+                    'purchase_count': product_counts['purchase_count'],
+                    'bom_count': product_counts['bom_count'],
+                    'pricelist_count': product_counts['pricelist_count'],
+                    'vendor_count': product_counts['vendor_count'],
+                    'stock_qty': product_counts['stock_qty'],
                 }))
             
             wizard.preview_line_ids = lines
 
-    @api.depends('selection_mode', 'product_ids', 'category_ids', 'include_subcategories',
-                 'filter_by_type', 'current_type_filter', 'new_type')
+    @api.onchange('preview_sort', 'preview_filter', 'preview_page_size')
+    def _onchange_preview_options(self):
+        """Go back to the first page when the preview ordering changes"""
+        self.preview_page = 1
+
+    @api.depends('target_product_ids')
     def _compute_total_counts(self):
         """Compute total counts for all products"""
+        counter = self.env['product.archive.replace.counter']
         for wizard in self:
+            totals = counter._empty_counts()
             products = wizard._get_target_products()
             
-            if not products:
-                wizard.total_sale_count = 0
-                wizard.total_purchase_count = 0
-                wizard.total_bom_count = 0
-                wizard.total_pricelist_count = 0
-                wizard.total_vendor_count = 0
-                wizard.total_stock_qty = 0
-                continue
+            if products:
+                try:
+                    totals = counter._sum_counts(counter._get_counts(products))
+                except Exception as e:
+                    _logger.error(f"Error computing counts: {e}", exc_info=True)
+                    totals = counter._empty_counts()
             
-            try:
-                all_variants = products.mapped('product_variant_ids')
-                variant_ids = all_variants.ids
-                template_ids = products.ids
-                
-                wizard.total_sale_count = self.env['sale.order.line'].search_count([
-                    ('product_id', 'in', variant_ids)
-                ]) if variant_ids else 0
-                
-                wizard.total_purchase_count = self.env['purchase.order.line'].search_count([
-                    ('product_id', 'in', variant_ids)
-                ]) if variant_ids else 0
-                
-                if wizard.has_mrp:
-                    bom_main = self.env['mrp.bom'].search_count([
-                        ('product_tmpl_id', 'in', template_ids)
-                    ]) if template_ids else 0
-                    
-                    bom_lines = self.env['mrp.bom.line'].search_count([
-                        ('product_id', 'in', variant_ids)
-                    ]) if variant_ids else 0
-                    
-                    wizard.total_bom_count = bom_main + bom_lines
-                else:
-                    wizard.total_bom_count = 0
-                
-                wizard.total_pricelist_count = self.env['product.pricelist.item'].search_count([
-                    '|',
-                    ('product_tmpl_id', 'in', template_ids),
-                    ('product_id', 'in', variant_ids)
-                ]) if (template_ids or variant_ids) else 0
-                
-                wizard.total_vendor_count = self.env['product.supplierinfo'].search_count([
-                    '|',
-                    ('product_tmpl_id', 'in', template_ids),
-                    ('product_id', 'in', variant_ids)
-                ]) if (template_ids or variant_ids) else 0
-                
-                wizard.total_stock_qty = sum(all_variants.mapped('qty_available'))
-                
-            except Exception as e:
-                _logger.error(f"Error computing counts: {e}", exc_info=True)
-                wizard.total_sale_count = 0
-                wizard.total_purchase_count = 0
-                wizard.total_bom_count = 0
-                wizard.total_pricelist_count = 0
-                wizard.total_vendor_count = 0
-                wizard.total_stock_qty = 0
+            wizard.total_sale_count = totals['sale_count']
+            wizard.total_purchase_count = totals['purchase_count']
+            wizard.total_bom_count = totals['bom_count']
+            wizard.total_pricelist_count = totals['pricelist_count']
+            wizard.total_vendor_count = totals['vendor_count']
+            wizard.total_stock_qty = totals['stock_qty']
 
     # ========== ACTIONS ==========
 
@@ -294,6 +405,26 @@ class ProductArchiveReplaceWizard(models.TransientModel):
             'target': 'new',
         }
 
+    def _reopen(self):
+        """Reopen the wizard form"""
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'product.archive.replace.wizard',
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def action_preview_previous_page(self):
+        """Show the previous page of the products list"""
+        self.preview_page = max(self.preview_page - 1, 1)
+        return self._reopen()
+
+    def action_preview_next_page(self):
+        """Show the next page of the products list"""
+        self.preview_page = min(self.preview_page + 1, max(self.preview_page_count, 1))
+        return self._reopen()
+
     def action_replace(self):
         """Main action: Archive old, create new, migrate references"""
         self.ensure_one()
@@ -303,6 +434,18 @@ class ProductArchiveReplaceWizard(models.TransientModel):
         if not products:
             raise UserError(_("No products to process. Check your selection."))
         
+        blocked = self._run_preflight(products)
+        if blocked:
+            if not self.preflight_skip_blocked:
+                return self._reopen()
+            products -= blocked
+            if not products:
+                raise UserError(_("All selected products have blocking conflicts."))
+        
+        # Low-contention mode relies on the short per-chunk transactions of background runs
+        if self.execution_mode == 'background' or self.lock_mode == 'skip_locked':
+            return self._action_enqueue(products)
+        
         self.migration_date = fields.Datetime.now()
         self.migration_user_id = self.env.user
         
@@ -313,127 +456,567 @@ class ProductArchiveReplaceWizard(models.TransientModel):
         _logger.info(f"Executed by: {self.env.user.name}")
         _logger.info("="*80)
         
+        run = self.env['product.archive.replace.run'].create(dict(
+            self._get_run_values(products),
+            state='running',
+            date_start=self.migration_date,
+        ))
+        self.run_id = run
+        
+        results = self._process_products(products, run)
+        self._invalidate_target_products()
+        success_count = results['success_count']
+        failed_count = results['failed_count']
+        run.write({'state': 'done', 'date_end': fields.Datetime.now()})
+        
         summary_lines = []
         summary_lines.append(f"<h3>🔄 Mass Archive & Replace Summary</h3>")
-        summary_lines.append(f"<p><strong>Processed {len(products)} products</strong></p>")
-        summary_lines.append("<hr/>")
+        summary_lines.append(f"<p><strong>Processed {len(products)} products</strong> (run {run.name})</p>")
+        summary_lines.append(f"<ul>")
+        summary_lines.append(f"<li style='color: green;'>✅ Success: {success_count}</li>")
+        if failed_count > 0:
+            summary_lines.append(f"<li style='color: red;'>❌ Failed: {failed_count}</li>")
+        if results['skipped_count'] > 0:
+            summary_lines.append(f"<li>⏭️ Already replaced: {results['skipped_count']}</li>")
+        summary_lines.append(f"</ul>")
         
+        self.migration_summary = ''.join(summary_lines)
+        self.show_results = True
+        self.success_count = success_count
+        self.failed_count = failed_count
+        
+        _logger.info("="*80)
+        _logger.info(f"MASS MIGRATION COMPLETED")
+        _logger.info(f"Success: {success_count}, Failed: {failed_count}")
+        _logger.info("="*80)
+        
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'product.archive.replace.wizard',
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def action_preflight(self):
+        """Check the target products for conflicts without writing anything"""
+        self.ensure_one()
+        
+        products = self._get_target_products()
+        if not products:
+            raise UserError(_("No products to process. Check your selection."))
+        
+        self._run_preflight(products)
+        return self._reopen()
+
+    def _run_preflight(self, products):
+        """
+        Scan ``products`` and store the pre-flight report on the wizard.
+        Returns the products with blocking conflicts.
+        """
+        issues = self.env['product.archive.replace.scanner']._scan(products, migrate_stock=self.migrate_stock)
+        blocked = products.browse(list({issue['template_id'] for issue in issues
+                                        if issue['severity'] == 'blocking'}))
+        self.preflight_blocked_count = len(blocked)
+        self.preflight_summary = self._render_preflight_report(issues, products)
+        return blocked
+
+    def _render_preflight_report(self, issues, products):
+        """HTML summary of a pre-flight scan, grouped by check"""
+        if not issues:
+            return f"<p>✅ No conflict found on the {len(products)} selected products.</p>"
+        
+        by_check = defaultdict(list)
+        for issue in issues:
+            by_check[issue['check']].append(issue)
+        names = {product.id: product.display_name
+                 for product in products.browse(list({issue['template_id'] for issue in issues}))}
+        
+        parts = []
+        for check, label in PREFLIGHT_CHECKS:
+            check_issues = by_check.get(check)
+            if not check_issues:
+                continue
+            icon = '⛔' if check_issues[0]['severity'] == 'blocking' else '⚠️'
+            product_count = len({issue['template_id'] for issue in check_issues})
+            rows = ''.join(f"<li>{html_escape(names[issue['template_id']])}: {html_escape(issue['message'])}</li>"
+                           for issue in check_issues[:20])
+            more = len(check_issues) - 20
+            if more > 0:
+                rows += f"<li>… {more} more</li>"
+            parts.append(f"<p><strong>{icon} {label}: {product_count} products</strong></p><ul>{rows}</ul>")
+        return ''.join(parts)
+
+    def action_dry_run(self):
+        """
+        Simulate the replacement of a sample of the target products.
+        The sample goes through the real processing code inside a savepoint that
+        is always rolled back; only the measured figures are kept.
+        """
+        self.ensure_one()
+        
+        products = self._get_target_products()
+        if not products:
+            raise UserError(_("No products to process. Check your selection."))
+        
+        # Counted before the simulation archives the sample and changes the selection
+        total = len(products)
+        sample_size = self.dry_run_sample_size
+        sample = products[:sample_size] if sample_size > 0 else products
+        
+        # Pending callbacks belong to the real transaction: run them before the
+        # simulation so that whatever the simulation registers can be dropped
+        self.env.flush_all()
+        self.env.cr.precommit.run()
+        
+        report = {}
+        try:
+            with self.env.cr.savepoint():
+                report = self.with_context(archive_replace_profiling=True)._simulate(sample, total)
+                raise DryRunRollback()
+        except DryRunRollback:
+            pass
+        finally:
+            self.env.cr.precommit.clear()
+            self.env.cr.postcommit.clear()
+            self.env.invalidate_all()
+            self.env['product.template']._invalidate_replacement_cache()
+        
+        report['total_products'] = total
+        self.dry_run_summary = self._render_dry_run_report(report)
+        
+        _logger.info(f"Dry run of {len(sample)}/{total} products: "
+                     f"{report['wall_time']:.2f}s measured, "
+                     f"{report['estimated_time']:.0f}s estimated for the full selection")
+        
+        return self._reopen()
+
+    def _simulate(self, products, total):
+        """
+        Process ``products`` for real and collect the figures of the dry run
+        report; the duration is extrapolated to ``total`` products, counted
+        on the selection before the simulation archived the sample.
+        """
+        last_message = self.env['mail.message'].sudo().search([], order='id desc', limit=1)
+        started = time.perf_counter()
+        run = self.env['product.archive.replace.run'].create(dict(
+            self._get_run_values(products),
+            name=_('Dry Run'),
+            state='running',
+        ))
+        results = self._process_products(products, run)
+        self.env.flush_all()
+        wall_time = time.perf_counter() - started
+        
+        phase_stats = run._get_phase_stats()
+        touched = self._get_touched_records(run, last_message.id)
+        per_product = wall_time / len(products) if products else 0.0
+        return {
+            'sample_size': len(products),
+            'success_count': results['success_count'],
+            'failed_count': results['failed_count'],
+            'errors': run.line_ids.filtered(lambda line: line.status == 'failed').mapped(
+                lambda line: f"{line.old_product_name}: {line.error_message}"),
+            'wall_time': wall_time,
+            'per_product': per_product,
+            'estimated_time': per_product * total,
+            'phase_stats': phase_stats,
+            'touched': touched,
+        }
+
+    def _get_touched_records(self, run, last_message_id):
+        """
+        Records written or created by the simulated ``run``, read from its
+        change journal, plus the chatter messages it posted.
+        Returns a dict {model: sorted record ids}.
+        """
+        touched = defaultdict(set)
+        for entry in self.env['product.archive.replace.journal'].search_read(
+                [('run_id', '=', run.id)], ['operation', 'res_model', 'values']):
+            values = json.loads(entry['values'])
+            if entry['operation'] == 'stock':
+                # Quantities are journaled per product and location: the quants holding them were touched
+                record_ids = self.env['stock.quant'].sudo().search([
+                    ('product_id', 'in', [row['product_id'] for row in values]),
+                    ('location_id', 'in', [row['location_id'] for row in values]),
+                ]).ids
+            else:
+                record_ids = values if entry['operation'] == 'create' else values.keys()
+            touched[entry['res_model']].update(int(record_id) for record_id in record_ids)
+        touched['mail.message'].update(self.env['mail.message'].sudo().search(
+            [('id', '>', last_message_id), ('model', '=', 'product.template')]).ids)
+        return {model: sorted(ids) for model, ids in sorted(touched.items()) if ids}
+
+    def _render_dry_run_report(self, report):
+        """HTML summary of a dry run"""
+        estimated = timedelta(seconds=round(report['estimated_time']))
+        parts = [
+            f"<p><strong>Simulated {report['sample_size']} of {report['total_products']} products</strong> "
+            f"in {report['wall_time']:.2f}s ({report['per_product'] * 1000:.0f} ms per product). "
+            f"All changes were rolled back.</p>",
+            f"<p>⏱️ <strong>Estimated duration for the full selection: {estimated}</strong></p>",
+            f"<ul><li style='color: green;'>✅ Would succeed: {report['success_count']}</li>",
+        ]
+        if report['failed_count']:
+            parts.append(f"<li style='color: red;'>❌ Would fail: {report['failed_count']}</li>")
+        parts.append("</ul>")
+        
+        if report['touched']:
+            rows = []
+            for model, ids in report['touched'].items():
+                listed = ', '.join(str(record_id) for record_id in ids[:DRY_RUN_LISTED_IDS])
+                if len(ids) > DRY_RUN_LISTED_IDS:
+                    listed += f", … {len(ids) - DRY_RUN_LISTED_IDS} more"
+                rows.append(f"<tr><td>{html_escape(model)}</td><td>{len(ids)}</td><td>{listed}</td></tr>")
+            parts.append(
+                "<p><strong>Records touched by the sample:</strong></p>"
+                "<table class='table table-sm'><thead><tr><th>Model</th><th>Records</th><th>IDs</th></tr></thead>"
+                f"<tbody>{''.join(rows)}</tbody></table>"
+            )
+        
+        if report['phase_stats']:
+            rows = ''.join(
+                f"<tr><td>{stat['label']}</td><td>{stat['wall_time']:.2f}</td>"
+                f"<td>{stat['avg_time']:.1f}</td><td>{stat['query_count']}</td></tr>"
+                for stat in report['phase_stats']
+            )
+            parts.append(
+                "<p><strong>Time per phase:</strong></p>"
+                "<table class='table table-sm'><thead><tr><th>Phase</th><th>Total (s)</th>"
+                f"<th>Avg (ms)</th><th>Queries</th></tr></thead><tbody>{rows}</tbody></table>"
+            )
+        
+        if report['errors']:
+            errors = ''.join(f"<li>{html_escape(error)}</li>" for error in report['errors'][:20])
+            parts.append(f"<p><strong>Errors:</strong></p><ul>{errors}</ul>")
+        
+        return ''.join(parts)
+
+    def _action_enqueue(self, products):
+        """Turn the target products into a background run of N-product chunks"""
+        run = self.env['product.archive.replace.run'].create(self._get_run_values(products))
+        run._create_chunks(products.ids)
+        run.action_queue()
+        
+        _logger.info(f"Queued archive & replace run {run.name}: "
+                     f"{len(products)} products in {len(run.chunk_ids)} chunks")
+        
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'product.archive.replace.run',
+            'res_id': run.id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+    def _get_run_values(self, products):
+        """Values of the background run created from this wizard"""
+        vals = {field_name: self[field_name]
+                for field_name in self.env['product.archive.replace.run']._get_option_fields()}
+        vals.update({
+            'chunk_size': self.chunk_size,
+            'worker_count': max(self.worker_count, 1),
+            'product_count': len(products),
+        })
+        return vals
+
+    def _process_products(self, products, run, chunk=None):
+        """
+        Process ``products`` in batches of result lines, so a large run never
+        holds all its results in memory: the replacements of a batch are
+        duplicated together, then its products are processed one by one and
+        its result lines created at once.
+        Products already completed in ``run`` are left out, products replaced
+        by an earlier attempt are skipped or resumed from their last checkpoint.
+        Returns the success/failed/skipped counts.
+        """
+        self = self.with_context(archive_replace_run_id=run.id)
+        if self.chatter_mode != 'immediate':
+            # The migration helpers write through the wizard environment: no tracking on any record
+            self = self.with_context(tracking_disable=True, mail_notrack=True, mail_create_nolog=True)
+        products = products.with_env(self.env)
+        batch_size = max(self.env['product.archive.replace.run.line']._get_create_batch_size(), 1)
+        profiling = self.env['product.archive.replace.profiler']._is_enabled()
+        
+        done_ids, resume = self._get_checkpoints(products, run)
+        products = products.filtered(lambda p: p.id not in done_ids)
+        if self.lock_mode == 'wait' and self.env.context.get('archive_replace_parallel'):
+            self._lock_chunk_parents(products)
+        
+        results = {'success_count': 0, 'failed_count': 0, 'skipped_count': 0}
+        for start in range(0, len(products), batch_size):
+            batch_results = self._process_batch(products[start:start + batch_size], run, chunk, resume, profiling)
+            for key, count in batch_results.items():
+                results[key] += count
+        return results
+
+    def _process_batch(self, products, run, chunk, resume, profiling=False):
+        """
+        Duplicate and process one batch of ``products``, then create their
+        result lines with one create. Products are processed up to the stock
+        phase, their other references are migrated once for the whole batch,
+        then the products whose references were migrated are archived.
+        ``resume`` holds the checkpoints of the products replaced by an
+        earlier attempt.
+        Returns the success/failed/skipped counts of the batch.
+        """
+        RunLine = self.env['product.archive.replace.run.line']
+        profiler = self.env['product.archive.replace.profiler']
+        pending_lines = []
+        pending_messages = []
+        staged = []
         success_count = 0
         failed_count = 0
-        result_lines = []
+        skipped_count = 0
+        
+        def get_failure_vals(checkpoint, error):
+            return {
+                'new_product_id': checkpoint['new_product'].id if checkpoint['new_product'] else False,
+                'status': 'failed',
+                'error_message': str(error),
+                'checkpoint': checkpoint['phase'],
+            }
+        
+        copy_profile = profiler._new_profile(profiling)
+        with copy_profile.phase('copy'):
+            replacements = self._duplicate_products(products.filtered(lambda p: p.id not in resume))
+        copy_share = copy_profile.get_share('copy', len(replacements))
         
         for product in products:
+            new_product, last_phase = resume.get(product.id, (replacements.get(product.id), False))
+            checkpoint = {'phase': last_phase, 'new_product': new_product}
+            line_vals = {
+                'run_id': run.id,
+                'chunk_id': chunk.id if chunk else False,
+                'old_product_id': product.id,
+                'old_product_name': product.name,
+                'old_default_code': product.default_code or '',
+                'old_barcode': product.barcode or '',
+                'old_type': product.type,
+                'new_type': self.new_type,
+            }
+            if last_phase == PHASE_SEQUENCE[-1]:
+                # Completed by an earlier attempt: only recorded
+                line_vals.update({
+                    'new_product_id': new_product.id,
+                    'new_product_name': new_product.name,
+                    'status': 'skipped',
+                    'checkpoint': last_phase,
+                    'note': _("Already replaced by an earlier run."),
+                })
+                skipped_count += 1
+                pending_lines.append((line_vals, NULL_PROFILE))
+                continue
+            
+            profile = profiler._new_profile(profiling)
+            if product.id in replacements:
+                profile.add('copy', **copy_share)
             try:
-                result_data = self._process_single_product(product)
-                summary_lines.append(result_data['html'])
+                result_data = self._process_single_product(
+                    product, profile=profile, new_product=new_product, checkpoint=checkpoint, stop_after='stock')
                 
-                result_lines.append((0, 0, {
-                    'old_product_id': product.id,
-                    'old_product_name': product.name,
-                    'old_default_code': product.default_code or '',
-                    'old_barcode': product.barcode or '',
-                    'old_type': product.type,
+                line_vals.update({
                     'new_product_id': result_data.get('new_product_id'),
                     'new_product_name': result_data.get('new_product_name', ''),
-                    'new_type': self.new_type,
-                    'status': 'success',
                     'sales_migrated': result_data.get('sales_count', 0),
                     'purchases_migrated': result_data.get('purchases_count', 0),
                     'boms_migrated': result_data.get('boms_count', 0),
                     'pricelists_migrated': result_data.get('pricelists_count', 0),
                     'vendors_migrated': result_data.get('vendors_count', 0),
                     'stock_transferred': result_data.get('stock_qty', 0),
-                    'error_message': '',
-                }))
-                
-                success_count += 1
-                
+                    'note': result_data.get('note') or False,
+                })
+                staged.append((product, line_vals, profile, checkpoint))
+            
             except Exception as e:
-                error_msg = f"<p style='color: red;'>❌ <strong>{product.name}</strong>: {str(e)}</p>"
-                summary_lines.append(error_msg)
                 _logger.error(f"Failed to process {product.name}: {e}", exc_info=True)
                 
-                result_lines.append((0, 0, {
-                    'old_product_id': product.id,
-                    'old_product_name': product.name,
-                    'old_default_code': product.default_code or '',
-                    'old_barcode': product.barcode or '',
-                    'old_type': product.type,
-                    'new_type': self.new_type,
-                    'status': 'failed',
-                    'error_message': str(e),
-                }))
+                if not self.continue_on_error or self._is_concurrency_error(e):
+                    raise
                 
+                line_vals.update(get_failure_vals(checkpoint, e))
                 failed_count += 1
+                pending_lines.append((line_vals, profile))
+        
+        # Checkpoints only move past the references once they are migrated
+        reference_errors = {}
+        reference_batch = [
+            (line_vals, profile, (product, checkpoint['new_product'], checkpoint['variant_map']))
+            for product, line_vals, profile, checkpoint in staged
+            if PHASE_SEQUENCE.index(checkpoint['phase']) < PHASE_SEQUENCE.index('references')
+        ] if self.migrate_references else []
+        if reference_batch:
+            reference_errors = self._migrate_reference_batch(reference_batch, profiling)
+            for product, _line_vals, _profile, checkpoint in staged:
+                if product.id not in reference_errors and checkpoint['phase'] == 'stock':
+                    checkpoint['phase'] = 'references'
+        
+        for product, line_vals, profile, checkpoint in staged:
+            try:
+                if product.id in reference_errors:
+                    raise UserError(_("Failed to migrate references: %s", reference_errors[product.id]))
+                result_data = self._process_single_product(
+                    product, profile=profile, new_product=checkpoint['new_product'], checkpoint=checkpoint)
+                
+                line_vals.update({
+                    'status': 'success',
+                    'note': '\n'.join(filter(None, [line_vals['note'], result_data.get('note')])) or False,
+                    'checkpoint': checkpoint['phase'],
+                })
+                pending_messages.extend(result_data.get('message_vals', []))
+                success_count += 1
+            
+            except Exception as e:
+                _logger.error(f"Failed to process {product.name}: {e}", exc_info=True)
                 
-                if not self.continue_on_error:
+                if not self.continue_on_error or self._is_concurrency_error(e):
                     raise
+                
+                line_vals.update(get_failure_vals(checkpoint, e))
+                failed_count += 1
+            
+            pending_lines.append((line_vals, profile))
         
-        summary_lines.append("<hr/>")
-        summary_lines.append(f"<p><strong>Results:</strong></p>")
-        summary_lines.append(f"<ul>")
-        summary_lines.append(f"<li style='color: green;'>✅ Success: {success_count}</li>")
-        if failed_count > 0:
-            summary_lines.append(f"<li style='color: red;'>❌ Failed: {failed_count}</li>")
-        summary_lines.append(f"</ul>")
+        vals_list = []
+        for line_vals, profile in pending_lines:
+            if profile.phases:
+                phase_vals = profile.get_phase_vals()
+                line_vals.update({
+                    'phase_ids': [(0, 0, dict(vals, run_id=run.id)) for vals in phase_vals],
+                    'profile_time': sum(vals['wall_time'] for vals in phase_vals),
+                    'profile_query_count': sum(vals['query_count'] for vals in phase_vals),
+                })
+            vals_list.append(line_vals)
+        RunLine.create(vals_list)
         
-        self.migration_summary = ''.join(summary_lines)
-        self.show_results = True
-        self.success_count = success_count
-        self.failed_count = failed_count
-        self.result_line_ids = result_lines
-        
-        _logger.info("="*80)
-        _logger.info(f"MASS MIGRATION COMPLETED")
-        _logger.info(f"Success: {success_count}, Failed: {failed_count}")
-        _logger.info("="*80)
+        if pending_messages:
+            self._create_messages(pending_messages)
         
         return {
-            'type': 'ir.actions.act_window',
-            'res_model': 'product.archive.replace.wizard',
-            'res_id': self.id,
-            'view_mode': 'form',
-            'target': 'new',
+            'success_count': success_count,
+            'failed_count': failed_count,
+            'skipped_count': skipped_count,
         }
 
-    def _process_single_product(self, old_product):
-        """Process a single product replacement - returns structured data"""
-        log_lines = []
-        log_lines.append(f"<p><strong>📦 {old_product.name}</strong></p>")
-        log_lines.append("<ul>")
+    def _get_checkpoints(self, products, run):
+        """
+        Resume state of ``products`` from earlier attempts of ``run``.
+        Returns the ids already completed in ``run`` and a dict
+        {old template id: (replacement, last completed phase)} for the products
+        already linked to a replacement. Products with a failed or retried line
+        in ``run`` resume after its checkpoint; archived products whose
+        replacement has the target type are complete. Other links come from
+        an earlier replacement of a reactivated product, which is replaced
+        again.
+        """
+        RunLine = self.env['product.archive.replace.run.line']
+        done_lines = RunLine.search_read([
+            ('run_id', '=', run.id),
+            ('old_product_id', 'in', products.ids),
+            ('status', 'in', ('success', 'skipped')),
+        ], ['old_product_id'])
+        done_ids = {line['old_product_id'][0] for line in done_lines}
         
-        _logger.info(f"Processing product: {old_product.name} (ID: {old_product.id})")
+        replaced = products.filtered(lambda p: p.id not in done_ids and p.replacement_template_id)
+        if not replaced:
+            return done_ids, {}
         
-        barcode = old_product.barcode
-        default_code = old_product.default_code
+        latest = {}
+        for line in RunLine.search_read([
+            ('run_id', '=', run.id),
+            ('old_product_id', 'in', replaced.ids),
+            ('checkpoint', '!=', False),
+        ], ['old_product_id', 'checkpoint'], order='id desc'):
+            latest.setdefault(line['old_product_id'][0], line['checkpoint'])
         
-        copy_vals = {
-            'name': old_product.name,
-            'type': self.new_type,
-            'barcode': barcode,
-            'default_code': default_code,
-            'active': True,
-        }
+        resume = {}
+        for product in replaced:
+            replacement = product.replacement_template_id
+            if not product.active and replacement.type == self.new_type:
+                resume[product.id] = (replacement, PHASE_SEQUENCE[-1])
+            elif product.id in latest:
+                resume[product.id] = (replacement, latest[product.id])
         
-        if hasattr(old_product, 'detailed_type'):
-            type_to_detailed = {
-                'product': 'product',
-                'consu': 'consu', 
-                'service': 'service',
-            }
-            copy_vals['detailed_type'] = type_to_detailed.get(self.new_type, self.new_type)
+        _logger.info(f"Resuming {len(resume)} products replaced by an earlier attempt")
+        return done_ids, resume
+
+    def _process_single_product(self, old_product, profile=NULL_PROFILE, new_product=None, checkpoint=None,
+                                stop_after=None):
+        """
+        Process a single product replacement - returns structured data.
+        ``new_product`` is the replacement when it was already created by
+        ``_duplicate_products`` or by an earlier attempt, otherwise the old
+        product is copied here.
+        ``checkpoint`` holds the last completed phase: phases up to it are
+        skipped, and it is moved forward as each phase completes. With
+        ``stop_after``, the phases following that one are left for a later
+        call with the same checkpoint.
+        Each phase is measured by ``profile`` when profiling is enabled.
+        """
+        warnings = []
+        if checkpoint is None:
+            checkpoint = {'phase': False, 'new_product': new_product}
+        start = PHASE_SEQUENCE.index(checkpoint['phase']) if checkpoint['phase'] else -1
+        end = PHASE_SEQUENCE.index(stop_after) if stop_after else len(PHASE_SEQUENCE) - 1
         
-        try:
-            old_product.write({'barcode': False, 'default_code': False})
-            new_product = old_product.copy(copy_vals)
-            log_lines.append(f"<li>✅ Created new product (ID: {new_product.id})</li>")
-            _logger.info(f"Created new product ID: {new_product.id}")
-        except Exception as e:
+        def pending(phase):
+            return start < PHASE_SEQUENCE.index(phase) <= end
+        
+        def completed(phase):
+            if pending(phase):
+                checkpoint['phase'] = phase
+        
+        # Set by an earlier call stopped after a phase: the product is not resumed
+        variant_map = checkpoint.get('variant_map')
+        if variant_map is None:
+            _logger.info(f"Processing product: {old_product.name} (ID: {old_product.id})")
+        
+        barcode = old_product.barcode
+        default_code = old_product.default_code
+        precreated = bool(new_product)
+        journal = self.env['product.archive.replace.journal']
+        
+        if pending('copy'):
             try:
-                old_product.write({'barcode': barcode, 'default_code': default_code})
-            except:
-                pass
-            raise UserError(f"Failed to create new product: {e}")
+                with profile.phase('copy') as stat:
+                    if not precreated:
+                        copy_vals = self._get_copy_values(old_product)
+                        with journal._recording(old_product.with_context(active_test=False).product_variant_ids,
+                                                ['barcode', 'default_code']):
+                            old_product.write({'barcode': False, 'default_code': False})
+                        new_product = old_product.copy(copy_vals)
+                        journal._record_creation(new_product)
+                    # Old variants are matched to new variants once, on their attribute values
+                    variant_map = old_product._get_variant_map(new_product)
+                    self._transfer_variant_codes(variant_map)
+                    with journal._recording(old_product, ['replacement_template_id', 'replacement_date',
+                                                          'replacement_user_id', 'original_type']):
+                        old_product.write({
+                            'replacement_template_id': new_product.id,
+                            'replacement_date': fields.Datetime.now(),
+                            'replacement_user_id': self.env.uid,
+                            'original_type': old_product.type,
+                        })
+                    stat['row_count'] = 1
+                _logger.info(f"Created new product ID: {new_product.id}")
+            except Exception as e:
+                if self._is_concurrency_error(e):
+                    raise
+                if not precreated:
+                    try:
+                        old_product.write({'barcode': barcode, 'default_code': default_code})
+                    except:
+                        pass
+                raise UserError(f"Failed to create new product: {e}")
+            checkpoint['new_product'] = new_product
+            completed('copy')
+        elif variant_map is None:
+            _logger.info(f"Resuming after phase {checkpoint['phase']} with replacement "
+                         f"{new_product.name} (ID: {new_product.id})")
+        
+        if variant_map is None:
+            variant_map = old_product._get_variant_map(new_product)
+        checkpoint['variant_map'] = variant_map
         
         counts = {
             'new_product_id': new_product.id,
@@ -444,251 +1027,655 @@ class ProductArchiveReplaceWizard(models.TransientModel):
             'pricelists_count': 0,
             'vendors_count': 0,
             'stock_qty': 0,
+            'references_count': 0,
         }
         
-        if self.migrate_sales:
-            count = self._migrate_sales_orders(old_product, new_product)
+        if self.migrate_sales and pending('sales'):
+            with profile.phase('sales') as stat:
+                count = self._migrate_sales_orders(old_product, new_product, variant_map)
+                stat['row_count'] = count
             counts['sales_count'] = count
-            if count > 0:
-                log_lines.append(f"<li>✅ Sales: {count} lines migrated</li>")
+        completed('sales')
         
-        if self.migrate_purchases:
-            count = self._migrate_purchase_orders(old_product, new_product)
+        if self.migrate_purchases and pending('purchases'):
+            with profile.phase('purchases') as stat:
+                count = self._migrate_purchase_orders(old_product, new_product, variant_map)
+                stat['row_count'] = count
             counts['purchases_count'] = count
-            if count > 0:
-                log_lines.append(f"<li>✅ Purchases: {count} lines migrated</li>")
+        completed('purchases')
         
-        if self.migrate_boms and self.has_mrp:
-            count = self._migrate_boms(old_product, new_product)
+        if self.migrate_boms and self.has_mrp and pending('boms'):
+            with profile.phase('boms') as stat:
+                count = self._migrate_boms(old_product, new_product, variant_map)
+                stat['row_count'] = count
             counts['boms_count'] = count
-            if count > 0:
-                log_lines.append(f"<li>✅ BOMs: {count} records migrated</li>")
+        completed('boms')
         
-        if self.migrate_pricelists:
-            count = self._migrate_pricelists(old_product, new_product)
+        if self.migrate_pricelists and pending('pricelists'):
+            with profile.phase('pricelists') as stat:
+                count = self._migrate_pricelists(old_product, new_product, variant_map)
+                stat['row_count'] = count
             counts['pricelists_count'] = count
-            if count > 0:
-                log_lines.append(f"<li>✅ Pricelists: {count} rules migrated</li>")
+        completed('pricelists')
         
-        if self.migrate_vendors:
-            count = self._migrate_vendors(old_product, new_product)
+        if self.migrate_vendors and pending('vendors'):
+            with profile.phase('vendors') as stat:
+                count = self._migrate_vendors(old_product, new_product, variant_map)
+                stat['row_count'] = count
             counts['vendors_count'] = count
-            if count > 0:
-                log_lines.append(f"<li>✅ Vendors: {count} records migrated</li>")
+        completed('vendors')
         
-        if self.migrate_stock and old_product.type == 'product':
-            qty = self._transfer_stock(old_product, new_product)
+        # The replacement has another type: stock of a storable product cannot follow it
+        if self.migrate_stock and old_product.type == 'product' and pending('stock'):
+            with profile.phase('stock') as stat:
+                qty = self._clear_stock(old_product)
+                stat['row_count'] = len(old_product.product_variant_ids)
             counts['stock_qty'] = qty
-            if qty != 0:
-                log_lines.append(f"<li>✅ Stock: {qty} units transferred</li>")
+        completed('stock')
+        
+        # _process_batch stops before this phase and migrates the references of its products at once
+        if self.migrate_references and pending('references'):
+            with profile.phase('references') as stat:
+                reference_counts, errors = self._migrate_other_references([(old_product, new_product, variant_map)])
+                count = reference_counts.get(old_product.id, 0)
+                stat['row_count'] = count
+            if errors:
+                raise UserError(_("Failed to migrate references: %s", errors[old_product.id]))
+            counts['references_count'] = count
+        completed('references')
+        
+        if pending('archive'):
+            try:
+                with profile.phase('archive') as stat:
+                    with journal._recording(old_product.with_context(active_test=False).product_variant_ids,
+                                            ['active']), \
+                            journal._recording(old_product, ['active']):
+                        old_product.active = False
+                    stat['row_count'] = 1
+            except Exception as e:
+                if self._is_concurrency_error(e):
+                    raise
+                warnings.append(f"Could not archive: {e}")
+        completed('archive')
+        
+        if pending('chatter'):
+            try:
+                with profile.phase('chatter') as stat:
+                    messages = self._get_replacement_messages(old_product, new_product)
+                    if self.chatter_mode == 'immediate':
+                        for record, body, subject in messages:
+                            record.message_post(body=body, subject=subject)
+                        stat['row_count'] = len(messages)
+                    elif self.chatter_mode == 'batched':
+                        counts['message_vals'] = [
+                            self._prepare_message_vals(record, body, subject)
+                            for record, body, subject in messages
+                        ]
+                        stat['row_count'] = len(messages)
+            except Exception as e:
+                if self._is_concurrency_error(e):
+                    raise
+        completed('chatter')
+        
+        counts['note'] = '\n'.join(warnings)
+        
+        return counts
+
+    def _get_copy_values(self, old_product):
+        """Values overriding the copied fields of the replacement of ``old_product``"""
+        copy_vals = {
+            'name': old_product.name,
+            'type': self.new_type,
+            'barcode': old_product.barcode,
+            'default_code': old_product.default_code,
+            'active': True,
+            'replaced_template_id': old_product.id,
+        }
+        
+        if hasattr(old_product, 'detailed_type'):
+            type_to_detailed = {
+                'product': 'product',
+                'consu': 'consu', 
+                'service': 'service',
+            }
+            copy_vals['detailed_type'] = type_to_detailed.get(self.new_type, self.new_type)
+        
+        return copy_vals
+
+    def _transfer_variant_codes(self, variant_map):
+        """
+        Move the internal references and barcodes of the old variants to the
+        new variants they are mapped to. Single-variant templates already got
+        theirs through the copy values. Archived old variants keep their
+        codes: they would overwrite the ones of the active variant mapped to
+        the same new variant.
+        """
+        old_variants = self.env['product.product'].browse(list(variant_map)).filtered(
+            lambda variant: variant.active and (variant.barcode or variant.default_code))
+        if not old_variants:
+            return
+        codes = [(variant_map[variant.id], variant.barcode, variant.default_code) for variant in old_variants]
+        new_variants = old_variants.browse(list({variant_map[variant.id].id for variant in old_variants}))
+        journal = self.env['product.archive.replace.journal']
+        with journal._recording(old_variants, ['barcode', 'default_code']), \
+                journal._recording(new_variants, ['barcode', 'default_code']):
+            old_variants.write({'barcode': False, 'default_code': False})
+            assigned = set()
+            for new_variant, barcode, default_code in codes:
+                if new_variant.id in assigned:
+                    continue
+                assigned.add(new_variant.id)
+                new_variant.write({'barcode': barcode, 'default_code': default_code})
+
+    def _duplicate_products(self, products):
+        """
+        Create the replacements of ``products`` with one multi-record create.
+        Copy values are read with ``copy_data`` on the prefetched templates;
+        codes and barcodes are released on all old products with one write so
+        the replacements can take them over.
+        Returns {old template id: new template}, or an empty dict when the
+        batch failed and each product has to be copied on its own.
+        """
+        if len(products) < 2:
+            return {}
         
         try:
-            old_product.active = False
-            log_lines.append(f"<li>✅ Archived old product</li>")
+            with self.env.cr.savepoint():
+                products = products.with_context(active_test=False)
+                copy_defaults = [self._get_copy_values(product) for product in products]
+                vals_list = [product.copy_data(default)[0]
+                             for product, default in zip(products, copy_defaults)]
+                journal = self.env['product.archive.replace.journal']
+                with journal._recording(products.product_variant_ids, ['barcode', 'default_code']):
+                    products.write({'barcode': False, 'default_code': False})
+                new_products = products.browse().create(vals_list)
+                journal._record_creation(new_products)
+                for product, new_product, default in zip(products, new_products, copy_defaults):
+                    product.with_context(from_copy_translation=True).copy_translations(
+                        new_product, excluded=default)
         except Exception as e:
-            log_lines.append(f"<li>⚠️ Could not archive: {e}</li>")
+            if self._is_concurrency_error(e):
+                raise
+            _logger.warning(f"Batch duplication of {len(products)} products failed, "
+                            f"copying them one by one: {e}")
+            return {}
         
-        try:
-            old_product.message_post(
-                body=f"<p>🔄 <strong>Replaced by:</strong> {new_product.name} (ID: {new_product.id})</p>",
-                subject="Product Replaced"
-            )
-            new_product.message_post(
-                body=f"<p>✅ <strong>Replacement for:</strong> {old_product.name} (ID: {old_product.id})</p>",
-                subject="Product Created"
+        _logger.info(f"Created {len(new_products)} replacement products in one batch")
+        return dict(zip(products.ids, new_products))
+
+    # ========== CHATTER ==========
+
+    def _get_replacement_messages(self, old_product, new_product):
+        """Chatter messages of one replacement, as (record, body, subject)"""
+        return [
+            (old_product,
+             f"<p>🔄 <strong>Replaced by:</strong> {new_product.name} (ID: {new_product.id})</p>",
+             "Product Replaced"),
+            (new_product,
+             f"<p>✅ <strong>Replacement for:</strong> {old_product.name} (ID: {old_product.id})</p>",
+             "Product Created"),
+        ]
+
+    def _prepare_message_vals(self, record, body, subject):
+        """Values of the note ``message_post`` would create, without followers or notifications"""
+        return {
+            'model': record._name,
+            'res_id': record.id,
+            'record_name': record.display_name,
+            'body': body,
+            'subject': subject,
+            'message_type': 'notification',
+            'subtype_id': self.env['ir.model.data']._xmlid_to_res_id('mail.mt_note'),
+            'author_id': self.env.user.partner_id.id,
+            'email_from': self.env.user.email_formatted,
+        }
+
+    def _create_messages(self, vals_list):
+        """Create the deferred chatter messages of a batch with one create"""
+        self.env['mail.message'].sudo().create(vals_list)
+        _logger.info(f"Created {len(vals_list)} chatter messages in one batch")
+
+    # ========== MIGRATION METHODS ==========
+
+    def _is_concurrency_error(self, error):
+        """Concurrency errors abort the whole chunk so it can be retried"""
+        return self.env['product.archive.replace.run']._is_concurrency_error(error)
+
+    def _lock_chunk_parents(self, products):
+        """
+        Lock every parent document holding lines of ``products`` before the
+        first product is processed: table after table in PARENT_LOCKS order,
+        in id order within each table. Parallel workers then take the orders
+        they share in the same global order and wait for each other instead
+        of deadlocking, whatever the order of their products.
+        """
+        variant_ids = tuple(products.with_context(active_test=False).product_variant_ids.ids)
+        if not variant_ids:
+            return
+        for parent_model, line_model, parent_field in PARENT_LOCKS:
+            if parent_model not in self.env or line_model not in self.env:
+                continue
+            Parent, Line = self.env[parent_model], self.env[line_model]
+            Line.flush_model(['product_id', parent_field])
+            query = f'SELECT "{parent_field}" FROM "{Line._table}" WHERE product_id IN %s'
+            params = [variant_ids]
+            if parent_model == 'mrp.bom':
+                # BOMs of the templates are rewritten too, with the filters of their lines
+                query += f' UNION SELECT id FROM "{Parent._table}" WHERE product_tmpl_id IN %s'
+                params.append(tuple(products.ids))
+            self.env.cr.execute(
+                f'SELECT id FROM "{Parent._table}" WHERE id IN ({query}) ORDER BY id FOR NO KEY UPDATE', params)
+
+    def _lock_parent_records(self, records, parent_field):
+        """
+        Lock the parent documents of ``records`` in id order. In parallel
+        runs they are already held since ``_lock_chunk_parents``, this only
+        covers the lines created since.
+        """
+        parents = records.mapped(parent_field)
+        if parents:
+            self.env.cr.execute(
+                f'SELECT id FROM "{parents._table}" WHERE id IN %s ORDER BY id FOR NO KEY UPDATE',
+                [tuple(parents.ids)]
             )
-        except:
-            pass
+
+    def _acquire_rows(self, records, get_vals, label, parent_field=None):
+        """
+        Lock ``records`` and their ``parent_field`` documents without waiting
+        (SKIP LOCKED). Rows held by other transactions, e.g. an order being
+        edited, are deferred on the run and retried later by the scheduled
+        actions. Returns the records that were acquired.
+        """
+        if not records:
+            return records
+        cr = self.env.cr
+        acquired_ids = set(records.ids)
         
-        log_lines.append("</ul>")
-        counts['html'] = ''.join(log_lines)
+        if parent_field:
+            parents = records.mapped(parent_field)
+            locked_parents = set()
+            if parents:
+                cr.execute(
+                    f'SELECT id FROM "{parents._table}" WHERE id IN %s ORDER BY id FOR NO KEY UPDATE SKIP LOCKED',
+                    [tuple(parents.ids)]
+                )
+                locked_parents = {row[0] for row in cr.fetchall()}
+            acquired_ids = {record.id for record in records
+                            if not record[parent_field] or record[parent_field].id in locked_parents}
         
-        return counts
+        if acquired_ids:
+            cr.execute(
+                f'SELECT id FROM "{records._table}" WHERE id IN %s ORDER BY id FOR NO KEY UPDATE SKIP LOCKED',
+                [tuple(acquired_ids)]
+            )
+            acquired_ids = {row[0] for row in cr.fetchall()}
+        
+        locked = records.filtered(lambda record: record.id not in acquired_ids)
+        if locked:
+            run = self.env['product.archive.replace.run'].browse(self.env.context.get('archive_replace_run_id'))
+            if not run:
+                raise UserError(_("Locked rows can only be deferred within a migration run."))
+            self.env['product.archive.replace.deferred']._defer(run, locked, get_vals, label, parent_field)
+        return records - locked
 
-    # ========== MIGRATION METHODS ==========
+    def _write_grouped(self, records, get_vals, label, parent_field=None):
+        """
+        Rewrite ``records`` with one write() per distinct target values.
+        Groups that fail in bulk (or all records when bulk mode is off)
+        are written one record at a time so continue_on_error keeps working.
+        In parallel runs the ``parent_field`` documents are locked first; in
+        low-contention mode locked rows are deferred instead of waited for.
+        Returns the number of records written.
+        """
+        if self.lock_mode == 'skip_locked':
+            records = self._acquire_rows(records, get_vals, label, parent_field)
+        elif parent_field and self.env.context.get('archive_replace_parallel'):
+            self._lock_parent_records(records, parent_field)
+        
+        groups = defaultdict(list)
+        for record in records:
+            vals = get_vals(record)
+            groups[tuple(sorted(vals.items()))].append(record.id)
+        
+        count = 0
+        field_names = {field_name for key in groups for field_name, _value in key}
+        with self.env['product.archive.replace.journal']._recording(records, field_names):
+            for key, record_ids in groups.items():
+                batch = records.browse(record_ids)
+                vals = dict(key)
+                
+                if self.bulk_write:
+                    try:
+                        with self.env.cr.savepoint():
+                            batch.write(vals)
+                        count += len(batch)
+                        continue
+                    except Exception as e:
+                        if self._is_concurrency_error(e):
+                            raise
+                        _logger.warning(f"Bulk {label} write failed for {len(batch)} records, "
+                                        f"falling back to per-record writes: {e}")
+                
+                for record in batch:
+                    try:
+                        with self.env.cr.savepoint():
+                            record.write(vals)
+                        count += 1
+                    except Exception as e:
+                        _logger.warning(f"Failed to migrate {label} {record.id}: {e}")
+                        if not self.continue_on_error or self._is_concurrency_error(e):
+                            raise
+        return count
 
-    def _migrate_sales_orders(self, old_product, new_product):
+    def _migrate_sales_orders(self, old_product, new_product, variant_map):
         """Migrate sales order lines"""
         try:
-            old_variants = old_product.product_variant_ids
-            new_variant = new_product.product_variant_ids[0]
-            lines = self.env['sale.order.line'].search([('product_id', 'in', old_variants.ids)])
-            count = 0
-            for line in lines:
-                try:
-                    line.product_id = new_variant
-                    count += 1
-                except Exception as e:
-                    _logger.warning(f"Failed to migrate SO line {line.id}: {e}")
-                    if not self.continue_on_error:
-                        raise
-            return count
+            lines = self.env['sale.order.line'].search([('product_id', 'in', list(variant_map))])
+            return self._write_grouped(lines, lambda line: {'product_id': variant_map[line.product_id.id].id},
+                                       'SO line', parent_field='order_id')
         except Exception as e:
             _logger.error(f"Sales migration error: {e}")
-            if not self.continue_on_error:
+            if not self.continue_on_error or self._is_concurrency_error(e):
                 raise
             return 0
 
-    def _migrate_purchase_orders(self, old_product, new_product):
+    def _migrate_purchase_orders(self, old_product, new_product, variant_map):
         """Migrate purchase order lines"""
         try:
-            old_variants = old_product.product_variant_ids
-            new_variant = new_product.product_variant_ids[0]
-            lines = self.env['purchase.order.line'].search([('product_id', 'in', old_variants.ids)])
-            count = 0
-            for line in lines:
-                try:
-                    line.product_id = new_variant
-                    count += 1
-                except Exception as e:
-                    _logger.warning(f"Failed to migrate PO line {line.id}: {e}")
-                    if not self.continue_on_error:
-                        raise
-            return count
+            lines = self.env['purchase.order.line'].search([('product_id', 'in', list(variant_map))])
+            return self._write_grouped(lines, lambda line: {'product_id': variant_map[line.product_id.id].id},
+                                       'PO line', parent_field='order_id')
         except Exception as e:
             _logger.error(f"Purchase migration error: {e}")
-            if not self.continue_on_error:
+            if not self.continue_on_error or self._is_concurrency_error(e):
                 raise
             return 0
 
-    def _migrate_boms(self, old_product, new_product):
+    def _migrate_boms(self, old_product, new_product, variant_map):
         """Migrate bills of materials"""
         if not self.has_mrp:
             return 0
         try:
-            old_variants = old_product.product_variant_ids
-            new_variant = new_product.product_variant_ids[0]
-            count = 0
             boms = self.env['mrp.bom'].search([('product_tmpl_id', '=', old_product.id)])
-            for bom in boms:
-                try:
-                    bom.write({
-                        'product_tmpl_id': new_product.id,
-                        'product_id': new_variant.id if bom.product_id else False
-                    })
-                    count += 1
-                except Exception as e:
-                    _logger.warning(f"Failed to migrate BOM {bom.id}: {e}")
-                    if not self.continue_on_error:
-                        raise
-            bom_lines = self.env['mrp.bom.line'].search([('product_id', 'in', old_variants.ids)])
-            for line in bom_lines:
-                try:
-                    line.product_id = new_variant
-                    count += 1
-                except Exception as e:
-                    _logger.warning(f"Failed to migrate BOM line {line.id}: {e}")
-                    if not self.continue_on_error:
-                        raise
+            self._migrate_bom_variant_filters(boms, old_product, new_product)
+            count = self._write_grouped(boms, lambda bom: {
+                'product_tmpl_id': new_product.id,
+                'product_id': variant_map[bom.product_id.id].id if bom.product_id else False,
+            }, 'BOM')
+            bom_lines = self.env['mrp.bom.line'].search([('product_id', 'in', list(variant_map))])
+            count += self._write_grouped(bom_lines, lambda line: {'product_id': variant_map[line.product_id.id].id},
+                                        'BOM line', parent_field='bom_id')
             return count
         except Exception as e:
             _logger.error(f"BOM migration error: {e}")
-            if not self.continue_on_error:
+            if not self.continue_on_error or self._is_concurrency_error(e):
                 raise
             return 0
 
-    def _migrate_pricelists(self, old_product, new_product):
+    def _migrate_bom_variant_filters(self, boms, old_product, new_product):
+        """
+        Point the "Apply on Variants" filters of the lines, by-products and
+        operations of ``boms`` to the matching attribute values of the new
+        template, so the BOMs pass their consistency check once moved.
+        """
+        value_map = old_product._get_attribute_value_map(new_product)
+        for field_name, label in [('bom_line_ids', 'BOM line filter'),
+                                  ('byproduct_ids', 'BOM by-product filter'),
+                                  ('operation_ids', 'BOM operation filter')]:
+            children = boms.mapped(field_name).filtered('bom_product_template_attribute_value_ids')
+            self._write_grouped(children, lambda child: {
+                'bom_product_template_attribute_value_ids': ((6, 0, tuple(
+                    value_map[value.id] for value in child.bom_product_template_attribute_value_ids
+                    if value_map.get(value.id)
+                )),),
+            }, label, parent_field='bom_id')
+
+    def _migrate_pricelists(self, old_product, new_product, variant_map):
         """Migrate pricelist items"""
         try:
-            old_variants = old_product.product_variant_ids
-            new_variant = new_product.product_variant_ids[0]
             items = self.env['product.pricelist.item'].search([
                 '|', ('product_tmpl_id', '=', old_product.id),
-                ('product_id', 'in', old_variants.ids)
+                ('product_id', 'in', list(variant_map))
             ])
-            count = 0
-            for item in items:
-                try:
-                    item.write({
-                        'product_tmpl_id': new_product.id if item.product_tmpl_id else False,
-                        'product_id': new_variant.id if item.product_id else False
-                    })
-                    count += 1
-                except Exception as e:
-                    _logger.warning(f"Failed to migrate pricelist {item.id}: {e}")
-                    if not self.continue_on_error:
-                        raise
-            return count
+            return self._write_grouped(items, lambda item: {
+                'product_tmpl_id': new_product.id if item.product_tmpl_id else False,
+                'product_id': variant_map[item.product_id.id].id if item.product_id else False,
+            }, 'pricelist')
         except Exception as e:
             _logger.error(f"Pricelist migration error: {e}")
-            if not self.continue_on_error:
+            if not self.continue_on_error or self._is_concurrency_error(e):
                 raise
             return 0
 
-    def _migrate_vendors(self, old_product, new_product):
+    def _migrate_vendors(self, old_product, new_product, variant_map):
         """Migrate vendor records"""
         try:
-            old_variants = old_product.product_variant_ids
-            new_variant = new_product.product_variant_ids[0]
             suppliers = self.env['product.supplierinfo'].search([
                 '|', ('product_tmpl_id', '=', old_product.id),
-                ('product_id', 'in', old_variants.ids)
+                ('product_id', 'in', list(variant_map))
             ])
-            count = 0
-            for supplier in suppliers:
-                try:
-                    supplier.write({
-                        'product_tmpl_id': new_product.id if supplier.product_tmpl_id else False,
-                        'product_id': new_variant.id if supplier.product_id else False
-                    })
-                    count += 1
-                except Exception as e:
-                    _logger.warning(f"Failed to migrate vendor {supplier.id}: {e}")
-                    if not self.continue_on_error:
-                        raise
-            return count
+            return self._write_grouped(suppliers, lambda supplier: {
+                'product_tmpl_id': new_product.id if supplier.product_tmpl_id else False,
+                'product_id': variant_map[supplier.product_id.id].id if supplier.product_id else False,
+            }, 'vendor')
         except Exception as e:
             _logger.error(f"Vendor migration error: {e}")
-            if not self.continue_on_error:
+            if not self.continue_on_error or self._is_concurrency_error(e):
                 raise
             return 0
 
-    def _transfer_stock(self, old_product, new_product):
-        """Transfer stock quantities"""
+    def _migrate_reference_batch(self, batch, profiling=False):
+        """
+        Migrate the other references of a batch of replacements at once and
+        report the rows migrated on their result lines.
+        ``batch`` is a list of (line values, profile, (old template, new
+        template, variant map)); the measured time is shared between them.
+        Returns {old template id: error} of the replacements that failed.
+        """
+        batch_profile = self.env['product.archive.replace.profiler']._new_profile(profiling)
+        with batch_profile.phase('references'):
+            counts, errors = self._migrate_other_references([maps for _line_vals, _profile, maps in batch])
+        share = batch_profile.get_share('references', len(batch))
+        for line_vals, profile, (old_product, _new_product, _variant_map) in batch:
+            line_vals['references_migrated'] = counts.get(old_product.id, 0)
+            if share:
+                profile.add('references', **dict(share, row_count=line_vals['references_migrated']))
+        return errors
+
+    def _migrate_other_references(self, replacements):
+        """
+        Migrate the references discovered by the reference registry for all
+        ``replacements`` (old template, new template, variant map) with one
+        update per field.
+        In low-contention mode, rows locked by other users are deferred.
+        Returns {old template id: rows migrated} and {old template id: error}
+        of the replacements whose references could not all be migrated.
+        """
+        template_map = {}
+        variant_ids = {}
+        variant_templates = {}
+        for old_product, new_product, variant_map in replacements:
+            template_map[old_product.id] = new_product.id
+            for old_id, new_variant in variant_map.items():
+                variant_ids[old_id] = new_variant.id
+                variant_templates[old_id] = old_product.id
+        
         try:
-            if old_product.type != 'product':
+            with self.env.cr.savepoint():
+                skip_locked = self.lock_mode == 'skip_locked'
+                updated, locked, failed = self.env['product.archive.replace.reference']._migrate_references(
+                    template_map, variant_ids, skip_locked=skip_locked)
+                
+                run = self.env['product.archive.replace.run'].browse(self.env.context.get('archive_replace_run_id'))
+                for (model_name, field_name, comodel), ids in locked:
+                    mapping = variant_ids if comodel == 'product.product' else template_map
+                    self.env['product.archive.replace.deferred']._defer(
+                        run, self.env[model_name].browse(ids),
+                        lambda record: {field_name: mapping[record[field_name].id]},
+                        f'{model_name}.{field_name}')
+        except Exception as e:
+            _logger.error(f"References migration error: {e}")
+            if not self.continue_on_error or self._is_concurrency_error(e):
+                raise
+            return {}, dict.fromkeys(template_map, str(e))
+        
+        counts = defaultdict(int)
+        for (comodel, old_id), count in updated.items():
+            counts[old_id if comodel == 'product.template' else variant_templates[old_id]] += count
+        errors = {}
+        for (comodel, old_id), error in failed.items():
+            template_id = old_id if comodel == 'product.template' else variant_templates[old_id]
+            errors[template_id] = f"{errors[template_id]}\n{error}" if template_id in errors else error
+        if errors:
+            _logger.error(f"References of {len(errors)} products could not be migrated")
+        return counts, errors
+
+    def _clear_stock(self, old_product):
+        """
+        Bring the on-hand quantities of the old variants to zero. The
+        replacement is not storable and cannot hold quants, so the stock
+        would otherwise stay on an archived product. The quantities are
+        journaled so that a revert puts them back.
+        Returns the quantity cleared.
+        """
+        try:
+            quants = self.env['stock.quant'].sudo().search([
+                ('product_id', 'in', old_product.with_context(active_test=False).product_variant_ids.ids),
+                ('location_id.usage', '=', 'internal'),
+                ('quantity', '!=', 0),
+            ])
+            if not quants:
                 return 0
-            old_variants = old_product.product_variant_ids
-            new_variant = new_product.product_variant_ids[0]
+            
+            try:
+                with self.env.cr.savepoint():
+                    if self.stock_transfer_moves:
+                        return self._clear_quants_with_moves(quants)
+                    return self._clear_quants(quants)
+            except Exception as e:
+                if self._is_concurrency_error(e):
+                    raise
+                _logger.warning(f"Bulk stock clearing failed for {old_product.name}, "
+                                f"falling back to per-quant updates: {e}")
+            
             total_qty = 0
-            quants = self.env['stock.quant'].search([
-                ('product_id', 'in', old_variants.ids),
-                ('location_id.usage', '=', 'internal')
-            ])
+            cleared = []
             for quant in quants:
-                if quant.quantity == 0:
-                    continue
                 try:
                     qty = quant.quantity
-                    self.env['stock.quant'].with_context(inventory_mode=True)._update_available_quantity(
-                        new_variant, quant.location_id, qty,
-                        lot_id=quant.lot_id, package_id=quant.package_id, owner_id=quant.owner_id
-                    )
-                    self.env['stock.quant'].with_context(inventory_mode=True)._update_available_quantity(
-                        quant.product_id, quant.location_id, -qty,
-                        lot_id=quant.lot_id, package_id=quant.package_id, owner_id=quant.owner_id
-                    )
+                    with self.env.cr.savepoint():
+                        self.env['stock.quant'].with_context(inventory_mode=True)._update_available_quantity(
+                            quant.product_id, quant.location_id, -qty,
+                            lot_id=quant.lot_id, package_id=quant.package_id, owner_id=quant.owner_id
+                        )
+                    cleared.append(self._get_stock_row(quant, -qty))
                     total_qty += qty
                 except Exception as e:
-                    _logger.warning(f"Failed to transfer stock in location {quant.location_id.name}: {e}")
-                    if not self.continue_on_error:
+                    _logger.warning(f"Failed to clear stock in location {quant.location_id.name}: {e}")
+                    if not self.continue_on_error or self._is_concurrency_error(e):
                         raise
+            self.env['product.archive.replace.journal']._record_stock(cleared)
             return total_qty
         except Exception as e:
-            _logger.error(f"Stock transfer error: {e}")
-            if not self.continue_on_error:
+            _logger.error(f"Stock clearing error: {e}")
+            if not self.continue_on_error or self._is_concurrency_error(e):
                 raise
             return 0
 
+    def _get_stock_row(self, quant, quantity):
+        """Journal row of ``quantity`` added to the quant ``quant``"""
+        return {
+            'product_id': quant.product_id.id,
+            'location_id': quant.location_id.id,
+            'lot_id': quant.lot_id.id,
+            'package_id': quant.package_id.id,
+            'owner_id': quant.owner_id.id,
+            'quantity': quantity,
+        }
+
+    def _clear_quants(self, quants):
+        """Zero the quants with one write"""
+        # The revert adds these quantities back, whatever the quants hold by then
+        self.env['product.archive.replace.journal']._record_stock([
+            self._get_stock_row(quant, -quant.quantity) for quant in quants
+        ])
+        total_qty = sum(quants.mapped('quantity'))
+        quants.write({'quantity': 0})
+        return total_qty
+
+    def _clear_quants_with_moves(self, quants):
+        """
+        Zero the quants through done inventory moves created in one batch,
+        from their location to the inventory adjustment location, keeping a
+        traceable history.
+        """
+        move_vals = []
+        for quant in quants:
+            product = quant.product_id
+            inventory_location = product.with_company(quant.company_id).property_stock_inventory
+            qty = abs(quant.quantity)
+            internal = quant.location_id
+            # Negative quants are brought back to zero the other way around
+            src, dest = (internal, inventory_location) if quant.quantity > 0 else (inventory_location, internal)
+            move_vals.append({
+                'name': _('Archive & Replace: %s', product.display_name),
+                'product_id': product.id,
+                'product_uom': product.uom_id.id,
+                'product_uom_qty': qty,
+                'location_id': src.id,
+                'location_dest_id': dest.id,
+                'company_id': quant.company_id.id,
+                'is_inventory': True,
+                'move_line_ids': [(0, 0, {
+                    'product_id': product.id,
+                    'product_uom_id': product.uom_id.id,
+                    'qty_done': qty,
+                    'location_id': src.id,
+                    'location_dest_id': dest.id,
+                    'lot_id': quant.lot_id.id,
+                    'package_id': quant.package_id.id if src == internal else False,
+                    'result_package_id': quant.package_id.id if dest == internal else False,
+                    'owner_id': quant.owner_id.id,
+                    'company_id': quant.company_id.id,
+                })],
+            })
+        
+        total_qty = sum(quants.mapped('quantity'))
+        moves = self.env['stock.move'].sudo().create(move_vals)
+        moves._action_done()
+        self.env['product.archive.replace.journal']._record_creation(moves)
+        return total_qty
+
     def action_print_audit_report(self):
         """Generate PDF audit report"""
         self.ensure_one()
         return self.env.ref('ics_product_archive_replace.action_report_product_archive_replace').report_action(self)
 
+    def _get_report_line_domain(self):
+        """Result lines listed in the audit report"""
+        domain = [('run_id', '=', self.run_id.id)]
+        if self.report_compact:
+            domain.append(('status', '=', 'failed'))
+        return domain
+
+    def _get_report_lines(self, offset=0, limit=None):
+        """One page-sized slice of the audit report lines"""
+        return self.env['product.archive.replace.run.line'].search(
+            self._get_report_line_domain(), offset=offset, limit=limit, order='id')
+
     def action_export_excel(self):
         """Export results to Excel"""
         self.ensure_one()
-        raise UserError(_("Excel export will be available in next version"))
+        if not self.run_id:
+            raise UserError(_("There are no results to export yet."))
+        return self.run_id.action_export_xlsx()
+
+    def action_export_csv(self):
+        """Export results to CSV"""
+        self.ensure_one()
+        if not self.run_id:
+            raise UserError(_("There are no results to export yet."))
+        return self.run_id.action_export_csv()
 
     def action_view_new_products(self):
         """View all newly created products"""
@@ -708,9 +1695,10 @@ class ProductArchiveReplaceWizard(models.TransientModel):
 class ProductArchiveReplacePreviewLine(models.TransientModel):
     _name = 'product.archive.replace.preview.line'
     _description = 'Product Replace Preview Line'
-    _order = 'product_name'
+    _order = 'sequence, id'
 
     wizard_id = fields.Many2one('product.archive.replace.wizard', required=True, ondelete='cascade')
+    sequence = fields.Integer('Sequence', default=0)
     product_id = fields.Many2one('product.template', string='Product', required=True)
     product_name = fields.Char(related='product_id.name', string='Product Name', readonly=True)
     default_code = fields.Char(string='Internal Reference', readonly=True)
@@ -747,61 +1735,3 @@ class ProductArchiveReplacePreviewLine(models.TransientModel):
     def _compute_has_stock(self):
         for line in self:
             line.has_stock = line.stock_qty != 0
-
-
-# ============================================================================
-# RESULT LINE MODEL
-# ============================================================================
-
-class ProductArchiveReplaceResultLine(models.TransientModel):
-    _name = 'product.archive.replace.result.line'
-    _description = 'Product Replacement Result Line'
-    _order = 'old_product_name'
-
-    wizard_id = fields.Many2one('product.archive.replace.wizard', required=True, ondelete='cascade')
-    
-    old_product_id = fields.Many2one('product.template', string='Old Product', readonly=True)
-    old_product_name = fields.Char('Old Product Name', readonly=True)
-    old_default_code = fields.Char('Old Ref', readonly=True)
-    old_barcode = fields.Char('Old Barcode', readonly=True)
-    old_type = fields.Selection([
-        ('product', 'Storable'),
-        ('consu', 'Consumable'),
-        ('service', 'Service'),
-    ], string='Old Type', readonly=True)
-    
-    new_product_id = fields.Many2one('product.template', string='New Product', readonly=True)
-    new_product_name = fields.Char('New Product Name', readonly=True)
-    new_type = fields.Selection([
-        ('product', 'Storable'),
-        ('consu', 'Consumable'),
-        ('service', 'Service'),
-    ], string='New Type', readonly=True)
-    
-    status = fields.Selection([
-        ('success', 'Success'),
-        ('failed', 'Failed'),
-    ], string='Status', readonly=True)
-    
-    sales_migrated = fields.Integer('Sales Lines', readonly=True)
-    purchases_migrated = fields.Integer('Purchase Lines', readonly=True)
-    boms_migrated = fields.Integer('BOMs', readonly=True)
-    pricelists_migrated = fields.Integer('Pricelists', readonly=True)
-    vendors_migrated = fields.Integer('Vendors', readonly=True)
-    stock_transferred = fields.Float('Stock Transferred', readonly=True)
-    
-    error_message = fields.Text('Error Message', readonly=True)
-    
-    type_change = fields.Char('Type Change', compute='_compute_type_change', store=False)
-    
-    @api.depends('old_type', 'new_type')
-    def _compute_type_change(self):
-        for line in self:
-            type_map = {
-                'product': 'Storable',
-                'consu': 'Consumable',
-                'service': 'Service',
-            }
-            old = type_map.get(line.old_type, line.old_type)
-            new = type_map.get(line.new_type, line.new_type)
-            line.type_change = f"{old} → {new}"            
\ No newline at end of file